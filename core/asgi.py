@@ -3,6 +3,10 @@ ASGI config for core project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serving the project through this module (e.g. ``uvicorn core.asgi:application``)
+enables the live dashboard stream at /api/dashboard-stream/; under WSGI the
+dashboard polls /api/dashboard-data/ instead.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
 """
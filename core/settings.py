@@ -84,6 +84,55 @@ DATABASES = {
     }
 }
 
+# Dashboard figures are cached (see inventory/cache.py). The file cache is
+# shared by every worker on the host, so an invalidation reaches all of them;
+# point this at Redis or Memcached when workers run on several hosts.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
+    }
+}
+
+# Rows the running inventory KPIs are spread over (see inventory/totals.py);
+# more rows let more stock writes update the totals without queueing
+INVENTORY_TOTALS_STRIPES = 8
+
+# Stock report builds allowed at once across the workers sharing the cache,
+# and how long (seconds) other report requests wait for a slot, or for an
+# identical build in progress, before getting a 503 with Retry-After
+STOCK_REPORT_MAX_CONCURRENT = 2
+STOCK_REPORT_QUEUE_TIMEOUT = 10
+STOCK_REPORT_WAIT_TIMEOUT = 30
+
+# Whole months of stock history kept in the live table (besides the current
+# month); older rows are moved to the archive by archive_stock_history
+STOCK_HISTORY_HOT_MONTHS = 6
+
+# The availability and price endpoints read quantity and price from a file
+# mapped by every worker on the host (see inventory/shared_stock.py), lagging
+# the database by at most this many seconds; 0 makes them query the database.
+# STOCK_SNAPSHOT_PATH overrides the file, which defaults to the temp directory.
+# Run sweep_stock_snapshot every minute to pick up transactions that committed
+# long after they stamped last_modified.
+STOCK_SNAPSHOT_MAX_AGE = 2
+
+# Milliseconds between write-behind flushes of quantity changes made through
+# inventory.writebehind (see that module); 0 writes each change immediately.
+# Unflushed changes are journaled under STOCK_WRITE_BEHIND_JOURNAL_DIR, and
+# only the worker holding that directory's owner lock defers them. A change
+# that still cannot be applied after STOCK_WRITE_BEHIND_MAX_ATTEMPTS flushes is
+# saved as a RejectedStockChange (see the admin) and dropped.
+STOCK_WRITE_BEHIND_MS = 0
+STOCK_WRITE_BEHIND_JOURNAL_DIR = os.path.join(BASE_DIR, 'stock_journal')
+STOCK_WRITE_BEHIND_MAX_ATTEMPTS = 20
+
+# Seconds a soft stock reservation (inventory/reservations.py) holds units for
+# an in-progress sale; expire_stock_reservations clears the expired ones
+STOCK_RESERVATION_TTL = 900
+# Seconds the availability endpoints may lag holds placed by other workers
+STOCK_RESERVATION_MAX_AGE = 1
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
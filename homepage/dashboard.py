@@ -0,0 +1,80 @@
+"""
+Cached dashboard figures.
+
+Everything on the dashboard except the incrementally maintained inventory
+totals is built here once per `days` window and trend bucket and served from
+the cache until a stock, stock history or bill change invalidates it.
+"""
+from inventory.analytics import BUCKETS, period_totals, sales_purchase_trend, top_sold
+from inventory.cache import DASHBOARD, get_or_compute
+from inventory.models import Stock
+
+# Upper bound on staleness for the time-based windows when nothing changes
+DASHBOARD_CACHE_TIMEOUT = 300
+
+# The windows the dashboard offers; anything else falls back to the default,
+# so a request cannot add cache entries of its own choosing
+DASHBOARD_DAYS = (7, 30, 90)
+DEFAULT_DASHBOARD_DAYS = 30
+
+
+def dashboard_days(value):
+    """The `days` request parameter as one of DASHBOARD_DAYS"""
+    try:
+        days = int(value)
+    except (TypeError, ValueError):
+        return DEFAULT_DASHBOARD_DAYS
+    return days if days in DASHBOARD_DAYS else DEFAULT_DASHBOARD_DAYS
+
+
+def build_dashboard_data(days, bucket=None):
+    """Compute the dashboard figures for the last `days` days"""
+    from transactions.models import SaleBill, PurchaseBill
+
+    # Stock chart data - Top 10 items
+    top_stock = list(Stock.objects.filter(is_deleted=False).order_by('-quantity').values_list('name', 'quantity')[:10])
+
+    # Top selling items
+    top_selling = top_sold(days, limit=5)
+
+    # Stock value distribution (for pie chart)
+    high_value_stocks = list(Stock.objects.filter(
+        is_deleted=False
+    ).order_by('-stock_value').values_list('name', 'stock_value')[:5])
+
+    # Recent transactions, as plain values so the cache never holds model instances
+    sales = [
+        {'billno': bill.billno, 'name': bill.name, 'time': bill.time, 'total': bill.get_total_price()}
+        for bill in SaleBill.objects.prefetch_related('saleitem_set').order_by('-time')[:5]
+    ]
+    purchases = [
+        {'billno': bill.billno, 'supplier': bill.supplier.name, 'time': bill.time, 'total': bill.get_total_price()}
+        for bill in PurchaseBill.objects.select_related('supplier').prefetch_related(
+            'purchaseitem_set'
+        ).order_by('-time')[:5]
+    ]
+
+    return {
+        'labels': [name for name, _ in top_stock],
+        'data': [quantity for _, quantity in top_stock],
+        'totals': period_totals(days),
+        'top_selling': top_selling,
+        'trend': sales_purchase_trend(days, bucket),
+        'stock_value_labels': [name for name, _ in high_value_stocks],
+        'stock_value_data': [float(value) for _, value in high_value_stocks],
+        'sales': sales,
+        'purchases': purchases,
+    }
+
+
+def get_dashboard_data(days, bucket=None):
+    """Cached build_dashboard_data; concurrent misses for the same window share one computation"""
+    days = dashboard_days(days)
+    if bucket not in BUCKETS:
+        bucket = None
+    return get_or_compute(
+        DASHBOARD,
+        f'{days}:{bucket or ""}',
+        lambda: build_dashboard_data(days, bucket),
+        DASHBOARD_CACHE_TIMEOUT
+    )
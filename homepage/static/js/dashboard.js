@@ -1,12 +1,20 @@
 /**
- * Dashboard AJAX functionality for real-time updates
+ * Dashboard live updates
+ *
+ * Under ASGI the page listens to the KPI event stream; when the stream is not
+ * available (WSGI answers 204 and the browser closes it) it falls back to
+ * polling the dashboard data endpoint. Stock events carry the new stock KPIs
+ * and bill events carry per-day sales/purchase deltas, so neither makes the
+ * page fetch anything.
  */
 
-// Auto-refresh dashboard data
 var dashboardRefreshInterval;
+var dashboardEventSource;
+var dashboardBillTotals;    // {days, sales, purchases} shown in the KPI cards
 
 function startDashboardAutoRefresh(intervalSeconds) {
     intervalSeconds = intervalSeconds || 30; // Default 30 seconds
+    stopDashboardAutoRefresh();
     
     dashboardRefreshInterval = setInterval(function() {
         refreshDashboardData();
@@ -16,54 +24,103 @@ function startDashboardAutoRefresh(intervalSeconds) {
 function stopDashboardAutoRefresh() {
     if (dashboardRefreshInterval) {
         clearInterval(dashboardRefreshInterval);
+        dashboardRefreshInterval = null;
     }
 }
 
+function startDashboardLiveUpdates(streamUrl, pollSeconds, billTotals) {
+    dashboardBillTotals = billTotals;
+    if (typeof EventSource === 'undefined') {
+        startDashboardAutoRefresh(pollSeconds);
+        return;
+    }
+    
+    var connected = false;
+    dashboardEventSource = new EventSource(streamUrl);
+    dashboardEventSource.addEventListener('stock', function(event) {
+        updateStockKPIs(JSON.parse(event.data));
+    });
+    dashboardEventSource.addEventListener('bills', function(event) {
+        applyBillDeltas(JSON.parse(event.data));
+    });
+    dashboardEventSource.onopen = function() {
+        stopDashboardAutoRefresh();
+        if (connected) {
+            // Bill deltas sent while the stream was down are lost; catch up once
+            refreshDashboardData();
+        }
+        connected = true;
+    };
+    dashboardEventSource.onerror = function() {
+        // CLOSED means the server refused the stream; CONNECTING is a retry in progress
+        if (dashboardEventSource.readyState === EventSource.CLOSED) {
+            startDashboardAutoRefresh(pollSeconds);
+        }
+    };
+}
+
 function refreshDashboardData() {
-    var days = $('select[name="days"]').val() || 30;
+    var select = document.querySelector('select[name="days"]');
+    var days = (select && select.value) || 30;
     
-    $.ajax({
-        url: '/api/dashboard-data/',
-        data: {
-            'days': days
-        },
-        dataType: 'json',
-        success: function(data) {
-            updateKPICards(data);
-        },
-        error: function() {
+    fetch('/api/dashboard-data/?days=' + encodeURIComponent(days), {credentials: 'same-origin'})
+        .then(function(response) {
+            if (!response.ok) {
+                throw new Error(response.status);
+            }
+            return response.json();
+        })
+        .then(updateKPICards)
+        .catch(function() {
             console.error('Failed to refresh dashboard data');
-        }
+        });
+}
+
+function setKPIText(selector, text) {
+    document.querySelectorAll(selector).forEach(function(element) {
+        element.textContent = text;
     });
 }
 
-function updateKPICards(data) {
-    // Update KPI cards with new data
-    $('.kpi-total-stock-value').text('$' + data.total_stock_value.toFixed(2));
-    $('.kpi-total-sales').text('$' + data.total_sales.toFixed(2));
-    $('.kpi-total-purchases').text('$' + data.total_purchases.toFixed(2));
-    $('.kpi-profit').text('$' + data.profit.toFixed(2));
-    $('.kpi-low-stock-count').text(data.low_stock_count);
-    
-    // Update profit card color
-    var profitCard = $('.kpi-profit').closest('.card');
-    if (data.profit >= 0) {
-        profitCard.removeClass('bg-danger').addClass('bg-success');
-    } else {
-        profitCard.removeClass('bg-success').addClass('bg-danger');
+function applyBillDeltas(data) {
+    if (!dashboardBillTotals) {
+        return;
     }
+    // Windows are whole days, today included, counted on the server's calendar
+    var today = Date.parse(data.today);
+    Object.keys(data.days).forEach(function(day) {
+        if ((today - Date.parse(day)) / 86400000 < dashboardBillTotals.days) {
+            dashboardBillTotals.sales += data.days[day].sales;
+            dashboardBillTotals.purchases += data.days[day].purchases;
+        }
+    });
+    updateBillKPIs(dashboardBillTotals.sales, dashboardBillTotals.purchases);
 }
 
-// Initialize on page load
-$(document).ready(function() {
-    // Start auto-refresh if enabled
-    if (typeof enableAutoRefresh !== 'undefined' && enableAutoRefresh) {
-        startDashboardAutoRefresh(30);
-    }
+function updateStockKPIs(data) {
+    setKPIText('.kpi-total-stock-value', '$' + data.total_stock_value.toFixed(2));
+    setKPIText('.kpi-low-stock-count', data.low_stock_count);
+}
+
+function updateBillKPIs(sales, purchases) {
+    var profit = sales - purchases;
+    setKPIText('.kpi-total-sales', '$' + sales.toFixed(2));
+    setKPIText('.kpi-total-purchases', '$' + purchases.toFixed(2));
+    setKPIText('.kpi-profit', '$' + profit.toFixed(2));
     
-    // Refresh on period change
-    $('select[name="days"]').on('change', function() {
-        refreshDashboardData();
+    // Update profit card color
+    document.querySelectorAll('.kpi-profit').forEach(function(element) {
+        var profitCard = element.closest('.card');
+        profitCard.classList.toggle('bg-success', profit >= 0);
+        profitCard.classList.toggle('bg-danger', profit < 0);
     });
-});
+}
 
+function updateKPICards(data) {
+    updateStockKPIs(data);
+    if (dashboardBillTotals) {
+        dashboardBillTotals.sales = data.total_sales;
+        dashboardBillTotals.purchases = data.total_purchases;
+    }
+    updateBillKPIs(data.total_sales, data.total_purchases);
+}
@@ -1,3 +1,23 @@
+from unittest import mock
+
+from django.core.cache import cache
 from django.test import TestCase
 
-# Create your tests here.
+from . import dashboard
+
+
+class DashboardDaysTest(TestCase):
+    """Only the offered windows reach the dashboard cache"""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_days_are_clamped(self):
+        for value, days in [('7', 7), ('90', 90), (None, 30), ('', 30), ('abc', 30), ('100000', 30), ('-7', 30)]:
+            self.assertEqual(dashboard.dashboard_days(value), days, value)
+
+    def test_unknown_windows_share_the_default_entry(self):
+        with mock.patch.object(dashboard, 'build_dashboard_data', return_value={}) as build:
+            for value in ['30', '31', '99999', 'x']:
+                dashboard.get_dashboard_data(value)
+        build.assert_called_once_with(30, None)
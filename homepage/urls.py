@@ -10,4 +10,5 @@ urlpatterns = [
     path('create-user/', views.register, name='user-create'),
     path('users/delete/<int:pk>/', views.user_delete, name='user-delete'),
     path('api/dashboard-data/', views.DashboardDataView.as_view(), name='dashboard-data'),
+    path('api/dashboard-stream/', views.DashboardStreamView.as_view(), name='dashboard-stream'),
 ]
\ No newline at end of file
@@ -1,6 +1,8 @@
 from django.shortcuts import render, redirect
 from django.views.generic import View, TemplateView, ListView, CreateView
 from inventory.models import Stock
+from inventory.totals import get_totals as get_inventory_totals
+from .dashboard import dashboard_days, get_dashboard_data
 from django.contrib.auth.models import User
 # from django.contrib.auth.forms import UserCreationForm
 from .forms import UserCreationForm
@@ -13,6 +15,9 @@ from django.db.models import Sum, Count, F, Avg, Max, Min, Q
 from django.utils import timezone
 from datetime import timedelta
 import json
+import logging
+
+logger = logging.getLogger(__name__)
 
 class HomeView(View):
     template_name = "home.html"
@@ -23,144 +28,48 @@ class HomeView(View):
             logger = logging.getLogger(__name__)
             
             # Get date range (default: last 30 days)
-            days = int(request.GET.get('days', 30))
-            start_date = timezone.now() - timedelta(days=days)
+            days = dashboard_days(request.GET.get('days'))
             
-            # Stock chart data - Top 10 items
-            labels = []
-            data = []
-            stockqueryset = Stock.objects.filter(is_deleted=False).order_by('-quantity')[:10]
-            for item in stockqueryset:
-                labels.append(item.name)
-                data.append(item.quantity)
+            # Charts, period totals, top sellers and recent bills (cached per window)
+            dashboard = get_dashboard_data(days, request.GET.get('bucket'))
+            totals = dashboard['totals']
+            trend = dashboard['trend']
             
-            # KPI Calculations
-            # Total inventory value
-            total_stock_value = Stock.objects.filter(
-                is_deleted=False
-            ).aggregate(
-                total=Sum(F('quantity') * F('unit_price'))
-            )['total'] or 0
+            # KPI Calculations (maintained incrementally by the stock write paths)
+            inventory_totals = get_inventory_totals()
+            total_stock_value = inventory_totals.total_value
+            low_stock_count = inventory_totals.low_stock_count
+            out_of_stock_count = inventory_totals.out_of_stock_count
             
             # Low stock items
             low_stock_items = Stock.objects.filter(
                 is_deleted=False,
                 quantity__lte=10
             ).order_by('quantity')  # Order by quantity ascending to show most critical first
-            low_stock_count = low_stock_items.count()
-            
-            # Out of stock items
-            out_of_stock_count = Stock.objects.filter(
-                is_deleted=False,
-                quantity=0
-            ).count()
-            
-            # Monthly sales (last 30 days)
-            total_sales = SaleItem.objects.filter(
-                billno__time__gte=start_date
-            ).aggregate(
-                total=Sum('totalprice')
-            )['total'] or 0
-            
-            sales_count = SaleBill.objects.filter(time__gte=start_date).count()
-            
-            # Monthly purchases (last 30 days)
-            total_purchases = PurchaseItem.objects.filter(
-                billno__time__gte=start_date
-            ).aggregate(
-                total=Sum('totalprice')
-            )['total'] or 0
-            
-            purchases_count = PurchaseBill.objects.filter(time__gte=start_date).count()
-            
-            # Profit calculation
-            profit = total_sales - total_purchases
-            
-            # Previous period for comparison (30 days before start_date)
-            prev_start_date = start_date - timedelta(days=days)
-            prev_total_sales = SaleItem.objects.filter(
-                billno__time__gte=prev_start_date,
-                billno__time__lt=start_date
-            ).aggregate(total=Sum('totalprice'))['total'] or 0
-            
-            prev_total_purchases = PurchaseItem.objects.filter(
-                billno__time__gte=prev_start_date,
-                billno__time__lt=start_date
-            ).aggregate(total=Sum('totalprice'))['total'] or 0
-            
-            # Calculate percentage changes
-            sales_change = ((total_sales - prev_total_sales) / prev_total_sales * 100) if prev_total_sales > 0 else 0
-            purchases_change = ((total_purchases - prev_total_purchases) / prev_total_purchases * 100) if prev_total_purchases > 0 else 0
-            
-            # Top selling items (last 30 days)
-            top_selling = SaleItem.objects.filter(
-                billno__time__gte=start_date
-            ).values('stock__name').annotate(
-                total_sold=Sum('quantity'),
-                revenue=Sum('totalprice')
-            ).order_by('-total_sold')[:5]
-            
-            # Sales trend (last 7 days)
-            sales_trend = []
-            sales_labels = []
-            for i in range(6, -1, -1):
-                date = timezone.now() - timedelta(days=i)
-                day_sales = SaleItem.objects.filter(
-                    billno__time__date=date.date()
-                ).aggregate(total=Sum('totalprice'))['total'] or 0
-                sales_trend.append(float(day_sales))
-                sales_labels.append(date.strftime('%b %d'))
-            
-            # Purchase trend (last 7 days)
-            purchase_trend = []
-            for i in range(6, -1, -1):
-                date = timezone.now() - timedelta(days=i)
-                day_purchases = PurchaseItem.objects.filter(
-                    billno__time__date=date.date()
-                ).aggregate(total=Sum('totalprice'))['total'] or 0
-                purchase_trend.append(float(day_purchases))
-            
-            # Stock value distribution (for pie chart)
-            stock_value_data = []
-            stock_value_labels = []
-            high_value_stocks = Stock.objects.filter(
-                is_deleted=False
-            ).annotate(
-                value=F('quantity') * F('unit_price')
-            ).order_by('-value')[:5]
-            
-            for stock in high_value_stocks:
-                stock_value_labels.append(stock.name)
-                stock_value_data.append(float(stock.quantity * stock.unit_price))
-            
-            # Recent transactions
-            sales = SaleBill.objects.prefetch_related('saleitem_set__stock').order_by('-time')[:5]
-            purchases = PurchaseBill.objects.select_related('supplier').prefetch_related(
-                'purchaseitem_set__stock'
-            ).order_by('-time')[:5]
             
             context = {
-                'labels': labels,
-                'data': data,
-                'sales': sales,
-                'purchases': purchases,
+                'labels': dashboard['labels'],
+                'data': dashboard['data'],
+                'sales': dashboard['sales'],
+                'purchases': dashboard['purchases'],
                 'total_stock_value': total_stock_value,
                 'low_stock_items': low_stock_items[:5],  # Top 5 low stock items
                 'low_stock_count': low_stock_count,
                 'out_of_stock_count': out_of_stock_count,
-                'total_sales': total_sales,
-                'total_purchases': total_purchases,
-                'profit': profit,
-                'sales_count': sales_count,
-                'purchases_count': purchases_count,
-                'sales_change': sales_change,
-                'purchases_change': purchases_change,
-                'top_selling': top_selling,
-                'sales_trend': sales_trend,
-                'sales_labels': sales_labels,
-                'purchase_trend': purchase_trend,
-                'stock_value_labels': stock_value_labels,
-                'stock_value_data': stock_value_data,
+                'total_sales': totals['total_sales'],
+                'total_purchases': totals['total_purchases'],
+                'profit': totals['profit'],
+                'sales_count': totals['sales_count'],
+                'purchases_count': totals['purchases_count'],
+                'sales_change': totals['sales_change'],
+                'purchases_change': totals['purchases_change'],
+                'top_selling': dashboard['top_selling'],
+                'sales_trend': trend['sales'],
+                'sales_labels': trend['labels'],
+                'purchase_trend': trend['purchases'],
+                'stock_value_labels': dashboard['stock_value_labels'],
+                'stock_value_data': dashboard['stock_value_data'],
+                'trend_bucket': trend['bucket'],
                 'days': days,
             }
             return render(request, self.template_name, context)
@@ -189,26 +98,17 @@ class DashboardDataView(View):
     def get(self, request):
         try:
             from django.http import JsonResponse
-            days = int(request.GET.get('days', 30))
-            start_date = timezone.now() - timedelta(days=days)
+            days = dashboard_days(request.GET.get('days'))
             
             # Quick stats
-            total_stock_value = Stock.objects.filter(
-                is_deleted=False
-            ).aggregate(total=Sum(F('quantity') * F('unit_price')))['total'] or 0
-            
-            total_sales = SaleItem.objects.filter(
-                billno__time__gte=start_date
-            ).aggregate(total=Sum('totalprice'))['total'] or 0
+            inventory_totals = get_inventory_totals()
+            total_stock_value = inventory_totals.total_value
+            low_stock_count = inventory_totals.low_stock_count
             
-            total_purchases = PurchaseItem.objects.filter(
-                billno__time__gte=start_date
-            ).aggregate(total=Sum('totalprice'))['total'] or 0
-            
-            low_stock_count = Stock.objects.filter(
-                is_deleted=False,
-                quantity__lte=10
-            ).count()
+            dashboard = get_dashboard_data(days, request.GET.get('bucket'))
+            totals = dashboard['totals']
+            total_sales = totals['total_sales']
+            total_purchases = totals['total_purchases']
             
             data = {
                 'total_stock_value': float(total_stock_value),
@@ -217,12 +117,55 @@ class DashboardDataView(View):
                 'profit': float(total_sales - total_purchases),
                 'low_stock_count': low_stock_count,
             }
+            if request.GET.get('trend') == '1':
+                data['trend'] = dashboard['trend']
             
             return JsonResponse(data)
         except Exception as e:
             logger.error(f"Error generating dashboard data: {str(e)}", exc_info=True)
             return JsonResponse({'error': str(e)}, status=500)
 
+class DashboardStreamView(View):
+    """Server-sent events stream of dashboard KPI changes (needs an ASGI server)"""
+    heartbeat_seconds = 15
+    retry_milliseconds = 5000
+
+    async def get(self, request):
+        from django.http import HttpResponse, StreamingHttpResponse
+        from django.core.handlers.asgi import ASGIRequest
+        if not isinstance(request, ASGIRequest):
+            # A WSGI worker would be held for as long as the page is open;
+            # 204 tells EventSource not to reconnect and the page polls instead
+            return HttpResponse(status=204)
+        response = StreamingHttpResponse(self.events(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    async def events(self):
+        from asgiref.sync import sync_to_async
+        from inventory.live import broadcaster
+        from inventory.totals import totals_payload
+
+        subscription = broadcaster.subscribe()
+        try:
+            yield f"retry: {self.retry_milliseconds}\n\n"
+            # Current values first, so a reconnecting client is never stale
+            yield self.format_event('stock', await sync_to_async(totals_payload)())
+            while True:
+                events = await subscription.wait(self.heartbeat_seconds)
+                if events is None:
+                    yield ": keepalive\n\n"
+                    continue
+                for name, data in events.items():
+                    yield self.format_event(name, data)
+        finally:
+            broadcaster.unsubscribe(subscription)
+
+    @staticmethod
+    def format_event(name, data):
+        return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
 class AboutView(TemplateView):
     template_name = "about.html"
 
@@ -0,0 +1,67 @@
+"""
+Denormalized last sale and purchase times on Stock.
+
+`Stock.last_sold_at` / `last_purchased_at` hold the bill time of the latest
+sale / purchase item for each stock item, so "not sold in N days" is a range
+scan on (is_deleted, last_sold_at) instead of an anti-join over every sale item.
+Recording an item only moves the time forward; deleting one recomputes it from
+the items that remain. Neither bumps Stock.version: the fields are left out
+of full saves, so a sale does not conflict with an edit of the same item.
+"""
+from django.apps import apps
+from django.db.models import Max, OuterRef, Q, Subquery
+from .models import Stock
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Bill item model -> Stock field it maintains
+ACTIVITY_FIELDS = {
+    'transactions.SaleItem': 'last_sold_at',
+    'transactions.PurchaseItem': 'last_purchased_at',
+}
+
+BACKFILL_CHUNK_SIZE = 1000
+
+
+def _bill_time(item):
+    bill_model = item._meta.get_field('billno').related_model
+    return bill_model.objects.filter(pk=item.billno_id).values_list('time', flat=True).first()
+
+
+def record_activity(item, field):
+    """Move `field` of the item's stock forward to the item's bill time"""
+    when = _bill_time(item)
+    if when is None:
+        return
+    Stock.objects.filter(
+        Q(**{f'{field}__isnull': True}) | Q(**{f'{field}__lt': when}),
+        pk=item.stock_id
+    ).update(**{field: when})
+
+
+def _latest_bill_time(item_model):
+    return Subquery(
+        item_model.objects.filter(
+            stock=OuterRef('pk')
+        ).order_by().values('stock').annotate(
+            latest=Max('billno__time')
+        ).values('latest')[:1]
+    )
+
+
+def refresh_activity(stock_ids, item_label):
+    """Recompute the field maintained by `item_label` for the given stock ids"""
+    item_model = apps.get_model(item_label)
+    field = ACTIVITY_FIELDS[item_label]
+    return Stock.objects.filter(pk__in=stock_ids).update(**{field: _latest_bill_time(item_model)})
+
+
+def backfill_activity(chunk_size=BACKFILL_CHUNK_SIZE):
+    """Recompute both fields for every stock item, one UPDATE per field per chunk; returns the item count"""
+    stock_ids = list(Stock.objects.order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(stock_ids), chunk_size):
+        chunk = stock_ids[start:start + chunk_size]
+        for item_label in ACTIVITY_FIELDS:
+            refresh_activity(chunk, item_label)
+    return len(stock_ids)
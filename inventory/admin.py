@@ -1,4 +1,5 @@
 from django.contrib import admin
-from .models import Stock
+from .models import RejectedStockChange, Stock
 
-admin.site.register(Stock)
\ No newline at end of file
+admin.site.register(Stock)
+admin.site.register(RejectedStockChange)
\ No newline at end of file
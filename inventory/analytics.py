@@ -0,0 +1,165 @@
+"""
+Sales and purchase figures shared by the dashboard, its AJAX endpoint and the stock report.
+
+Amounts and quantities come from the DailyStockMovement facts, so each figure is
+one grouped query over days x items rows, whatever the transaction volume.
+Windows are whole days, today included.
+"""
+import datetime
+
+from django.db.models import Sum, Q, DateField
+from django.db.models.functions import Trunc
+from django.utils import timezone
+
+from .models import DailyStockMovement
+
+BUCKETS = ('day', 'week', 'month')
+
+BUCKET_LABEL_FORMATS = {
+    'day': '%b %d',
+    'week': '%b %d',
+    'month': '%b %Y',
+}
+
+
+def default_bucket(days):
+    """Daily buckets up to a month, weekly up to half a year, monthly beyond"""
+    if days <= 31:
+        return 'day'
+    if days <= 180:
+        return 'week'
+    return 'month'
+
+
+def _bucket_start(day, bucket):
+    if bucket == 'week':
+        return day - datetime.timedelta(days=day.weekday())
+    if bucket == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def _next_bucket(day, bucket):
+    if bucket == 'week':
+        return day + datetime.timedelta(days=7)
+    if bucket == 'month':
+        return (day.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return day + datetime.timedelta(days=1)
+
+
+def _bucket_keys(first_day, last_day, bucket):
+    """Every bucket start between the two days, so empty buckets still get a zero"""
+    keys = []
+    key = _bucket_start(first_day, bucket)
+    while key <= last_day:
+        keys.append(key)
+        key = _next_bucket(key, bucket)
+    return keys
+
+
+def _first_day(days):
+    return timezone.localdate() - datetime.timedelta(days=days - 1)
+
+
+def _bucketed_totals(first_day, bucket):
+    """{bucket start date: (revenue, cost)} of the daily movements since `first_day`"""
+    rows = DailyStockMovement.objects.filter(
+        date__gte=first_day
+    ).annotate(
+        period=Trunc('date', bucket, output_field=DateField())
+    ).values('period').annotate(
+        revenue=Sum('revenue'),
+        cost=Sum('cost')
+    ).order_by()
+    return {row['period']: (row['revenue'] or 0, row['cost'] or 0) for row in rows}
+
+
+def sales_purchase_trend(days=7, bucket=None):
+    """
+    Sales and purchase totals for the last `days` days (today included) grouped
+    into day, week or month buckets, with empty buckets filled with zeros.
+    Returns {'bucket', 'labels', 'sales', 'purchases'}.
+    """
+    if bucket not in BUCKETS:
+        bucket = default_bucket(days)
+    first_day = _first_day(days)
+
+    totals = _bucketed_totals(first_day, bucket)
+    keys = _bucket_keys(first_day, timezone.localdate(), bucket)
+    label_format = BUCKET_LABEL_FORMATS[bucket]
+    return {
+        'bucket': bucket,
+        'labels': [key.strftime(label_format) for key in keys],
+        'sales': [float(totals.get(key, (0, 0))[0]) for key in keys],
+        'purchases': [float(totals.get(key, (0, 0))[1]) for key in keys],
+    }
+
+
+def _day_start(day):
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+def _percent_change(current, previous):
+    return ((current - previous) / previous * 100) if previous > 0 else 0
+
+
+def period_totals(days):
+    """
+    Sales and purchase totals and bill counts for the last `days` days, plus the
+    totals of the period just before it: one query over the daily movements and
+    one count per bill table.
+    """
+    from transactions.models import SaleBill, PurchaseBill
+
+    first_day = _first_day(days)
+    previous_first_day = first_day - datetime.timedelta(days=days)
+    current = Q(date__gte=first_day)
+    previous = Q(date__lt=first_day)
+    totals = DailyStockMovement.objects.filter(
+        date__gte=previous_first_day
+    ).aggregate(
+        sales=Sum('revenue', filter=current),
+        purchases=Sum('cost', filter=current),
+        prev_sales=Sum('revenue', filter=previous),
+        prev_purchases=Sum('cost', filter=previous)
+    )
+    start = _day_start(first_day)
+
+    total_sales = totals['sales'] or 0
+    total_purchases = totals['purchases'] or 0
+    prev_total_sales = totals['prev_sales'] or 0
+    prev_total_purchases = totals['prev_purchases'] or 0
+    return {
+        'start_date': start,
+        'total_sales': total_sales,
+        'total_purchases': total_purchases,
+        'sales_count': SaleBill.objects.filter(time__gte=start).count(),
+        'purchases_count': PurchaseBill.objects.filter(time__gte=start).count(),
+        'profit': total_sales - total_purchases,
+        'prev_total_sales': prev_total_sales,
+        'prev_total_purchases': prev_total_purchases,
+        'sales_change': _percent_change(total_sales, prev_total_sales),
+        'purchases_change': _percent_change(total_purchases, prev_total_purchases),
+    }
+
+
+def top_sold(days, limit=10):
+    """Best selling items of the last `days` days by units: [{'stock__name', 'total_sold', 'revenue'}]"""
+    return list(DailyStockMovement.objects.filter(
+        date__gte=_first_day(days),
+        qty_sold__gt=0
+    ).values('stock__name').annotate(
+        total_sold=Sum('qty_sold'),
+        revenue=Sum('revenue')
+    ).order_by('-total_sold')[:limit])
+
+
+def top_purchased(days, limit=10):
+    """Most purchased items of the last `days` days by units: [{'stock__name', 'total_purchased', 'cost'}]"""
+    return list(DailyStockMovement.objects.filter(
+        date__gte=_first_day(days),
+        qty_purchased__gt=0
+    ).values('stock__name').annotate(
+        total_purchased=Sum('qty_purchased'),
+        cost=Sum('cost')
+    ).order_by('-total_purchased')[:limit])
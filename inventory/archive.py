@@ -0,0 +1,119 @@
+"""
+StockHistory archival.
+
+StockHistory gets a row on every stock change and is never pruned, so its
+indexes grow without bound and every insert pays for them. archive_history()
+moves rows older than the hot horizon (STOCK_HISTORY_HOT_MONTHS whole months)
+into ArchivedStockHistory, tagged with their month, and adds them to the
+per-month StockHistoryRollup counts. Readers that need the full trail go
+through history_page() or history_rows(), which read both tables.
+"""
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import StockHistory, ArchivedStockHistory, StockHistoryRollup
+from .pagination import paginate_keyset_merged
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Whole months of history kept in the live table, besides the current one
+HOT_MONTHS = getattr(settings, 'STOCK_HISTORY_HOT_MONTHS', 6)
+
+ARCHIVE_BATCH_SIZE = 1000
+
+ARCHIVED_FIELDS = (
+    'id', 'stock_id', 'previous_quantity', 'new_quantity',
+    'previous_name', 'new_name', 'previous_price', 'new_price',
+    'change_type', 'changed_by', 'changed_at', 'reason',
+)
+
+
+def month_start(moment):
+    """First day of the (local) month `moment` falls in"""
+    return timezone.localtime(moment).date().replace(day=1)
+
+
+def archive_cutoff(months=None):
+    """Start of the oldest month kept live: rows changed before it get archived"""
+    months = HOT_MONTHS if months is None else months
+    first = timezone.localdate().replace(day=1)
+    year, month = divmod(first.year * 12 + first.month - 1 - months, 12)
+    return timezone.make_aware(datetime.datetime(year, month + 1, 1))
+
+
+def _rollup(rows):
+    """Add archived rows to the per-month rollup"""
+    totals = {}
+    for row in rows:
+        key = (row.stock_id, row.month, row.change_type)
+        entries, quantity_change = totals.get(key, (0, 0))
+        if row.previous_quantity is not None and row.new_quantity is not None:
+            quantity_change += row.new_quantity - row.previous_quantity
+        totals[key] = (entries + 1, quantity_change)
+
+    for (stock_id, month, change_type), (entries, quantity_change) in totals.items():
+        rollup, created = StockHistoryRollup.objects.get_or_create(
+            stock_id=stock_id, month=month, change_type=change_type,
+            defaults={'entries': entries, 'quantity_change': quantity_change}
+        )
+        if not created:
+            StockHistoryRollup.objects.filter(pk=rollup.pk).update(
+                entries=F('entries') + entries,
+                quantity_change=F('quantity_change') + quantity_change
+            )
+
+
+def archive_history(before=None):
+    """
+    Move history rows changed before `before` (default: archive_cutoff()) to
+    the archive, one batch per transaction. Returns the number of rows moved.
+    """
+    before = archive_cutoff() if before is None else before
+    moved = 0
+    while True:
+        with transaction.atomic():
+            rows = list(StockHistory.objects.filter(
+                changed_at__lt=before
+            ).order_by('changed_at', 'id').values(*ARCHIVED_FIELDS)[:ARCHIVE_BATCH_SIZE])
+            if not rows:
+                break
+            archived = [
+                ArchivedStockHistory(month=month_start(row['changed_at']), **row)
+                for row in rows
+            ]
+            ArchivedStockHistory.objects.bulk_create(archived)
+            _rollup(archived)
+            StockHistory.objects.filter(pk__in=[row['id'] for row in rows]).delete()
+        moved += len(rows)
+    if moved:
+        logger.info(f"Archived {moved} stock history row(s) changed before {before}")
+    return moved
+
+
+def history_page(stock, cursor=None, per_page=50):
+    """
+    One KeysetPage of a stock item's history, newest first, live and archived
+    rows together. The archive is only queried once the live rows run out.
+    """
+    return paginate_keyset_merged(
+        [StockHistory.objects.filter(stock=stock), ArchivedStockHistory.objects.filter(stock=stock)],
+        cursor=cursor,
+        per_page=per_page,
+        time_field='changed_at'
+    )
+
+
+def history_querysets():
+    """The live and archived history tables (newest first), each with its stock item joined in"""
+    return [StockHistory.objects.select_related('stock'), ArchivedStockHistory.objects.select_related('stock')]
+
+
+def history_rows(fields, ordering, *args, **filters):
+    """values(*fields) of the live and archived history rows matching the filters, in one ordering"""
+    live = StockHistory.objects.filter(*args, **filters).order_by().values(*fields)
+    archived = ArchivedStockHistory.objects.filter(*args, **filters).order_by().values(*fields)
+    return live.union(archived, all=True).order_by(*ordering)
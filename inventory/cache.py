@@ -0,0 +1,85 @@
+"""
+Cached read models with generation-based invalidation and single-flight fills.
+
+Cached entries of a namespace are keyed by the namespace's current generation,
+so invalidating bumps one counter instead of finding every key (e.g. every
+`days` window of the dashboard). On a miss, the request that wins an atomic
+`cache.add` lock recomputes the value while concurrent requests for the same
+key wait for it instead of all hitting the database.
+
+Both only work across workers if the cache backend is shared; a local-memory
+cache would leave other processes serving stale figures after an invalidation.
+The default file cache is shared by the workers of one host. Its `add` is a
+check followed by a write, so two processes missing at the same instant can
+both compute; Redis or Memcached make the lock exact and span hosts.
+"""
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+import logging
+
+logger = logging.getLogger(__name__)
+
+DASHBOARD = 'dashboard'
+
+# Longest a fill may hold its lock before waiters compute for themselves
+LOCK_TIMEOUT = 30
+
+# How often waiters look for the value being filled
+POLL_INTERVAL = 0.05
+
+_MISSING = object()
+
+
+def _generation_key(namespace):
+    return f'{namespace}:generation'
+
+
+def generation(namespace):
+    """Current generation of a namespace"""
+    # Seeded from the clock so an evicted counter never comes back to an old value
+    return cache.get_or_set(_generation_key(namespace), time.time_ns, None)
+
+
+def invalidate(namespace):
+    """Make every cached entry of the namespace stale"""
+    try:
+        cache.incr(_generation_key(namespace))
+    except ValueError:
+        cache.set(_generation_key(namespace), time.time_ns(), None)
+
+
+def invalidate_on_commit(namespace):
+    """Invalidate the namespace once the current transaction commits"""
+    transaction.on_commit(lambda: invalidate(namespace))
+
+
+def get_or_compute(namespace, key, compute, timeout):
+    """
+    Return the cached value of `key` in the namespace's current generation,
+    computing it with `compute()` (once across concurrent callers) on a miss.
+    """
+    key = f'{namespace}:{generation(namespace)}:{key}'
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        return value
+
+    lock_key = f'{key}:lock'
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while True:
+        if cache.add(lock_key, 1, LOCK_TIMEOUT):
+            try:
+                value = compute()
+                cache.set(key, value, timeout)
+                return value
+            finally:
+                cache.delete(lock_key)
+
+        time.sleep(POLL_INTERVAL)
+        value = cache.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        if time.monotonic() >= deadline:
+            logger.warning(f"Gave up waiting for cache fill of {key}, computing it directly")
+            return compute()
@@ -0,0 +1,130 @@
+"""
+Request coalescing and admission control for expensive read-only computations.
+
+Identical requests that arrive while a computation for the same key is running
+wait for that computation and share its result instead of starting their own.
+Distinct computations are limited to `max_concurrent` at a time; a computation
+that cannot get a slot within `queue_timeout` seconds fails with ServerBusy,
+which views turn into a 503 with a Retry-After header. A request waiting on
+another's computation gives up the same way after `wait_timeout` seconds, so a
+stuck computation cannot pin every thread that asked for the same key.
+
+The in-flight markers, the slots and the shared results live in the Django
+cache, taken with `cache.add` like the fill locks in inventory/cache.py, so
+they hold across every worker using the same cache. A marker or slot left by a
+process that died expires after `lock_timeout` seconds.
+"""
+import time
+import uuid
+
+from django.core.cache import cache
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Longest a computation may hold its slot or in-flight marker
+LOCK_TIMEOUT = 120
+
+# How often waiting requests look for a slot or a shared result
+POLL_INTERVAL = 0.05
+
+
+class ServerBusy(Exception):
+    """Raised when no computation slot became free in time"""
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__(f"Too many concurrent computations, retry in {retry_after}s")
+
+    def __reduce__(self):
+        # Followers in other processes receive the leader's error through the cache
+        return (ServerBusy, (self.retry_after,))
+
+
+class RequestCoalescer:
+    """
+    Runs at most one computation per key and at most `max_concurrent` keys at
+    once, across all workers sharing the cache. `name` keeps the cache keys of
+    different coalescers apart.
+    """
+
+    def __init__(self, name, max_concurrent, queue_timeout, retry_after=None, wait_timeout=None,
+                 lock_timeout=LOCK_TIMEOUT):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.wait_timeout = queue_timeout if wait_timeout is None else wait_timeout
+        self.retry_after = retry_after or max(1, int(queue_timeout))
+        self.lock_timeout = lock_timeout
+
+    def _key(self, kind, value):
+        return f'coalesce:{self.name}:{kind}:{value}'
+
+    def run(self, key, compute):
+        """Return compute() for `key`, joining a computation already in flight for it"""
+        flight_key = self._key('flight', key)
+        token = uuid.uuid4().hex
+        while True:
+            if cache.add(flight_key, token, self.lock_timeout):
+                return self._lead(flight_key, token, compute)
+            leader = cache.get(flight_key)
+            if leader is not None:
+                return self._follow(leader)
+            # The flight finished between the two calls; try to lead the next one
+
+    def _lead(self, flight_key, token, compute):
+        """Compute within a slot and hand the outcome to the followers"""
+        try:
+            slot = self._acquire_slot(token)
+            try:
+                result = compute()
+            finally:
+                self._release(self._key('slot', slot), token)
+        except Exception as e:
+            self._share(token, (False, e))
+            raise
+        else:
+            self._share(token, (True, result))
+            return result
+        finally:
+            self._release(flight_key, token)
+
+    def _follow(self, token):
+        """Wait for the outcome of the flight `token` leads"""
+        result_key = self._key('result', token)
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            outcome = cache.get(result_key)
+            if outcome is not None:
+                succeeded, value = outcome
+                if succeeded:
+                    return value
+                raise value
+            if time.monotonic() >= deadline:
+                raise ServerBusy(self.retry_after)
+            time.sleep(POLL_INTERVAL)
+
+    def _share(self, token, outcome):
+        """Publish a flight's outcome for as long as a follower might wait on it"""
+        try:
+            cache.set(self._key('result', token), outcome, max(1, int(self.wait_timeout) + 1))
+        except Exception as e:
+            # Unpicklable result or error; followers are told to retry
+            logger.warning(f"Could not share result of {self.name} computation: {str(e)}")
+            cache.set(self._key('result', token), (False, ServerBusy(self.retry_after)), self.retry_after)
+
+    def _acquire_slot(self, token):
+        """Take one of the max_concurrent slots, or raise ServerBusy after queue_timeout"""
+        deadline = time.monotonic() + self.queue_timeout
+        while True:
+            for slot in range(self.max_concurrent):
+                if cache.add(self._key('slot', slot), token, self.lock_timeout):
+                    return slot
+            if time.monotonic() >= deadline:
+                raise ServerBusy(self.retry_after)
+            time.sleep(POLL_INTERVAL)
+
+    def _release(self, key, token):
+        """Delete a slot or in-flight marker unless it expired and was taken by someone else"""
+        if cache.get(key) == token:
+            cache.delete(key)
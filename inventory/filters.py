@@ -1,6 +1,9 @@
+import datetime
+
 import django_filters
 from django.db import models
-from .models import Stock    
+from django.utils import timezone
+from .models import Stock, StockHistory
 
 class StockFilter(django_filters.FilterSet):
     """Enhanced filter for stock items with multiple filter options"""
@@ -36,4 +39,26 @@ class StockFilter(django_filters.FilterSet):
         model = Stock
         fields = ['name', 'quantity_min', 'quantity_max', 'price_min', 'price_max', 
                   'modified_by', 'last_modified_after', 'last_modified_before', 
-                  'low_stock', 'out_of_stock']
\ No newline at end of file
+                  'low_stock', 'out_of_stock']
+
+
+class StockHistoryFilter(django_filters.FilterSet):
+    """Filters for the audit log; they apply equally to archived history"""
+    change_type = django_filters.ChoiceFilter(choices=StockHistory.CHANGE_TYPES, label='Change Type')
+    changed_by = django_filters.CharFilter(field_name='changed_by', label='Changed By')
+    stock = django_filters.NumberFilter(field_name='stock', label='Stock ID')
+    changed_after = django_filters.DateFilter(method='filter_changed_after', label='Changed On or After')
+    changed_before = django_filters.DateFilter(method='filter_changed_before', label='Changed On or Before')
+    
+    # Date bounds become changed_at ranges so the (change_type, -changed_at) index still applies
+    def filter_changed_after(self, queryset, name, value):
+        start = timezone.make_aware(datetime.datetime.combine(value, datetime.time.min))
+        return queryset.filter(changed_at__gte=start)
+    
+    def filter_changed_before(self, queryset, name, value):
+        end = timezone.make_aware(datetime.datetime.combine(value + datetime.timedelta(days=1), datetime.time.min))
+        return queryset.filter(changed_at__lt=end)
+    
+    class Meta:
+        model = StockHistory
+        fields = ['change_type', 'changed_by', 'stock', 'changed_after', 'changed_before']
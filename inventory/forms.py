@@ -27,10 +27,14 @@ class StockForm(forms.ModelForm):
 
 class StockEditDetailsForm(forms.ModelForm):
     """Form for editing only name and price (not quantity)"""
+    # Stock.version the form was rendered from, so the save can detect concurrent edits
+    version = forms.IntegerField(widget=forms.HiddenInput, required=False)
+    
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.fields['name'].widget.attrs.update({'class': 'textinput form-control'})
         self.fields['unit_price'].widget.attrs.update({'class': 'textinput form-control', 'min': '1.00'})
+        self.fields['version'].initial = self.instance.version
     
     def clean_unit_price(self):
         unit_price = self.cleaned_data.get('unit_price')
@@ -44,6 +48,9 @@ class StockEditDetailsForm(forms.ModelForm):
 
 
 class StockAdjustmentForm(forms.ModelForm):
+    # Stock.version the form was rendered from, so the save can detect concurrent edits
+    version = forms.IntegerField(widget=forms.HiddenInput, required=False)
+    
     def __init__(self, *args, **kwargs):
         self.stock = kwargs.pop('stock', None)
         super().__init__(*args, **kwargs)
@@ -53,6 +60,7 @@ class StockAdjustmentForm(forms.ModelForm):
         
         if self.stock:
             self.fields['adjusted_quantity'].label = f'New Quantity (Current: {self.stock.quantity})'
+            self.fields['version'].initial = self.stock.version
     
     def clean_adjusted_quantity(self):
         adjusted_quantity = self.cleaned_data.get('adjusted_quantity')
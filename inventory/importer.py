@@ -0,0 +1,235 @@
+"""
+Set-based CSV import of stock items.
+
+The file is read in chunks. Each chunk resolves the names it mentions with a
+single `name__in` query, creates new items with one bulk_create, applies
+quantity increments and price changes to existing items with one UPDATE, and
+writes its history rows with one bulk_create. Only counters and the first few
+messages are kept, so memory does not grow with the size of the file.
+"""
+import csv
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.db import transaction, DatabaseError
+from django.db.models import Case, When, Value, F, IntegerField, DecimalField, ExpressionWrapper
+from django.utils import timezone
+
+from .models import Stock, StockHistory
+from .search import index_stocks
+from .totals import apply_changes, stock_state
+import logging
+
+logger = logging.getLogger(__name__)
+
+# CSV rows handled per database round trip
+IMPORT_CHUNK_SIZE = 1000
+
+# Row messages kept for display
+REPORT_LIMIT = 20
+
+NAME_COLUMNS = ('Name', 'name', 'Item Name', 'item_name')
+QUANTITY_COLUMNS = ('Quantity', 'quantity', 'Qty', 'qty')
+PRICE_COLUMNS = ('Unit Price', 'unit_price', 'Price', 'price')
+
+
+class ImportResult:
+    """Counters and the first REPORT_LIMIT messages of an import run"""
+
+    def __init__(self, report_limit=REPORT_LIMIT):
+        self.report_limit = report_limit
+        self.processed_count = 0
+        self.created_count = 0
+        self.updated_count = 0
+        self.error_count = 0
+        self.errors = []
+        self.rows_processed = []
+
+    def add_error(self, message):
+        self.error_count += 1
+        if len(self.errors) < self.report_limit:
+            self.errors.append(message)
+
+    def add_processed(self, message, created):
+        self.processed_count += 1
+        if created:
+            self.created_count += 1
+        else:
+            self.updated_count += 1
+        if len(self.rows_processed) < self.report_limit:
+            self.rows_processed.append(message)
+
+
+def _first_value(row, columns):
+    for column in columns:
+        if row.get(column):
+            return row[column]
+    return None
+
+
+def import_stock_csv(file, username):
+    """Import a CSV text stream of stock items and return an ImportResult"""
+    result = ImportResult()
+    chunk = []
+    for row_num, row in enumerate(csv.DictReader(file), start=2):
+        chunk.append((row_num, row))
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            _import_chunk(chunk, username, result)
+            chunk = []
+    if chunk:
+        _import_chunk(chunk, username, result)
+    logger.info(
+        f"Stock import by {username}: {result.created_count} created, "
+        f"{result.updated_count} updated, {result.error_count} error(s)"
+    )
+    return result
+
+
+def _parse_rows(chunk, row_errors):
+    """Yield (row_num, name, quantity, unit_price) for rows with usable values"""
+    for row_num, row in chunk:
+        name = _first_value(row, NAME_COLUMNS)
+        quantity = _first_value(row, QUANTITY_COLUMNS)
+        unit_price = _first_value(row, PRICE_COLUMNS)
+
+        if not name or not quantity or not unit_price:
+            row_errors.append((row_num, f"Row {row_num}: Missing required field"))
+            continue
+        try:
+            quantity = int(quantity)
+            unit_price = Decimal(unit_price.strip())
+            # Decimal() also accepts NaN and Infinity, which no comparison can validate
+            if not unit_price.is_finite():
+                raise InvalidOperation(unit_price)
+        except (ValueError, InvalidOperation):
+            row_errors.append((row_num, f"Row {row_num}: Invalid number format"))
+            continue
+        yield row_num, name, quantity, unit_price
+
+
+def _change_reason(previous_price, new_price, previous_quantity, new_quantity):
+    """Same wording as the history signal uses for edits"""
+    changes = []
+    if previous_price != new_price:
+        changes.append(f"Price: ${previous_price} → ${new_price}")
+    if previous_quantity != new_quantity:
+        changes.append(f"Quantity: {previous_quantity} → {new_quantity}")
+    return '; '.join(changes)
+
+
+def _import_chunk(chunk, username, result):
+    row_errors = []         # (row_num, message), reported in row order
+    parsed = list(_parse_rows(chunk, row_errors))
+
+    existing = {stock.name: stock for stock in Stock.objects.filter(name__in={row[1] for row in parsed})}
+    original = {name: stock_state(stock) for name, stock in existing.items()}
+    now = timezone.now()
+    last_modification = now.strftime('%Y-%m-%d %H:%M:%S')
+
+    created = {}            # name -> new Stock, in file order
+    updated = set()         # names of existing items that changed
+    history = []
+    processed = []          # (message, created) reported once the chunk is written
+
+    for row_num, name, quantity, unit_price in parsed:
+        stock = created.get(name) or existing.get(name)
+        if stock is None:
+            stock = Stock(
+                name=name,
+                quantity=quantity,
+                unit_price=unit_price,
+                stock_value=quantity * unit_price,
+                modified_by=username,
+                last_modified=now,
+                last_modification=last_modification
+            )
+            try:
+                stock.full_clean(validate_unique=False, validate_constraints=False)
+            except (ValidationError, InvalidOperation) as e:
+                row_errors.append((row_num, f"Row {row_num}: {str(e)}"))
+                continue
+            created[name] = stock
+            history.append(StockHistory(
+                stock=stock,
+                previous_quantity=0,
+                new_quantity=quantity,
+                change_type='edit',
+                changed_by=username,
+                reason='Stock item created',
+                changed_at=now
+            ))
+            processed.append((f"Row {row_num}: Created {name}", True))
+            continue
+
+        previous_quantity, previous_price = stock.quantity, stock.unit_price
+        stock.quantity = previous_quantity + quantity
+        stock.unit_price = unit_price
+        stock.stock_value = stock.quantity * unit_price
+        try:
+            stock.full_clean(validate_unique=False, validate_constraints=False)
+        except (ValidationError, InvalidOperation) as e:
+            stock.quantity, stock.unit_price = previous_quantity, previous_price
+            stock.stock_value = previous_quantity * previous_price
+            row_errors.append((row_num, f"Row {row_num}: {str(e)}"))
+            continue
+        if name not in created:
+            updated.add(name)
+        reason = _change_reason(previous_price, stock.unit_price, previous_quantity, stock.quantity)
+        if reason:
+            history.append(StockHistory(
+                stock=stock,
+                previous_quantity=previous_quantity if previous_quantity != stock.quantity else None,
+                new_quantity=stock.quantity if previous_quantity != stock.quantity else None,
+                previous_price=previous_price if previous_price != stock.unit_price else None,
+                new_price=stock.unit_price if previous_price != stock.unit_price else None,
+                change_type='edit',
+                changed_by=username,
+                reason=reason,
+                changed_at=now
+            ))
+        processed.append((f"Row {row_num}: Updated {name}", False))
+
+    try:
+        with transaction.atomic():
+            if created:
+                Stock.objects.bulk_create(created.values())
+                index_stocks((stock.pk, stock.name) for stock in created.values())
+            if updated:
+                _apply_updates([existing[name] for name in updated], original, username, now, last_modification)
+            if history:
+                StockHistory.objects.bulk_create(history)
+            apply_changes(
+                [(None, stock_state(stock)) for stock in created.values()]
+                + [(original[name], stock_state(existing[name])) for name in updated]
+            )
+    except DatabaseError as e:
+        logger.error(f"Error importing stock rows {chunk[0][0]}-{chunk[-1][0]}: {str(e)}", exc_info=True)
+        row_errors.extend((row_num, f"Row {row_num}: {str(e)}") for row_num, _, _, _ in parsed)
+        processed = []
+
+    for row_num, message in sorted(row_errors):
+        result.add_error(message)
+    for message, was_created in processed:
+        result.add_processed(message, was_created)
+
+
+def _apply_updates(stocks, original, username, now, last_modification):
+    """One UPDATE adding each item's quantity delta and setting its new price"""
+    ids = [stock.pk for stock in stocks]
+    quantity = F('quantity') + Case(
+        *[When(pk=stock.pk, then=Value(stock.quantity - original[stock.name][0])) for stock in stocks],
+        output_field=IntegerField()
+    )
+    unit_price = Case(
+        *[When(pk=stock.pk, then=Value(stock.unit_price)) for stock in stocks],
+        output_field=DecimalField(max_digits=10, decimal_places=2)
+    )
+    Stock.objects.filter(pk__in=ids).update(
+        quantity=quantity,
+        unit_price=unit_price,
+        stock_value=ExpressionWrapper(quantity * unit_price, output_field=DecimalField(max_digits=16, decimal_places=2)),
+        version=F('version') + 1,
+        modified_by=username,
+        last_modified=now,
+        last_modification=last_modification
+    )
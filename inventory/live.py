@@ -0,0 +1,106 @@
+"""
+In-process broadcaster for live dashboard updates.
+
+Stock and bill writes publish a small event once their transaction commits.
+Each open dashboard stream holds a Subscription that keeps one pending payload
+per event name and wakes its event loop, so a burst of writes reaches a client
+as one message and an idle client costs one parked coroutine. A new payload
+replaces the pending one, or is combined with it by the publisher's merge
+function for events that carry deltas. Nothing is built or queued while no
+stream is connected.
+
+Events only reach streams served by the process that made the write; clients
+connected to other workers pick the change up with the next event they receive.
+"""
+import asyncio
+import threading
+
+from django.db import transaction
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """Pending payload per event name for one connected stream"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.pending = {}
+        self._lock = threading.Lock()
+        self._ready = asyncio.Event()
+
+    def push(self, name, data, merge=None):
+        """
+        Called from any thread. Replaces an undelivered payload of the same
+        name, or combines the two with merge(pending, data) when given.
+        """
+        with self._lock:
+            if merge is not None and name in self.pending:
+                data = merge(self.pending[name], data)
+            self.pending[name] = data
+        try:
+            self.loop.call_soon_threadsafe(self._ready.set)
+        except RuntimeError:
+            # The stream's event loop is already closed
+            pass
+
+    async def wait(self, timeout):
+        """Return the {name: data} events pushed since the last call, or None after `timeout` seconds"""
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        self._ready.clear()
+        with self._lock:
+            events, self.pending = self.pending, {}
+        return events
+
+
+class Broadcaster:
+    """Fan-out of published events to every subscription in this process"""
+
+    def __init__(self):
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        """Register a subscription bound to the running event loop"""
+        subscription = Subscription(asyncio.get_running_loop())
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def has_subscribers(self):
+        return bool(self._subscriptions)
+
+    def publish(self, name, data, merge=None):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.push(name, data, merge)
+
+
+broadcaster = Broadcaster()
+
+
+def _publish(name, build, merge):
+    try:
+        broadcaster.publish(name, build(), merge)
+    except Exception as e:
+        logger.error(f"Error publishing live '{name}' event: {str(e)}", exc_info=True)
+
+
+def publish_on_commit(name, build, merge=None):
+    """
+    Publish `build()` as event `name` once the current transaction commits
+    (immediately outside a transaction). Skipped when no stream is connected.
+    Pass `merge` for delta payloads that must add up rather than replace.
+    """
+    if not broadcaster.has_subscribers():
+        return
+    transaction.on_commit(lambda: _publish(name, build, merge))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from inventory.archive import HOT_MONTHS, archive_cutoff, archive_history
+
+
+class Command(BaseCommand):
+    help = 'Move stock history older than the hot horizon into the monthly archive; meant to run periodically'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--months', type=int, default=HOT_MONTHS,
+            help=f'Whole months of history to keep live besides the current one (default {HOT_MONTHS})'
+        )
+
+    def handle(self, *args, **options):
+        cutoff = archive_cutoff(options['months'])
+        moved = archive_history(cutoff)
+        self.stdout.write(self.style.SUCCESS(f'Archived {moved} history row(s) changed before {cutoff:%Y-%m-%d}.'))
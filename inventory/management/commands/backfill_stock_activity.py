@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from inventory.activity import backfill_activity, BACKFILL_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Recompute Stock.last_sold_at and last_purchased_at from the recorded bill items'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=BACKFILL_CHUNK_SIZE,
+                            help='Stock items updated per statement')
+
+    def handle(self, *args, **options):
+        count = backfill_activity(options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Updated sale/purchase times of {count} stock item(s).'))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from inventory.reservations import expire_reservations
+
+
+class Command(BaseCommand):
+    help = 'Delete expired stock reservations in bulk; meant to run every few minutes'
+
+    def handle(self, *args, **options):
+        deleted = expire_reservations()
+        self.stdout.write(self.style.SUCCESS(f'Expired {deleted} stock reservation(s).'))
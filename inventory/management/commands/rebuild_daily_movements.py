@@ -0,0 +1,21 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from inventory.movements import rebuild_movements
+
+
+class Command(BaseCommand):
+    help = 'Recompute the daily stock movement facts from the recorded bill items'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='Only rebuild days on or after this date (YYYY-MM-DD)')
+
+    def handle(self, *args, **options):
+        start_date = None
+        if options['since']:
+            try:
+                start_date = datetime.date.fromisoformat(options['since'])
+            except ValueError:
+                raise CommandError(f"Invalid date: {options['since']}")
+        count = rebuild_movements(start_date)
+        self.stdout.write(self.style.SUCCESS(f'Wrote {count} daily stock movement row(s).'))
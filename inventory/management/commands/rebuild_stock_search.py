@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from inventory.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the stock name search index from scratch'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = rebuild_index()
+        if count is None:
+            self.stdout.write(self.style.WARNING(
+                'This database does not support the search index; search falls back to icontains.'
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Indexed {count} stock name(s).'))
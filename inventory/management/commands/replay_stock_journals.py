@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from inventory.writebehind import replay_journals
+
+
+class Command(BaseCommand):
+    help = 'Apply write-behind journals left by processes that stopped before flushing them'
+
+    def handle(self, *args, **options):
+        replayed = replay_journals()
+        self.stdout.write(self.style.SUCCESS(f'Replayed {replayed} journaled stock change(s).'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from inventory.shared_stock import stock_table
+
+
+class Command(BaseCommand):
+    help = 'Re-read every stock row into the shared stock table, catching late commits; meant to run every minute'
+
+    def handle(self, *args, **options):
+        count = stock_table.sweep()
+        if count is None:
+            self.stdout.write('The shared stock table is off here; nothing to sweep.')
+            return
+        self.stdout.write(self.style.SUCCESS(f'Swept {count} stock row(s) into the shared table.'))
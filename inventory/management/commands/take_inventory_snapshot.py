@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from inventory.models import InventorySnapshot
+from inventory.snapshots import take_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Snapshot every stock item for point-in-time (as-of) inventory queries; meant to run daily'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Take a snapshot even if one was already taken today')
+
+    def handle(self, *args, **options):
+        today = timezone.localdate()
+        if not options['force'] and InventorySnapshot.objects.filter(taken_at__date=today).exists():
+            self.stdout.write('A snapshot was already taken today; use --force to take another.')
+            return
+        snapshot = take_snapshot()
+        self.stdout.write(self.style.SUCCESS(f'Snapshot of {snapshot.item_count} item(s) taken at {snapshot.taken_at}.'))
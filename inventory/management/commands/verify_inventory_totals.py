@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from inventory.totals import find_drift, rebuild_totals
+
+
+class Command(BaseCommand):
+    help = 'Recompute the inventory KPI counters from scratch and report any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Overwrite the stored counters when they drifted')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            drift = find_drift()
+            if not drift:
+                self.stdout.write(self.style.SUCCESS('Inventory totals are correct.'))
+                return
+            for field, (stored, actual) in drift.items():
+                self.stdout.write(self.style.WARNING(f'{field}: stored {stored}, actual {actual}'))
+            if options['fix']:
+                rebuild_totals()
+                self.stdout.write(self.style.SUCCESS('Inventory totals rebuilt.'))
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:53
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0005_stockhistory_new_name_stockhistory_new_price_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='stockhistory',
+            name='changed_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0006_stockhistory_changed_at_default'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='stock',
+            index=models.Index(fields=['is_deleted', '-last_modified', '-id'], name='inventory_s_is_dele_b14bc0_idx'),
+        ),
+    ]
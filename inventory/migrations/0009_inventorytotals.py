@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:01
+
+from django.db import migrations, models
+from django.db.models import Count, F, Q, Sum
+
+
+def build_totals(apps, schema_editor):
+    Stock = apps.get_model('inventory', 'Stock')
+    InventoryTotals = apps.get_model('inventory', 'InventoryTotals')
+    totals = Stock.objects.filter(is_deleted=False).aggregate(
+        total_value=Sum(F('quantity') * F('unit_price')),
+        total_quantity=Sum('quantity'),
+        item_count=Count('id'),
+        low_stock_count=Count('id', filter=Q(quantity__lte=10)),
+        out_of_stock_count=Count('id', filter=Q(quantity=0)),
+    )
+    totals['total_value'] = totals['total_value'] or 0
+    totals['total_quantity'] = totals['total_quantity'] or 0
+    InventoryTotals.objects.create(pk=1, **totals)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0008_stock_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventoryTotals',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_value', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('total_quantity', models.BigIntegerField(default=0)),
+                ('item_count', models.IntegerField(default=0)),
+                ('low_stock_count', models.IntegerField(default=0)),
+                ('out_of_stock_count', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Inventory Totals',
+            },
+        ),
+        migrations.RunPython(build_totals, migrations.RunPython.noop),
+    ]
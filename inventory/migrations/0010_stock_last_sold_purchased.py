@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0009_inventorytotals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stock',
+            name='last_purchased_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='stock',
+            name='last_sold_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='stock',
+            index=models.Index(fields=['is_deleted', 'last_sold_at'], name='inventory_s_is_dele_432605_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stock',
+            index=models.Index(fields=['is_deleted', 'last_purchased_at'], name='inventory_s_is_dele_9940e4_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:08
+
+from django.db import migrations, models
+from django.db.models import F
+
+BACKFILL_CHUNK_SIZE = 1000
+
+
+def backfill_stock_value(apps, schema_editor):
+    """Fill stock_value one pk range at a time, each range in its own short write"""
+    Stock = apps.get_model('inventory', 'Stock')
+    stock_ids = list(Stock.objects.using(schema_editor.connection.alias).order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(stock_ids), BACKFILL_CHUNK_SIZE):
+        chunk = stock_ids[start:start + BACKFILL_CHUNK_SIZE]
+        Stock.objects.using(schema_editor.connection.alias).filter(
+            pk__gte=chunk[0], pk__lte=chunk[-1]
+        ).update(stock_value=F('quantity') * F('unit_price'))
+
+
+class Migration(migrations.Migration):
+    # Let each backfill chunk commit on its own instead of locking the table for the whole run
+    atomic = False
+
+    dependencies = [
+        ('inventory', '0010_stock_last_sold_purchased'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stock',
+            name='stock_value',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=16),
+        ),
+        migrations.RunPython(backfill_stock_value, migrations.RunPython.noop),
+        # Built after the backfill so the index is written once
+        migrations.AddIndex(
+            model_name='stock',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['-stock_value'], name='stock_active_value_idx'),
+        ),
+    ]
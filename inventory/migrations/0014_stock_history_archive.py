@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:15
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0013_inventory_snapshots'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedStockHistory',
+            fields=[
+                ('previous_quantity', models.IntegerField(blank=True, null=True)),
+                ('new_quantity', models.IntegerField(blank=True, null=True)),
+                ('previous_name', models.CharField(blank=True, max_length=30, null=True)),
+                ('new_name', models.CharField(blank=True, max_length=30, null=True)),
+                ('previous_price', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('new_price', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('change_type', models.CharField(choices=[('purchase', 'Purchase'), ('sale', 'Sale'), ('adjustment', 'Adjustment'), ('edit', 'Edit'), ('delete', 'Delete'), ('restore', 'Restore')], max_length=20)),
+                ('changed_by', models.CharField(max_length=100)),
+                ('changed_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, editable=False)),
+                ('reason', models.TextField(blank=True)),
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('month', models.DateField(db_index=True)),
+                ('stock', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_history', to='inventory.stock')),
+            ],
+            options={
+                'verbose_name_plural': 'Archived Stock Histories',
+                'ordering': ['-changed_at'],
+                'indexes': [models.Index(fields=['stock', '-changed_at'], name='inventory_a_stock_i_5002ea_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='StockHistoryRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('change_type', models.CharField(choices=[('purchase', 'Purchase'), ('sale', 'Sale'), ('adjustment', 'Adjustment'), ('edit', 'Edit'), ('delete', 'Delete'), ('restore', 'Restore')], max_length=20)),
+                ('entries', models.PositiveIntegerField(default=0)),
+                ('quantity_change', models.IntegerField(default=0)),
+                ('stock', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='history_rollups', to='inventory.stock')),
+            ],
+            options={
+                'ordering': ['-month', 'change_type'],
+                'constraints': [models.UniqueConstraint(fields=('stock', 'month', 'change_type'), name='unique_history_rollup')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0014_stock_history_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stock',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0015_stock_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockJournalCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('journal', models.CharField(max_length=100, unique=True)),
+                ('applied_seq', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:23
+
+import django.db.models.deletion
+import inventory.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0016_stock_journal_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('token', models.CharField(default=inventory.models.new_reservation_token, editable=False, max_length=32, unique=True)),
+                ('expires_at', models.DateTimeField()),
+                ('created_by', models.CharField(blank=True, max_length=100)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('stock', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='inventory.stock')),
+            ],
+            options={
+                'ordering': ['expires_at'],
+                'indexes': [models.Index(fields=['stock', 'expires_at', 'quantity'], name='inventory_s_stock_i_f7811c_idx'), models.Index(fields=['expires_at'], name='inventory_s_expires_9d6a1b_idx')],
+            },
+        ),
+    ]
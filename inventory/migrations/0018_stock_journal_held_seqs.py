@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0017_stock_reservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stockjournalcheckpoint',
+            name='held_seqs',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:03
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def backfill_history_ids(apps, schema_editor):
+    # Best estimate for snapshots taken before the high-water id was recorded
+    InventorySnapshot = apps.get_model('inventory', 'InventorySnapshot')
+    StockHistory = apps.get_model('inventory', 'StockHistory')
+    ArchivedStockHistory = apps.get_model('inventory', 'ArchivedStockHistory')
+    for snapshot in InventorySnapshot.objects.all():
+        ids = [
+            model.objects.filter(changed_at__lte=snapshot.taken_at).aggregate(top=Max('id'))['top'] or 0
+            for model in (StockHistory, ArchivedStockHistory)
+        ]
+        InventorySnapshot.objects.filter(pk=snapshot.pk).update(history_id=max(ids))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0018_stock_journal_held_seqs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inventorysnapshot',
+            name='history_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_history_ids, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0019_inventory_snapshot_history_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RejectedStockChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('journal', models.CharField(max_length=100)),
+                ('seq', models.BigIntegerField()),
+                ('delta', models.IntegerField()),
+                ('change_type', models.CharField(choices=[('purchase', 'Purchase'), ('sale', 'Sale'), ('adjustment', 'Adjustment'), ('edit', 'Edit'), ('delete', 'Delete'), ('restore', 'Restore')], max_length=20)),
+                ('changed_by', models.CharField(max_length=100)),
+                ('reason', models.TextField(blank=True)),
+                ('attempts', models.IntegerField()),
+                ('rejected_at', models.DateTimeField(auto_now_add=True)),
+                ('stock', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='rejected_changes', to='inventory.stock')),
+            ],
+            options={
+                'ordering': ['-rejected_at'],
+                'constraints': [models.UniqueConstraint(fields=('journal', 'seq'), name='unique_rejected_stock_change')],
+            },
+        ),
+    ]
@@ -1,9 +1,25 @@
-from django.db import models
+import uuid
+from decimal import Decimal
+
+from django.db import connections, models, router, transaction
 from django.core.exceptions import ValidationError
-from django.db.models import F
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 
-class StockHistory(models.Model):
-    """Audit trail for stock changes"""
+class StockVersionConflict(ValidationError):
+    """Raised when saving a Stock whose row was changed by someone else since it was read"""
+
+    def __init__(self, stock):
+        self.stock = stock
+        super().__init__(
+            'This item was changed by someone else while you were editing it. '
+            'Reload the page to see the current values and try again.'
+        )
+
+
+class BaseStockHistory(models.Model):
+    """Fields shared by live and archived stock history rows"""
     CHANGE_TYPES = [
         ('purchase', 'Purchase'),
         ('sale', 'Sale'),
@@ -13,7 +29,6 @@ class StockHistory(models.Model):
         ('restore', 'Restore'),
     ]
     
-    stock = models.ForeignKey('Stock', on_delete=models.CASCADE, related_name='history')
     # Quantity changes
     previous_quantity = models.IntegerField(null=True, blank=True)
     new_quantity = models.IntegerField(null=True, blank=True)
@@ -25,9 +40,22 @@ class StockHistory(models.Model):
     new_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     change_type = models.CharField(max_length=20, choices=CHANGE_TYPES)
     changed_by = models.CharField(max_length=100)
-    changed_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Set when the change is logged rather than when the row is inserted, so
+    # buffered history keeps its original ordering
+    changed_at = models.DateTimeField(default=timezone.now, editable=False, db_index=True)
     reason = models.TextField(blank=True)
     
+    class Meta:
+        abstract = True
+    
+    def __str__(self):
+        return f"{self.stock.name} - {self.change_type} - {self.changed_at}"
+
+
+class StockHistory(BaseStockHistory):
+    """Audit trail for stock changes"""
+    stock = models.ForeignKey('Stock', on_delete=models.CASCADE, related_name='history')
+    
     class Meta:
         ordering = ['-changed_at']
         indexes = [
@@ -35,9 +63,40 @@ class StockHistory(models.Model):
             models.Index(fields=['change_type', '-changed_at']),
         ]
         verbose_name_plural = 'Stock Histories'
+
+
+class ArchivedStockHistory(BaseStockHistory):
+    """
+    StockHistory rows moved out of the live table once older than the hot
+    horizon (see inventory/archive.py). Rows keep their original id so paging
+    by (changed_at, id) runs across both tables.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    stock = models.ForeignKey('Stock', on_delete=models.CASCADE, related_name='archived_history')
+    # First day of the month the row belongs to; archiving and purging work month by month
+    month = models.DateField(db_index=True)
     
-    def __str__(self):
-        return f"{self.stock.name} - {self.change_type} - {self.changed_at}"
+    class Meta:
+        ordering = ['-changed_at']
+        indexes = [
+            models.Index(fields=['stock', '-changed_at']),
+        ]
+        verbose_name_plural = 'Archived Stock Histories'
+
+
+class StockHistoryRollup(models.Model):
+    """Per stock item, month and change type: how many history rows and their net quantity change"""
+    stock = models.ForeignKey('Stock', on_delete=models.CASCADE, related_name='history_rollups')
+    month = models.DateField()
+    change_type = models.CharField(max_length=20, choices=BaseStockHistory.CHANGE_TYPES)
+    entries = models.PositiveIntegerField(default=0)
+    quantity_change = models.IntegerField(default=0)
+    
+    class Meta:
+        ordering = ['-month', 'change_type']
+        constraints = [
+            models.UniqueConstraint(fields=['stock', 'month', 'change_type'], name='unique_history_rollup'),
+        ]
 
 
 class StockAdjustment(models.Model):
@@ -68,6 +127,144 @@ class StockAdjustment(models.Model):
     def __str__(self):
         return f"{self.stock.name} - {self.get_adjustment_type_display()} - {self.adjusted_at}"
 
+class InventoryTotals(models.Model):
+    """One stripe of the running inventory KPIs, updated by delta from every Stock write path; the KPIs are the sum over all rows"""
+    total_value = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    total_quantity = models.BigIntegerField(default=0)
+    item_count = models.IntegerField(default=0)
+    low_stock_count = models.IntegerField(default=0)
+    out_of_stock_count = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'Inventory Totals'
+
+    def __str__(self):
+        return f"{self.item_count} items, value {self.total_value}"
+
+class DailyStockMovement(models.Model):
+    """Units and amounts sold and purchased per stock item per day, updated by the bill item signals"""
+    stock = models.ForeignKey('Stock', on_delete=models.CASCADE, related_name='daily_movements')
+    date = models.DateField()
+    qty_sold = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    qty_purchased = models.IntegerField(default=0)
+    cost = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ['-date']
+        constraints = [
+            models.UniqueConstraint(fields=['stock', 'date'], name='unique_stock_movement_per_day'),
+        ]
+        indexes = [
+            models.Index(fields=['date', 'stock']),
+        ]
+
+    def __str__(self):
+        return f"{self.stock.name} - {self.date}"
+
+def new_reservation_token():
+    return uuid.uuid4().hex
+
+
+class StockReservation(models.Model):
+    """A short-lived hold on stock for an in-progress sale; it stops counting once expires_at passes"""
+    stock = models.ForeignKey('Stock', on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    token = models.CharField(max_length=32, unique=True, default=new_reservation_token, editable=False)
+    expires_at = models.DateTimeField()
+    created_by = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['expires_at']
+        indexes = [
+            # Active holds per item are summed from this index alone
+            models.Index(fields=['stock', 'expires_at', 'quantity']),
+            # The sweeper deletes expired holds oldest first
+            models.Index(fields=['expires_at']),
+        ]
+    
+    def __str__(self):
+        return f"{self.quantity} x {self.stock_id} until {self.expires_at}"
+
+
+def held_units(now):
+    """Units of the outer Stock row held by reservations still active at `now`, as an expression"""
+    return Coalesce(Subquery(
+        StockReservation.objects.filter(
+            stock=OuterRef('pk'), expires_at__gt=now
+        ).order_by().values('stock').annotate(held=Sum('quantity')).values('held')[:1]
+    ), 0, output_field=models.IntegerField())
+
+
+class StockJournalCheckpoint(models.Model):
+    """Last write-behind journal record applied to Stock, written in the same transaction as the deltas"""
+    journal = models.CharField(max_length=100, unique=True)
+    applied_seq = models.BigIntegerField(default=0)
+    # Records up to applied_seq that could not be applied yet and are still due
+    held_seqs = models.JSONField(default=list, blank=True)
+    
+    def __str__(self):
+        return f"{self.journal} @ {self.applied_seq}"
+
+
+class RejectedStockChange(models.Model):
+    """
+    A write-behind change that still could not be applied after
+    STOCK_WRITE_BEHIND_MAX_ATTEMPTS flushes, kept for someone to re-enter by hand
+    """
+    journal = models.CharField(max_length=100)
+    seq = models.BigIntegerField()
+    # The item may since have been removed; the change is kept either way
+    stock = models.ForeignKey('Stock', on_delete=models.DO_NOTHING, db_constraint=False, related_name='rejected_changes')
+    delta = models.IntegerField()
+    change_type = models.CharField(max_length=20, choices=BaseStockHistory.CHANGE_TYPES)
+    changed_by = models.CharField(max_length=100)
+    reason = models.TextField(blank=True)
+    attempts = models.IntegerField()
+    rejected_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-rejected_at']
+        constraints = [
+            models.UniqueConstraint(fields=['journal', 'seq'], name='unique_rejected_stock_change'),
+        ]
+
+    def __str__(self):
+        return f"{self.delta:+d} on stock #{self.stock_id} ({self.journal} @ {self.seq})"
+
+
+class InventorySnapshot(models.Model):
+    """A point-in-time copy of every stock item, taken by take_inventory_snapshot"""
+    taken_at = models.DateTimeField(unique=True)
+    item_count = models.IntegerField(default=0)
+    # Highest StockHistory id whose change the copied items include
+    history_id = models.BigIntegerField(default=0)
+
+    class Meta:
+        ordering = ['-taken_at']
+
+    def __str__(self):
+        return f"Snapshot {self.taken_at} ({self.item_count} items)"
+
+class StockSnapshotItem(models.Model):
+    """One stock item as it was when its snapshot was taken"""
+    snapshot = models.ForeignKey(InventorySnapshot, on_delete=models.CASCADE, related_name='items')
+    stock = models.ForeignKey('Stock', on_delete=models.CASCADE, related_name='snapshot_items')
+    name = models.CharField(max_length=30)
+    quantity = models.IntegerField()
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2)
+    is_deleted = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['snapshot', 'stock'], name='unique_stock_per_snapshot'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} @ {self.snapshot.taken_at}"
+
 class Stock(models.Model):
     id = models.AutoField(primary_key=True)
     name = models.CharField(max_length=30, unique=True, db_index=True)
@@ -77,11 +274,34 @@ class Stock(models.Model):
     last_modification = models.CharField(max_length=30, default='')
     modified_by = models.CharField(max_length=30, null=True, blank=True)
     is_deleted = models.BooleanField(default=False, db_index=True)
+    # Time of the latest sale/purchase bill that included this item, kept by the bill item signals
+    last_sold_at = models.DateTimeField(null=True, blank=True, editable=False)
+    last_purchased_at = models.DateTimeField(null=True, blank=True, editable=False)
+    # quantity * unit_price, stored so value-ranked queries can walk an index;
+    # kept by save() and by every bulk write path
+    stock_value = models.DecimalField(max_digits=16, decimal_places=2, default=0, editable=False)
+    # Bumped by every write; save() only updates the row at the version it was read with
+    version = models.PositiveIntegerField(default=0, editable=False)
+
+    # Fields diffed against the loaded snapshot by the history signals
+    TRACKED_FIELDS = ('name', 'quantity', 'unit_price', 'is_deleted')
+
+    # Written only by the bill item signals' own UPDATEs; save() leaves them
+    # out so an instance read before a sale cannot write the old time back
+    ACTIVITY_FIELDS = ('last_sold_at', 'last_purchased_at')
 
     class Meta:
         indexes = [
             models.Index(fields=['quantity', 'is_deleted']),
             models.Index(fields=['last_modified']),
+            # Keyset pagination of the active list walks this index
+            models.Index(fields=['is_deleted', '-last_modified', '-id']),
+            # "Not sold/purchased since" queries range-scan these
+            models.Index(fields=['is_deleted', 'last_sold_at']),
+            models.Index(fields=['is_deleted', 'last_purchased_at']),
+            # Top-N by value walks this index; partial because Django renders is_deleted=False
+            # as NOT is_deleted, which SQLite cannot match against an (is_deleted, ...) prefix
+            models.Index(fields=['-stock_value'], condition=models.Q(is_deleted=False), name='stock_active_value_idx'),
         ]
 
     def clean(self):
@@ -92,12 +312,69 @@ class Stock(models.Model):
             raise ValidationError({'unit_price': 'Unit price must be greater than zero.'})
     
     def save(self, *args, **kwargs):
-        """Override save to run validation and auto-populate last_modification"""
+        """Override save to run validation and auto-populate last_modification and stock_value"""
         # Auto-populate last_modification with current date/time whenever stock is saved
         from django.utils import timezone
         self.last_modification = timezone.now().strftime('%Y-%m-%d %H:%M:%S')
         self.full_clean()
+        self.stock_value = self.quantity * self.unit_price
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None and not self._state.adding and not kwargs.get('force_insert'):
+            update_fields = {
+                field.name for field in self._meta.concrete_fields if not field.primary_key
+            } - self.get_deferred_fields() - set(self.ACTIVITY_FIELDS)
+        if update_fields is not None:
+            update_fields = {*update_fields, 'version'}
+            if {'quantity', 'unit_price'} & update_fields:
+                update_fields.add('stock_value')
+            kwargs['update_fields'] = update_fields
         super().save(*args, **kwargs)
+        self._take_snapshot()
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        """
+        UPDATE ... WHERE id = ? AND version = ?, writing the next version, so a
+        save based on a stale read fails instead of overwriting the newer row.
+        Raises StockVersionConflict in that case.
+        """
+        expected = self.version
+        values = [
+            (field, model, expected + 1 if field.name == 'version' else value)
+            for field, model, value in values
+        ]
+        updated = super()._do_update(
+            base_qs.filter(version=expected), using, pk_val, values, update_fields, forced_update
+        )
+        if updated:
+            self.version = expected + 1
+        elif base_qs.filter(pk=pk_val).exists():
+            raise StockVersionConflict(self)
+        return updated
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Remember the tracked values as loaded so change tracking needs no extra SELECT"""
+        instance = super().from_db(db, field_names, values)
+        instance._take_snapshot()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        """Reload from the database and move the snapshot along with the reloaded fields"""
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        snapshot = getattr(self, '_loaded_values', None)
+        if fields is None or snapshot is None:
+            self._take_snapshot()
+        else:
+            for field in fields:
+                if field in snapshot:
+                    snapshot[field] = self.__dict__[field]
+
+    def _take_snapshot(self):
+        """Store the current tracked values, or None when some of them are deferred"""
+        if all(field in self.__dict__ for field in self.TRACKED_FIELDS):
+            self._loaded_values = {field: self.__dict__[field] for field in self.TRACKED_FIELDS}
+        else:
+            self._loaded_values = None
 
     def check_stock_availability(self, requested_quantity):
         """Check if requested quantity is available"""
@@ -107,17 +384,123 @@ class Stock(models.Model):
             return False, f"Insufficient stock. Available: {self.quantity}, Requested: {requested_quantity}"
         return True, "Stock available"
 
-    def reserve_stock(self, quantity):
-        """Reserve stock (decrease quantity)"""
-        if not self.check_stock_availability(quantity)[0]:
+    def reserve_stock(self, quantity, changed_by='System', reason='Stock reserved', change_type='sale'):
+        """Reserve stock (decrease quantity) atomically, leaving units held by reservations, and return the new quantity"""
+        if quantity <= 0:
+            raise ValidationError("Cannot reserve stock: quantity must be positive")
+        new_quantity = self._apply_quantity_delta(-quantity, change_type, changed_by, reason)
+        if new_quantity is None:
             raise ValidationError("Cannot reserve stock: insufficient quantity")
-        self.quantity -= quantity
-        self.save()
+        return new_quantity
+
+    def release_stock(self, quantity, changed_by='System', reason='Stock released', change_type='adjustment'):
+        """Release stock (increase quantity) atomically and return the new quantity"""
+        if quantity <= 0:
+            raise ValidationError("Cannot release stock: quantity must be positive")
+        new_quantity = self._apply_quantity_delta(quantity, change_type, changed_by, reason)
+        if new_quantity is None:
+            raise ValidationError("Cannot release stock: stock item is deleted")
+        return new_quantity
+
+    def _apply_quantity_delta(self, delta, change_type, changed_by, reason, history=None, respect_holds=True):
+        """
+        Add delta to the quantity with a single conditional UPDATE that only matches
+        the row while it is not deleted and the quantity stays non-negative, so
+        concurrent callers can never oversell. With respect_holds, a decrease must
+        also leave the units held by active StockReservations. Returns the new
+        quantity, or None when the row did not match.
+
+        `history` lists the (delta, change_type, changed_by, reason) parts the
+        delta is made of, logged as one history row each in order; by default
+        the whole delta is one row.
+        """
+        # Both import this module
+        from .signals import log_stock_transaction
+        from .totals import apply_changes
+
+        using = self._state.db or router.db_for_write(Stock, instance=self)
+        connection = connections[using]
+        now = timezone.now()
+        last_modification = now.strftime('%Y-%m-%d %H:%M:%S')
+        keep_held = respect_holds and delta < 0
+        # No savepoint of its own: a failure here fails the caller's transaction
+        # anyway, and history buffered by the caller stays in its buffer
+        with transaction.atomic(using=using, savepoint=False):
+            if connection.vendor in ('postgresql', 'sqlite') and connection.features.can_return_columns_from_insert:
+                qn = connection.ops.quote_name
+
+                def column(model, name):
+                    return qn(model._meta.get_field(name).column)
+
+                quantity_column = column(Stock, 'quantity')
+                held_sql, held_params = '0', []
+                if keep_held:
+                    held_sql = (
+                        f"COALESCE((SELECT SUM({column(StockReservation, 'quantity')}) "
+                        f"FROM {qn(StockReservation._meta.db_table)} "
+                        f"WHERE {column(StockReservation, 'stock')} = %s "
+                        f"AND {column(StockReservation, 'expires_at')} > %s), 0)"
+                    )
+                    held_params = [self.pk, connection.ops.adapt_datetimefield_value(now)]
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f"UPDATE {qn(Stock._meta.db_table)} "
+                        f"SET {quantity_column} = {quantity_column} + %s, "
+                        f"{column(Stock, 'stock_value')} = ({quantity_column} + %s) * {column(Stock, 'unit_price')}, "
+                        f"{column(Stock, 'version')} = {column(Stock, 'version')} + 1, "
+                        f"{column(Stock, 'last_modified')} = %s, {column(Stock, 'last_modification')} = %s "
+                        f"WHERE {qn(Stock._meta.pk.column)} = %s AND {column(Stock, 'is_deleted')} = %s "
+                        f"AND {quantity_column} + %s >= {held_sql} "
+                        f"RETURNING {quantity_column}, {column(Stock, 'unit_price')}, {column(Stock, 'version')}",
+                        [delta, delta, connection.ops.adapt_datetimefield_value(now), last_modification, self.pk, False, delta,
+                         *held_params],
+                    )
+                    row = cursor.fetchone()
+                new_quantity, unit_price, version = row if row else (None, None, None)
+            else:
+                # No UPDATE ... RETURNING on this backend; the row stays locked by the
+                # UPDATE, so reading it back in the same transaction is still exact
+                updated = Stock.objects.using(using).filter(
+                    pk=self.pk, is_deleted=False, quantity__gte=-delta + (held_units(now) if keep_held else 0)
+                ).update(
+                    quantity=F('quantity') + delta,
+                    stock_value=(F('quantity') + delta) * F('unit_price'),
+                    version=F('version') + 1,
+                    last_modified=now,
+                    last_modification=last_modification
+                )
+                row = Stock.objects.using(using).filter(pk=self.pk).values_list(
+                    'quantity', 'unit_price', 'version'
+                ).first() if updated else None
+                new_quantity, unit_price, version = row if row else (None, None, None)
+
+            if new_quantity is None:
+                return None
+            apply_changes([((new_quantity - delta, unit_price, False), (new_quantity, unit_price, False))])
+            quantity = new_quantity - delta
+            for part_delta, part_type, part_by, part_reason in history or [(delta, change_type, changed_by, reason)]:
+                log_stock_transaction(
+                    stock=self,
+                    previous_quantity=quantity,
+                    new_quantity=quantity + part_delta,
+                    change_type=part_type,
+                    changed_by=part_by,
+                    reason=part_reason
+                )
+                quantity += part_delta
 
-    def release_stock(self, quantity):
-        """Release stock (increase quantity)"""
-        self.quantity += quantity
-        self.save()
+        # Keep the in-memory instance and its snapshot in line with the row
+        self.quantity = new_quantity
+        self.stock_value = new_quantity * Decimal(str(unit_price))
+        self.last_modified = now
+        self.last_modification = last_modification
+        # Only take the new version if this was the sole write since the instance
+        # was read; otherwise its other fields are stale and a save should conflict
+        if version == self.version + 1:
+            self.version = version
+        if getattr(self, '_loaded_values', None) is not None:
+            self._loaded_values['quantity'] = new_quantity
+        return new_quantity
 
     def __str__(self):
         return self.name
\ No newline at end of file
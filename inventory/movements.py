@@ -0,0 +1,179 @@
+"""
+Per-day sales and purchase facts.
+
+DailyStockMovement holds, for each stock item and day, the units and amounts
+sold and purchased that day. The bill item signals apply every item save or
+delete to it as a delta, and moving a bill to another day moves its items'
+totals, so reports read days x items rows instead of every bill item.
+"""
+import heapq
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models import F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from .models import DailyStockMovement
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Bill item model -> (quantity field, amount field) it feeds
+MOVEMENT_FIELDS = {
+    'transactions.SaleItem': ('qty_sold', 'revenue'),
+    'transactions.PurchaseItem': ('qty_purchased', 'cost'),
+}
+
+# Bill model -> its item model
+BILL_ITEMS = {
+    'transactions.SaleBill': 'transactions.SaleItem',
+    'transactions.PurchaseBill': 'transactions.PurchaseItem',
+}
+
+REBUILD_BATCH_SIZE = 1000
+
+# Item fields its contribution is computed from, remembered when it is loaded
+ITEM_FIELDS = ('stock_id', 'billno_id', 'quantity', 'totalprice')
+
+
+def _add(stock_id, day, item_label, quantity, amount):
+    """Add quantity/amount to the (stock, day) row of the item's kind, creating the row if needed"""
+    if not quantity and not amount:
+        return
+    quantity_field, amount_field = MOVEMENT_FIELDS[item_label]
+    row, created = DailyStockMovement.objects.get_or_create(
+        stock_id=stock_id, date=day,
+        defaults={quantity_field: quantity, amount_field: amount}
+    )
+    if not created:
+        DailyStockMovement.objects.filter(pk=row.pk).update(**{
+            quantity_field: F(quantity_field) + quantity,
+            amount_field: F(amount_field) + amount,
+        })
+        if quantity < 0 or amount < 0:
+            # Drop rows that no longer record anything, as a rebuild would
+            DailyStockMovement.objects.filter(pk=row.pk, qty_sold=0, revenue=0, qty_purchased=0, cost=0).delete()
+
+
+def item_state(item):
+    """The (stock_id, day, quantity, totalprice) an item contributes, or None if its bill is gone"""
+    bill_model = item._meta.get_field('billno').related_model
+    bill_time = bill_model.objects.filter(pk=item.billno_id).values_list('time', flat=True).first()
+    if bill_time is None:
+        return None
+    return (item.stock_id, timezone.localdate(bill_time), item.quantity, item.totalprice)
+
+
+def stored_item_state(item):
+    """item_state of the item as currently stored, or None for a new item"""
+    if item.pk is None:
+        return None
+    row = type(item).objects.filter(pk=item.pk).values_list(
+        'stock_id', 'billno__time', 'quantity', 'totalprice'
+    ).first()
+    if row is None or row[1] is None:
+        return None
+    stock_id, bill_time, quantity, totalprice = row
+    return (stock_id, timezone.localdate(bill_time), quantity, totalprice)
+
+
+def item_snapshot(item):
+    """The ITEM_FIELDS values of an item, or None when some are deferred"""
+    values = item.__dict__
+    if all(name in values for name in ITEM_FIELDS):
+        return tuple(values[name] for name in ITEM_FIELDS)
+    return None
+
+
+def snapshot_item_state(item, snapshot, after):
+    """
+    item_state of an item as it was loaded, from its item_snapshot. `after` is
+    its state now; while the item stays on the same bill its day is reused, so
+    only moving an item to another bill costs a query.
+    """
+    stock_id, billno_id, quantity, totalprice = snapshot
+    if billno_id == item.billno_id and after is not None:
+        day = after[1]
+    else:
+        bill_model = item._meta.get_field('billno').related_model
+        bill_time = bill_model.objects.filter(pk=billno_id).values_list('time', flat=True).first()
+        if bill_time is None:
+            return None
+        day = timezone.localdate(bill_time)
+    return (stock_id, day, quantity, totalprice)
+
+
+def apply_item_change(item_label, before, after):
+    """Replace an item's `before` contribution with its `after` one (either may be None)"""
+    with transaction.atomic():
+        if before is not None:
+            stock_id, day, quantity, amount = before
+            _add(stock_id, day, item_label, -quantity, -amount)
+        if after is not None:
+            stock_id, day, quantity, amount = after
+            _add(stock_id, day, item_label, quantity, amount)
+
+
+def move_bill(bill_label, bill_pk, old_day, new_day):
+    """Move the totals of a bill's items from one day to another; returns the amount moved"""
+    item_label = BILL_ITEMS[bill_label]
+    item_model = apps.get_model(item_label)
+    rows = item_model.objects.filter(billno_id=bill_pk).order_by().values('stock_id').annotate(
+        quantity=Sum('quantity'), amount=Sum('totalprice')
+    )
+    with transaction.atomic():
+        for row in rows:
+            _add(row['stock_id'], old_day, item_label, -row['quantity'], -row['amount'])
+            _add(row['stock_id'], new_day, item_label, row['quantity'], row['amount'])
+    return sum(row['amount'] for row in rows)
+
+
+def _grouped_items(item_label, start_date):
+    """(stock_id, day, item_label, quantity, amount) per stock and day of one item kind, in (stock, day) order"""
+    items = apps.get_model(item_label).objects.all()
+    if start_date is not None:
+        items = items.filter(billno__time__date__gte=start_date)
+    grouped = items.annotate(day=TruncDate('billno__time')).values('stock_id', 'day').annotate(
+        quantity=Sum('quantity'), amount=Sum('totalprice')
+    ).order_by('stock_id', 'day')
+    for row in grouped.iterator(chunk_size=REBUILD_BATCH_SIZE):
+        yield row['stock_id'], row['day'], item_label, row['quantity'], row['amount']
+
+
+def rebuild_movements(start_date=None):
+    """
+    Recompute the fact table from the bill items, from `start_date` on (or
+    entirely). Returns the number of rows written.
+
+    The sale and purchase aggregates are read as two streams sorted by (stock,
+    day) and merged, and rows are inserted a batch at a time, so memory stays
+    at one batch whatever the size of the bill history.
+    """
+    streams = [_grouped_items(item_label, start_date) for item_label in MOVEMENT_FIELDS]
+    written = 0
+    batch = []
+    movement = None
+    with transaction.atomic():
+        existing = DailyStockMovement.objects.all()
+        if start_date is not None:
+            existing = existing.filter(date__gte=start_date)
+        existing.delete()
+
+        for stock_id, day, item_label, quantity, amount in heapq.merge(*streams, key=lambda row: row[:2]):
+            if movement is None or (movement.stock_id, movement.date) != (stock_id, day):
+                if movement is not None:
+                    batch.append(movement)
+                movement = DailyStockMovement(stock_id=stock_id, date=day)
+                if len(batch) >= REBUILD_BATCH_SIZE:
+                    DailyStockMovement.objects.bulk_create(batch)
+                    written += len(batch)
+                    batch = []
+            quantity_field, amount_field = MOVEMENT_FIELDS[item_label]
+            setattr(movement, quantity_field, quantity)
+            setattr(movement, amount_field, amount)
+        if movement is not None:
+            batch.append(movement)
+        DailyStockMovement.objects.bulk_create(batch)
+        written += len(batch)
+    logger.info(f"Rebuilt {written} daily stock movement row(s)")
+    return written
@@ -0,0 +1,140 @@
+"""
+Keyset (cursor) pagination for querysets ordered newest first by a timestamp and id.
+
+Each page is fetched with a range condition on the ordering key instead of an
+OFFSET, so deep pages cost the same as the first one and no COUNT(*) is needed.
+"""
+import base64
+import datetime
+import json
+
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    """Raised when a cursor token cannot be decoded"""
+
+
+def encode_cursor(timestamp, pk, direction):
+    """Build an opaque URL-safe token pointing before ('prev') or after ('next') a row"""
+    payload = json.dumps([timestamp.isoformat(), pk, direction])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Return (timestamp, pk, direction) from a token built by encode_cursor"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        timestamp, pk, direction = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if direction not in ('next', 'prev'):
+            raise ValueError(direction)
+        return datetime.datetime.fromisoformat(timestamp), int(pk), direction
+    except (ValueError, TypeError, UnicodeDecodeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {token}") from e
+
+
+class KeysetPage:
+    """One page of results with the cursors needed to move to its neighbours"""
+
+    def __init__(self, object_list, has_next, has_previous, time_field, count=None):
+        self.object_list = object_list
+        self.has_next_page = has_next
+        self.has_previous_page = has_previous
+        self.time_field = time_field
+        self.count = count
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.has_next_page
+
+    def has_previous(self):
+        return self.has_previous_page
+
+    def has_other_pages(self):
+        return self.has_next_page or self.has_previous_page
+
+    def _cursor(self, obj, direction):
+        return encode_cursor(getattr(obj, self.time_field), obj.pk, direction)
+
+    @property
+    def next_cursor(self):
+        if self.has_next_page and self.object_list:
+            return self._cursor(self.object_list[-1], 'next')
+        return None
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous_page and self.object_list:
+            return self._cursor(self.object_list[0], 'prev')
+        return None
+
+
+def paginate_keyset(queryset, cursor=None, per_page=10, time_field='last_modified', with_count=False):
+    """
+    Return a KeysetPage of `queryset` ordered by (-time_field, -pk), starting
+    after/before the row the cursor points at. The total count is only computed
+    when `with_count` is set.
+    """
+    count = queryset.count() if with_count else None
+    if not cursor:
+        rows = list(queryset.order_by(f'-{time_field}', '-pk')[:per_page + 1])
+        return KeysetPage(rows[:per_page], len(rows) > per_page, False, time_field, count)
+
+    timestamp, pk, direction = decode_cursor(cursor)
+    rows = list(_keyset_slice(queryset, timestamp, pk, direction, time_field)[:per_page + 1])
+    return _keyset_page(rows, direction, per_page, time_field, count)
+
+
+def paginate_keyset_merged(querysets, cursor=None, per_page=10, time_field='last_modified'):
+    """
+    paginate_keyset over several querysets read as one, e.g. a table and its
+    archive. Their primary keys must not overlap, and they are given newest
+    first with time ranges that do not overlap (everything in the archive is
+    older than the live table). A queryset is only read when the ones nearer
+    the cursor did not fill the page, so paging through recent rows never
+    touches the archive, and none is read for more than one page.
+    """
+    if cursor:
+        timestamp, pk, direction = decode_cursor(cursor)
+    else:
+        timestamp, pk, direction = None, None, None
+    rows = []
+    # Going back towards newer rows ('prev') the newest queryset is the farthest
+    for queryset in reversed(querysets) if direction == 'prev' else querysets:
+        needed = per_page + 1 - len(rows)
+        if needed <= 0:
+            break
+        if direction is None:
+            rows.extend(queryset.order_by(f'-{time_field}', '-pk')[:needed])
+        else:
+            rows.extend(_keyset_slice(queryset, timestamp, pk, direction, time_field)[:needed])
+    rows.sort(key=lambda obj: (getattr(obj, time_field), obj.pk), reverse=direction != 'prev')
+    if direction is None:
+        return KeysetPage(rows[:per_page], len(rows) > per_page, False, time_field)
+    return _keyset_page(rows, direction, per_page, time_field)
+
+
+def _keyset_slice(queryset, timestamp, pk, direction, time_field):
+    """Rows after ('next') or before ('prev') the cursor position, nearest first"""
+    if direction == 'next':
+        return queryset.filter(
+            Q(**{f'{time_field}__lt': timestamp}) | Q(**{time_field: timestamp, 'pk__lt': pk})
+        ).order_by(f'-{time_field}', '-pk')
+    return queryset.filter(
+        Q(**{f'{time_field}__gt': timestamp}) | Q(**{time_field: timestamp, 'pk__gt': pk})
+    ).order_by(time_field, 'pk')
+
+
+def _keyset_page(rows, direction, per_page, time_field, count=None):
+    """KeysetPage from up to per_page + 1 rows fetched by _keyset_slice"""
+    if direction == 'next':
+        return KeysetPage(rows[:per_page], len(rows) > per_page, True, time_field, count)
+    has_previous = len(rows) > per_page
+    rows = rows[:per_page]
+    rows.reverse()
+    return KeysetPage(rows, True, has_previous, time_field, count)
@@ -0,0 +1,102 @@
+"""
+Stock analysis report.
+
+The report is built into plain lists and dicts so that one computation can be
+handed to every request that asked for the same window while it was running.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Sum, Count, Avg, Max, Min, F, Q
+from django.utils import timezone
+
+from .analytics import BUCKETS, sales_purchase_trend, top_sold, top_purchased
+from .coalesce import RequestCoalescer
+from .models import Stock
+
+# Report builds allowed at once across all workers; further distinct requests queue for a slot
+REPORT_MAX_CONCURRENT = getattr(settings, 'STOCK_REPORT_MAX_CONCURRENT', 2)
+
+# Seconds a request waits for a slot before being told to retry
+REPORT_QUEUE_TIMEOUT = getattr(settings, 'STOCK_REPORT_QUEUE_TIMEOUT', 10)
+
+# Seconds a request waits for an identical report already being built
+REPORT_WAIT_TIMEOUT = getattr(settings, 'STOCK_REPORT_WAIT_TIMEOUT', 30)
+
+report_coalescer = RequestCoalescer(
+    'stock_report', REPORT_MAX_CONCURRENT, REPORT_QUEUE_TIMEOUT, wait_timeout=REPORT_WAIT_TIMEOUT
+)
+
+
+def build_stock_report(days, bucket=None):
+    """Compute every section of the stock report for the last `days` days"""
+    start_date = timezone.now() - timedelta(days=days)
+
+    # Stock valuation
+    stock_analysis = Stock.objects.filter(
+        is_deleted=False
+    ).aggregate(
+        total_items=Count('id'),
+        total_quantity=Sum('quantity'),
+        total_value=Sum('stock_value'),
+        avg_price=Avg('unit_price'),
+        max_price=Max('unit_price'),
+        min_price=Min('unit_price')
+    )
+
+    # Low stock analysis, with value for display
+    low_stock = list(Stock.objects.filter(
+        is_deleted=False,
+        quantity__lte=10
+    ).annotate(
+        value=F('stock_value')
+    ).order_by('quantity'))
+
+    # Out of stock
+    out_of_stock = [item for item in low_stock if item.quantity == 0]
+
+    # Items sold and purchased in period
+    items_sold = top_sold(days)
+    items_purchased = top_purchased(days)
+
+    # Sales vs purchases trend over the period
+    trend = sales_purchase_trend(days, bucket)
+
+    # Slow moving items (not sold in last 90 days), least recently sold first
+    ninety_days_ago = timezone.now() - timedelta(days=90)
+    slow_moving = list(Stock.objects.filter(
+        Q(last_sold_at__isnull=True) | Q(last_sold_at__lt=ninety_days_ago),
+        is_deleted=False
+    ).annotate(
+        value=F('stock_value')
+    ).order_by('last_sold_at')[:10])
+
+    # High value items
+    high_value = list(Stock.objects.filter(
+        is_deleted=False
+    ).annotate(
+        value=F('stock_value')
+    ).order_by('-stock_value')[:10])
+
+    return {
+        'stock_analysis': stock_analysis,
+        'items_sold': items_sold,
+        'items_purchased': items_purchased,
+        'low_stock': low_stock,
+        'out_of_stock': out_of_stock,
+        'slow_moving': slow_moving,
+        'high_value': high_value,
+        'trend': trend,
+        'days': days,
+        'start_date': start_date,
+    }
+
+
+def get_stock_report(days, bucket=None):
+    """
+    build_stock_report, shared with identical requests already in flight and
+    subject to the concurrent build cap. Raises ServerBusy when no slot frees up.
+    """
+    if bucket not in BUCKETS:
+        bucket = None
+    return report_coalescer.run(f'{days}:{bucket or ""}', lambda: build_stock_report(days, bucket))
@@ -0,0 +1,153 @@
+"""
+Soft stock reservations.
+
+hold() places a StockReservation for a sale that is still in progress. The
+reservation leaves Stock.quantity alone and stops counting once its
+expires_at passes, so an abandoned cart needs no release. Available-to-promise
+is the quantity minus the active holds, summed from the
+(stock, expires_at, quantity) index. expire_stock_reservations deletes
+expired rows in bulk, which only keeps the table small; expired holds never
+count either way.
+
+Held units are not for sale. Stock.reserve_stock, services.reserve_many and
+write-behind reserve() refuse to take them, and the availability endpoints
+(through shared_stock.active_stocks) leave them out. The endpoints read the
+held totals from cached_holds(), a per-process copy of every active hold
+re-read at most once per STOCK_RESERVATION_MAX_AGE seconds, so they go to the
+database for holds only that often however busy they are. confirm() deletes its
+hold before taking the units, so a confirmed sale uses its own held units.
+Checkout reaches hold/confirm/release through the api/holds/ endpoints.
+
+hold() locks the item's Stock row (where the backend supports it) before it
+checks available-to-promise and inserts the reservation, so holds racing for
+the same item take turns: they can never both succeed, and the first is never
+turned away because of the second.
+"""
+import datetime
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+from .models import Stock, StockReservation
+from . import writebehind
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Seconds a hold lasts unless the caller asks otherwise
+HOLD_TTL = getattr(settings, 'STOCK_RESERVATION_TTL', 900)
+
+# Seconds the availability endpoints may lag the holds placed by other processes
+HOLDS_MAX_AGE = getattr(settings, 'STOCK_RESERVATION_MAX_AGE', 1)
+
+SWEEP_BATCH_SIZE = 1000
+
+_holds_lock = threading.Lock()
+_holds_cache = {'read_at': None, 'held': {}}
+
+
+def _held_by_stock(reservations):
+    return dict(reservations.order_by().values('stock_id').annotate(held=Sum('quantity')).values_list('stock_id', 'held'))
+
+
+def active_holds(stock_ids, now=None):
+    """{stock_id: units held by unexpired reservations}, for items with any"""
+    now = now or timezone.now()
+    return _held_by_stock(StockReservation.objects.filter(stock_id__in=stock_ids, expires_at__gt=now))
+
+
+def cached_holds():
+    """
+    {stock_id: units held} for every item with active holds, as this process
+    last read it; read again once HOLDS_MAX_AGE seconds old, or after this
+    process places or drops a hold. A hold that expired meanwhile still counts.
+    """
+    with _holds_lock:
+        read_at = _holds_cache['read_at']
+        if read_at is not None and time.monotonic() - read_at < HOLDS_MAX_AGE:
+            return _holds_cache['held']
+    held = _held_by_stock(StockReservation.objects.filter(expires_at__gt=timezone.now()))
+    with _holds_lock:
+        _holds_cache.update(read_at=time.monotonic(), held=held)
+    return held
+
+
+def clear_hold_cache():
+    """Make the next cached_holds() read the database"""
+    with _holds_lock:
+        _holds_cache['read_at'] = None
+
+
+def available_to_promise(stock_ids, now=None):
+    """{stock_id: quantity minus active holds} for the non-deleted items among stock_ids"""
+    held = active_holds(stock_ids, now)
+    return {
+        stock_id: quantity + writebehind.pending(stock_id) - held.get(stock_id, 0)
+        for stock_id, quantity in Stock.objects.filter(pk__in=stock_ids, is_deleted=False).values_list('pk', 'quantity')
+    }
+
+
+def hold(stock, quantity, ttl=None, created_by=''):
+    """Reserve `quantity` units of `stock` for `ttl` seconds and return the reservation; raises ValidationError"""
+    if quantity <= 0:
+        raise ValidationError("Cannot hold stock: quantity must be positive")
+    expires_at = timezone.now() + datetime.timedelta(seconds=HOLD_TTL if ttl is None else ttl)
+    with transaction.atomic():
+        stored = Stock.objects.select_for_update().filter(
+            pk=stock.pk, is_deleted=False
+        ).values_list('quantity', flat=True).first()
+        if stored is None:
+            raise ValidationError("Cannot hold stock: stock item is deleted")
+        available = stored + writebehind.pending(stock.pk) - active_holds([stock.pk]).get(stock.pk, 0)
+        if available < quantity:
+            raise ValidationError(f"Insufficient stock. Available: {available}, Requested: {quantity}")
+        reservation = StockReservation.objects.create(
+            stock=stock, quantity=quantity, expires_at=expires_at, created_by=created_by
+        )
+    transaction.on_commit(clear_hold_cache)
+    return reservation
+
+
+def release(token):
+    """Drop a hold (abandoned or cancelled sale); returns whether it existed"""
+    deleted, _ = StockReservation.objects.filter(token=token).delete()
+    transaction.on_commit(clear_hold_cache)
+    return deleted > 0
+
+
+def confirm(token, changed_by='System', reason='Reserved sale confirmed'):
+    """
+    Turn an unexpired hold into a sale: remove it and take its units off the
+    stock with writebehind.reserve. Returns the new quantity; raises ValidationError
+    if the hold is gone or expired.
+    """
+    with transaction.atomic():
+        reservation = StockReservation.objects.select_related('stock').filter(
+            token=token, expires_at__gt=timezone.now()
+        ).first()
+        if reservation is None:
+            raise ValidationError("Reservation not found or expired")
+        reservation.delete()
+        transaction.on_commit(clear_hold_cache)
+        return writebehind.reserve(reservation.stock, reservation.quantity, changed_by=changed_by, reason=reason)
+
+
+def expire_reservations(now=None):
+    """Delete expired holds in batches; returns the number deleted"""
+    now = now or timezone.now()
+    deleted = 0
+    while True:
+        batch = list(StockReservation.objects.filter(
+            expires_at__lte=now
+        ).order_by('expires_at').values_list('pk', flat=True)[:SWEEP_BATCH_SIZE])
+        if not batch:
+            break
+        StockReservation.objects.filter(pk__in=batch).delete()
+        deleted += len(batch)
+    if deleted:
+        logger.info(f"Expired {deleted} stock reservation(s)")
+    return deleted
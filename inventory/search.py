@@ -0,0 +1,155 @@
+"""
+Substring search index for stock names.
+
+On SQLite with FTS5 the names are mirrored into a trigram-tokenized virtual
+table keyed by stock id, which answers `name contains q` from the index instead
+of running LIKE over every row. Other databases (or SQLite builds without FTS5)
+fall back to a plain icontains query.
+"""
+from django.db import connection, DatabaseError, OperationalError
+from django.db.models import Case, When, Value, IntegerField
+from django.db.models.functions import Length
+from .models import Stock
+import logging
+
+logger = logging.getLogger(__name__)
+
+SEARCH_TABLE = 'inventory_stock_search'
+
+# Trigram matching needs at least three characters
+MIN_INDEXED_QUERY_LENGTH = 3
+
+
+# Whether the search table exists, per database alias
+_index_present = {}
+
+
+def index_available(conn=None):
+    """Whether the search table exists (it is created by migration or rebuild_stock_search)"""
+    conn = conn or connection
+    if conn.alias not in _index_present:
+        _index_present[conn.alias] = (
+            conn.vendor == 'sqlite' and SEARCH_TABLE in conn.introspection.table_names()
+        )
+    return _index_present[conn.alias]
+
+
+def _index_lost(error):
+    """
+    Forget the cached answer after a query on the search table failed, e.g.
+    because another process dropped it. Re-raises unless the table is gone.
+    """
+    _index_present.pop(connection.alias, None)
+    if index_available():
+        raise error
+    logger.warning(f"Stock search index disappeared: {str(error)}")
+
+
+def create_index(conn=None):
+    """Create the FTS5 table if the database supports it; returns True when it exists"""
+    conn = conn or connection
+    _index_present.pop(conn.alias, None)
+    if conn.vendor != 'sqlite':
+        return False
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(name, tokenize='trigram')"
+            )
+    except DatabaseError as e:
+        # SQLite built without FTS5, or older than 3.34 (no trigram tokenizer)
+        logger.warning(f"Stock search index not available: {str(e)}")
+        return False
+    return True
+
+
+def drop_index(conn=None):
+    """Drop the search table"""
+    conn = conn or connection
+    _index_present.pop(conn.alias, None)
+    if conn.vendor == 'sqlite':
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+
+
+def rebuild_index(conn=None):
+    """Refill the search table from inventory_stock; returns the number of names indexed, or None if unsupported"""
+    conn = conn or connection
+    if not create_index(conn):
+        return None
+    with conn.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE}")
+        cursor.execute(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, name) SELECT id, name FROM {Stock._meta.db_table}"
+        )
+        cursor.execute(f"SELECT COUNT(*) FROM {SEARCH_TABLE}")
+        return cursor.fetchone()[0]
+
+
+def index_stock(stock_id, name):
+    """Insert or replace the indexed name of one stock item"""
+    if not index_available():
+        return
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [stock_id])
+            cursor.execute(f"INSERT INTO {SEARCH_TABLE} (rowid, name) VALUES (%s, %s)", [stock_id, name])
+    except OperationalError as e:
+        _index_lost(e)
+
+
+def index_stocks(items):
+    """Index many (stock_id, name) pairs at once, e.g. after a bulk_create"""
+    if not index_available():
+        return
+    items = list(items)
+    try:
+        with connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [[stock_id] for stock_id, _ in items])
+            cursor.executemany(f"INSERT INTO {SEARCH_TABLE} (rowid, name) VALUES (%s, %s)", items)
+    except OperationalError as e:
+        _index_lost(e)
+
+
+def unindex_stock(stock_id):
+    """Remove one stock item from the index"""
+    if not index_available():
+        return
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [stock_id])
+    except OperationalError as e:
+        _index_lost(e)
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search_stocks(query, limit=10):
+    """
+    Return up to `limit` active stock items whose name contains `query`,
+    prefix matches first, then shorter names, then alphabetically.
+    """
+    query = query.strip()
+    if len(query) >= MIN_INDEXED_QUERY_LENGTH and index_available():
+        stock_table = Stock._meta.db_table
+        try:
+            return list(Stock.objects.raw(
+                f"SELECT s.* FROM {SEARCH_TABLE} f "
+                f"JOIN {stock_table} s ON s.id = f.rowid "
+                f"WHERE f.name MATCH %s AND s.is_deleted = %s "
+                f"ORDER BY (lower(f.name) LIKE lower(%s) ESCAPE '\\') DESC, length(f.name), f.name "
+                f"LIMIT %s",
+                ['"' + query.replace('"', '""') + '"', False, _escape_like(query) + '%', limit]
+            ))
+        except OperationalError as e:
+            _index_lost(e)
+
+    # Too short for trigrams, no index on this database, or the index was dropped
+    return list(Stock.objects.filter(
+        is_deleted=False,
+        name__icontains=query
+    ).annotate(
+        is_prefix=Case(When(name__istartswith=query, then=Value(1)), default=Value(0), output_field=IntegerField())
+    ).order_by('-is_prefix', Length('name'), 'name')[:limit])
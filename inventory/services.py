@@ -0,0 +1,223 @@
+"""
+Stock operations that work on several items at once.
+"""
+from functools import reduce
+from operator import or_
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Case, When, F, Q, Value, IntegerField
+from django.utils import timezone
+from .models import Stock, held_units
+from .reservations import active_holds
+from .signals import buffered_history, record_history
+from .totals import apply_changes
+from .writebehind import accumulator
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Read-and-UPDATE rounds reserve_many makes when rows change under it
+RESERVE_ATTEMPTS = 3
+
+
+class InsufficientStockError(ValidationError):
+    """Raised when an order cannot be reserved; `shortfalls` maps stock id to what was missing"""
+
+    def __init__(self, shortfalls):
+        self.shortfalls = shortfalls
+        super().__init__([
+            f"{line['name'] or f'Stock #{stock_id}'}: {line['message']}"
+            for stock_id, line in shortfalls.items()
+        ])
+
+
+def _normalize_lines(lines):
+    """Turn a {stock_id: qty} mapping (or (stock_id, qty) pairs) into a merged dict of ints"""
+    items = lines.items() if hasattr(lines, 'items') else lines
+    requested = {}
+    for stock_id, quantity in items:
+        stock_id, quantity = int(stock_id), int(quantity)
+        if quantity <= 0:
+            raise ValidationError(f"Stock #{stock_id}: quantity must be positive")
+        requested[stock_id] = requested.get(stock_id, 0) + quantity
+    return requested
+
+
+def _find_shortfalls(requested, rows):
+    """
+    Compare requested quantities with the loaded rows, less the units their
+    'held' reservations keep; same messages as check_stock_availability
+    """
+    shortfalls = {}
+    for stock_id, quantity in requested.items():
+        row = rows.get(stock_id)
+        if row is None:
+            shortfalls[stock_id] = {'name': None, 'requested': quantity, 'available': 0,
+                                    'message': "Stock item not found"}
+            continue
+        available = row['quantity'] - row.get('held', 0)
+        if row['is_deleted']:
+            shortfalls[stock_id] = {'name': row['name'], 'requested': quantity, 'available': 0,
+                                    'message': "Stock item is deleted"}
+        elif available < quantity:
+            shortfalls[stock_id] = {'name': row['name'], 'requested': quantity, 'available': available,
+                                    'message': f"Insufficient stock. Available: {available}, Requested: {quantity}"}
+    return shortfalls
+
+
+def _lock_rows(stock_ids):
+    """
+    The rows of stock_ids by id, locked in pk order where the backend supports
+    it, with the units held by active reservations as 'held'
+    """
+    rows = {
+        row['id']: row
+        for row in Stock.objects.select_for_update().filter(pk__in=stock_ids).order_by('pk').values(
+            'id', 'name', 'quantity', 'unit_price', 'is_deleted', 'version'
+        )
+    }
+    held = active_holds(stock_ids)
+    for stock_id, row in rows.items():
+        row['held'] = held.get(stock_id, 0)
+    return rows
+
+
+def reserve_many(lines, changed_by='System', reason='Stock reserved', change_type='sale'):
+    """
+    Reserve stock for every line of an order in one transaction, all or nothing.
+    Units held by other sales' active reservations are not available.
+
+    `lines` maps stock id to the quantity to reserve. Rows are locked in pk order
+    so concurrent orders cannot deadlock, the quantities are decremented with a
+    single guarded UPDATE (read again and retried if a row changed under it)
+    and the history rows are written in one batch.
+    Returns {stock_id: new_quantity}; raises InsufficientStockError with a
+    per-line report if any line cannot be covered.
+
+    With write-behind on, the lines are checked against the stored quantities
+    plus pending changes and left to the next flush (see writebehind.py).
+    """
+    requested = _normalize_lines(lines)
+    if not requested:
+        return {}
+    stock_ids = sorted(requested)
+
+    if accumulator.enabled():
+        def check(rows):
+            shortfalls = _find_shortfalls(requested, rows)
+            if shortfalls:
+                raise InsufficientStockError(shortfalls)
+        return accumulator.add_many(
+            {stock_id: -requested[stock_id] for stock_id in stock_ids},
+            change_type, changed_by, reason, check=check
+        )
+
+    with buffered_history():
+        for _ in range(RESERVE_ATTEMPTS):
+            rows = _lock_rows(stock_ids)
+            shortfalls = _find_shortfalls(requested, rows)
+            if shortfalls:
+                raise InsufficientStockError(shortfalls)
+
+            now = timezone.now()
+            needed = Case(
+                *[When(pk=stock_id, then=Value(requested[stock_id])) for stock_id in stock_ids],
+                output_field=IntegerField()
+            )
+            # Each row must still be at the version read, so the quantities
+            # reported and logged are exactly the ones the UPDATE started from
+            unchanged = reduce(or_, (Q(pk=stock_id, version=rows[stock_id]['version']) for stock_id in stock_ids))
+            savepoint = transaction.savepoint()
+            updated = Stock.objects.filter(
+                unchanged, is_deleted=False, quantity__gte=needed + held_units(now)
+            ).update(
+                quantity=F('quantity') - needed,
+                stock_value=(F('quantity') - needed) * F('unit_price'),
+                version=F('version') + 1,
+                last_modified=now,
+                last_modification=now.strftime('%Y-%m-%d %H:%M:%S')
+            )
+            if updated == len(stock_ids):
+                transaction.savepoint_commit(savepoint)
+                break
+            # A row changed between the read and the UPDATE, only possible on a
+            # backend without row locks: undo the lines that matched and try again
+            transaction.savepoint_rollback(savepoint)
+        else:
+            rows = _lock_rows(stock_ids)
+            raise InsufficientStockError(_find_shortfalls(requested, rows) or {
+                stock_id: {'name': row['name'], 'requested': requested[stock_id], 'available': row['quantity'],
+                           'message': "Stock changed while reserving, please try again"}
+                for stock_id, row in rows.items()
+            })
+
+        apply_changes(
+            ((row['quantity'], row['unit_price'], False),
+             (row['quantity'] - requested[stock_id], row['unit_price'], False))
+            for stock_id, row in rows.items()
+        )
+
+        new_quantities = {}
+        for stock_id in stock_ids:
+            previous_quantity = rows[stock_id]['quantity']
+            new_quantities[stock_id] = previous_quantity - requested[stock_id]
+            record_history(
+                stock_id=stock_id,
+                previous_quantity=previous_quantity,
+                new_quantity=new_quantities[stock_id],
+                change_type=change_type,
+                changed_by=changed_by,
+                reason=reason,
+                changed_at=now
+            )
+
+    logger.info(f"Reserved {len(stock_ids)} stock line(s) for {changed_by}")
+    return new_quantities
+
+
+def set_deleted(stock_ids, deleted=True, changed_by='System', reason=None):
+    """
+    Soft-delete (or restore) many stock items with one UPDATE and one bulk
+    insert of 'delete'/'restore' history rows (through the history buffer, so
+    inside an outer one they keep their place), whatever the selection size.
+    Items already in the target state are left alone. Returns the sorted ids
+    whose state actually changed.
+    """
+    stock_ids = sorted({int(stock_id) for stock_id in stock_ids})
+    if not stock_ids:
+        return []
+    change_type = 'delete' if deleted else 'restore'
+    reason = reason or f"Bulk {change_type}"
+
+    with buffered_history():
+        rows = list(
+            Stock.objects.select_for_update().filter(
+                pk__in=stock_ids, is_deleted=not deleted
+            ).order_by('pk').values_list('pk', 'quantity', 'unit_price')
+        )
+        if not rows:
+            return []
+        changed = [stock_id for stock_id, _, _ in rows]
+        now = timezone.now()
+        Stock.objects.filter(pk__in=changed).update(
+            is_deleted=deleted,
+            version=F('version') + 1,
+            modified_by=changed_by,
+            last_modified=now,
+            last_modification=now.strftime('%Y-%m-%d %H:%M:%S')
+        )
+        for stock_id in changed:
+            record_history(
+                stock_id=stock_id,
+                change_type=change_type,
+                changed_by=changed_by,
+                reason=reason,
+                changed_at=now
+            )
+        apply_changes(
+            ((quantity, unit_price, not deleted), (quantity, unit_price, deleted))
+            for _, quantity, unit_price in rows
+        )
+
+    return changed
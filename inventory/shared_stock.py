@@ -0,0 +1,342 @@
+"""
+Shared-memory stock lookup table for the read-hot endpoints.
+
+Every worker on the host maps the same file. The file has a 64-byte header
+and one fixed 24-byte slot per stock id: quantity, unit price in cents and
+flags (present, deleted). The availability and price endpoints read it
+without going to the database.
+
+The first worker to find the table older than STOCK_SNAPSHOT_MAX_AGE
+seconds refreshes it under an exclusive flock; the others wait on the lock
+and then read the refreshed table. A refresh reads only the Stock rows whose
+last_modified moved since the previous one, overlapping by
+STOCK_SNAPSHOT_OVERLAP seconds to pick up transactions that committed late.
+Only the very first refresh, or one after a repair, reads every row.
+
+last_modified is stamped before commit, so a transaction that commits later
+than the overlap (a long import) is missed by the deltas. The
+sweep_stock_snapshot command, run every minute or so, re-reads the whole
+table outside any request. It reads the rows before taking the flock, so
+lookups never wait on it, and leaves the rows changed meanwhile to the next
+delta refresh.
+
+Writers make the header sequence number odd while they change slots, and
+readers retry a lookup that ran across a change a few times before falling
+back to the database. A writer killed between its two header writes leaves
+the sequence odd; the next flock holder notices and clears the watermark,
+so the next refresh rewrites every slot and makes it even again.
+
+The table needs fcntl and a database other processes can see. Without
+them (Windows, in-memory SQLite) lookup() returns None and callers query
+the database as before.
+"""
+import datetime
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import DatabaseError, connection
+from .models import Stock
+import logging
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Seconds a lookup may lag the database; 0 turns the shared table off
+MAX_AGE = getattr(settings, 'STOCK_SNAPSHOT_MAX_AGE', 2)
+
+# Seconds of last_modified each refresh re-reads before the previous watermark
+OVERLAP = getattr(settings, 'STOCK_SNAPSHOT_OVERLAP', 30)
+
+# Tries a lookup makes while writers keep changing the table, before using the database
+READ_ATTEMPTS = 3
+
+MAGIC = b'IMSSTK01'
+# magic, sequence, capacity (slots), refreshed at, watermark, last full sweep (epoch seconds)
+HEADER = struct.Struct('<8sQQddd')
+HEADER_SIZE = 64
+# quantity, unit price in cents, flags
+SLOT = struct.Struct('<qqB7x')
+EMPTY_SLOT = SLOT.pack(0, 0, 0)
+
+PRESENT = 1
+DELETED = 2
+
+StockRow = namedtuple('StockRow', ['quantity', 'unit_price', 'is_deleted'])
+
+
+def default_path():
+    """A file in the temp directory named after the database, so test and dev databases do not share one"""
+    name = str(settings.DATABASES['default']['NAME'])
+    digest = hashlib.sha1(name.encode()).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), f'ims_stock_snapshot_{digest}.bin')
+
+
+class SharedStockTable:
+    """One process's handle on the shared table file"""
+
+    def __init__(self, path=None, max_age=MAX_AGE, overlap=OVERLAP):
+        self.path = path
+        self.max_age = max_age
+        self.overlap = overlap
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+
+    def enabled(self):
+        """Whether lookups can be served from the shared file in this process"""
+        if fcntl is None or not self.max_age:
+            return False
+        # Other processes cannot see an in-memory database
+        return not (connection.vendor == 'sqlite' and connection.is_in_memory_db())
+
+    # File handling
+
+    def _open(self):
+        """Open and map the file once per process (again after a fork)"""
+        if self._pid == os.getpid() and self._map is not None:
+            return
+        self._close()
+        fd = os.open(self.path or default_path(), os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < HEADER_SIZE:
+                os.ftruncate(fd, HEADER_SIZE)
+                os.pwrite(fd, HEADER.pack(MAGIC, 0, 0, 0.0, 0.0, 0.0), 0)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._fd = fd
+        self._pid = os.getpid()
+        self._map = mmap.mmap(fd, 0)
+
+    def _close(self):
+        if self._map is not None and self._pid == os.getpid():
+            self._map.close()
+            os.close(self._fd)
+        self._map = self._fd = self._pid = None
+
+    def _header(self):
+        magic, sequence, capacity, refreshed_at, watermark, swept_at = HEADER.unpack_from(self._map, 0)
+        return sequence, capacity, refreshed_at, watermark, swept_at
+
+    def _remap(self, capacity):
+        """Map the whole file again if another process grew it past our mapping"""
+        if len(self._map) < HEADER_SIZE + capacity * SLOT.size:
+            self._map.close()
+            self._map = mmap.mmap(self._fd, 0)
+
+    # Writing (the caller holds the flock)
+
+    def _writable_header(self):
+        """
+        The header, repaired if a writer died mid-write: its sequence is made
+        even again and the refresh time and watermark are cleared, so the next
+        refresh rewrites every slot
+        """
+        sequence, capacity, refreshed_at, watermark, swept_at = self._header()
+        if sequence % 2:
+            logger.warning("Shared stock table was left mid-write by a dead process; rebuilding it")
+            sequence += 1
+            refreshed_at = watermark = 0.0
+        return sequence, capacity, refreshed_at, watermark, swept_at
+
+    def _write(self, sequence, slots, header):
+        """
+        Write {stock_id: packed slot} with the sequence odd, then the header
+        (capacity, refreshed at, watermark, swept at) with it even again.
+        Slots already holding the same bytes are skipped, keeping the odd window short.
+        """
+        changed = []
+        for stock_id, data in slots.items():
+            offset = HEADER_SIZE + stock_id * SLOT.size
+            if self._map[offset:offset + SLOT.size] != data:
+                changed.append((offset, data))
+        HEADER.pack_into(self._map, 0, MAGIC, sequence + 1, *header)
+        for offset, data in changed:
+            self._map[offset:offset + SLOT.size] = data
+        HEADER.pack_into(self._map, 0, MAGIC, sequence + 2, *header)
+
+    @staticmethod
+    def _read_rows(since=None):
+        """(id, quantity, unit_price, is_deleted, last_modified) of every Stock row, or those modified since `since`"""
+        rows = Stock.objects.all()
+        if since is not None:
+            rows = rows.filter(last_modified__gte=datetime.datetime.fromtimestamp(since, tz=datetime.timezone.utc))
+        return list(rows.values_list('id', 'quantity', 'unit_price', 'is_deleted', 'last_modified'))
+
+    def _fill(self, rows, capacity, full):
+        """
+        Grow the file for the largest id and pack the rows into slots; a full
+        fill also clears the slots whose row is gone. Returns (capacity, slots,
+        newest last_modified timestamp or 0).
+        """
+        needed = max((row[0] for row in rows), default=-1) + 1
+        if needed > capacity:
+            capacity = max(needed, capacity * 2, 1024)
+            os.ftruncate(self._fd, HEADER_SIZE + capacity * SLOT.size)
+        self._remap(capacity)
+
+        slots = dict.fromkeys(range(capacity), EMPTY_SLOT) if full else {}
+        newest = 0.0
+        for stock_id, quantity, unit_price, is_deleted, last_modified in rows:
+            flags = PRESENT | (DELETED if is_deleted else 0)
+            slots[stock_id] = SLOT.pack(quantity, int(unit_price * 100), flags)
+            if last_modified is not None:
+                newest = max(newest, last_modified.timestamp())
+        return capacity, slots, newest
+
+    def _refresh(self):
+        """Apply the Stock rows changed since the last refresh (every row on the first one)"""
+        sequence, capacity, refreshed_at, watermark, swept_at = self._writable_header()
+        started = time.time()
+        full = not watermark
+        rows = self._read_rows(None if full else watermark - self.overlap)
+        capacity, slots, newest = self._fill(rows, capacity, full)
+        self._write(sequence, slots, (capacity, started, max(watermark, newest), started if full else swept_at))
+
+    def _ensure_fresh(self):
+        """Refresh if the table is older than max_age, letting one process do it at a time"""
+        if time.time() - self._header()[2] <= self.max_age:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            # Another process may have refreshed while we waited for the lock
+            if time.time() - self._header()[2] > self.max_age:
+                self._refresh()
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def forget(self, stock_id):
+        """Clear the slot of a hard-deleted item, which no last_modified delta would report"""
+        if not self.enabled():
+            return
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                sequence, capacity, refreshed_at, watermark, swept_at = self._writable_header()
+                self._remap(capacity)
+                slots = {stock_id: EMPTY_SLOT} if stock_id < capacity else {}
+                self._write(sequence, slots, (capacity, refreshed_at, watermark, swept_at))
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def sweep(self):
+        """
+        Rewrite every slot from a full read of the Stock table, catching rows
+        the deltas missed and clearing those that are gone. Returns the number
+        of rows read, or None when the table is off. Meant for the
+        sweep_stock_snapshot command: the rows are read before the flock is
+        taken, and the next lookup re-reads what changed meanwhile.
+        """
+        if not self.enabled():
+            return None
+        with self._lock:
+            self._open()
+            started = time.time()
+            rows = self._read_rows()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                sequence, capacity, refreshed_at, watermark, swept_at = self._writable_header()
+                capacity, slots, _ = self._fill(rows, capacity, True)
+                # A delta refresh may have written newer values while the rows were
+                # read; winding the watermark back makes the next lookup re-read them
+                watermark = min(watermark, started) if watermark else started
+                self._write(sequence, slots, (capacity, 0.0, watermark, started))
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return len(rows)
+
+    # Reading
+
+    def _read(self, stock_ids):
+        """
+        {stock_id: StockRow} from one consistent state of the table, or None if
+        writers kept changing it (or one died mid-write) for READ_ATTEMPTS tries
+        """
+        for _ in range(READ_ATTEMPTS):
+            sequence, capacity = self._header()[:2]
+            if not sequence % 2:
+                self._remap(capacity)
+                rows = {}
+                for stock_id in stock_ids:
+                    if 0 <= stock_id < capacity:
+                        quantity, cents, flags = SLOT.unpack_from(self._map, HEADER_SIZE + stock_id * SLOT.size)
+                        if flags & PRESENT:
+                            rows[stock_id] = StockRow(quantity, Decimal(cents).scaleb(-2), bool(flags & DELETED))
+                if self._header()[0] == sequence:
+                    return rows
+            time.sleep(0)
+        return None
+
+    def lookup(self, stock_ids):
+        """
+        {stock_id: StockRow} for the ids that exist (deleted ones included), at
+        most max_age seconds behind the database. None when the shared table is
+        unavailable and the caller should query the database.
+        """
+        if not self.enabled():
+            return None
+        try:
+            with self._lock:
+                self._open()
+                self._ensure_fresh()
+                return self._read(stock_ids)
+        except (OSError, DatabaseError) as e:
+            logger.warning(f"Shared stock table unavailable, falling back to the database: {e}")
+            return None
+
+
+stock_table = SharedStockTable(getattr(settings, 'STOCK_SNAPSHOT_PATH', None))
+
+
+def active_stocks(stock_ids):
+    """
+    Non-deleted stock items by id, as unsaved Stock instances carrying quantity
+    and unit_price from the shared table, or loaded from the database when it
+    is unavailable. Quantities are what can be sold: they include this
+    process's unflushed write-behind changes and leave out units held by
+    active reservations (from reservations.cached_holds, as holds come and go
+    too fast for the table).
+    """
+    from .reservations import cached_holds
+    from .writebehind import pending
+    held = cached_holds()
+    rows = stock_table.lookup(stock_ids)
+    if rows is None:
+        stocks = Stock.objects.filter(pk__in=stock_ids, is_deleted=False).in_bulk()
+        for stock in stocks.values():
+            stock.quantity += pending(stock.pk) - held.get(stock.pk, 0)
+        return stocks
+    return {
+        stock_id: Stock(
+            id=stock_id, quantity=row.quantity + pending(stock_id) - held.get(stock_id, 0),
+            unit_price=row.unit_price, is_deleted=False
+        )
+        for stock_id, row in rows.items()
+        if not row.is_deleted
+    }
+
+
+def get_active_stock(stock_id):
+    """Stock.objects.get(pk=stock_id, is_deleted=False), answered through active_stocks"""
+    try:
+        stock_id = int(stock_id)
+    except (TypeError, ValueError):
+        raise Stock.DoesNotExist(f"Invalid stock id: {stock_id}")
+    stock = active_stocks([stock_id]).get(stock_id)
+    if stock is None:
+        raise Stock.DoesNotExist(f"No active stock item {stock_id}")
+    return stock
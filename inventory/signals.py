@@ -1,43 +1,159 @@
 """
 Django signals for inventory app to track stock changes automatically.
 """
-from django.db.models.signals import pre_save, post_save, post_delete
+from django.db.models.signals import pre_save, post_save, post_delete, post_init
 from django.dispatch import receiver
 from django.db import transaction
 from django.utils import timezone
+from contextlib import ContextDecorator
+from functools import partial
 from .models import Stock, StockHistory
+from .activity import ACTIVITY_FIELDS, record_activity, refresh_activity
+from .movements import (
+    MOVEMENT_FIELDS, BILL_ITEMS, apply_item_change, item_state, stored_item_state, move_bill,
+    item_snapshot, snapshot_item_state
+)
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 
+# Rows per INSERT when a history buffer is flushed
+HISTORY_BATCH_SIZE = 500
+
+_history_buffer = threading.local()
+
+
+class _Frame:
+    """One open buffered_history block: its atomic, the savepoints open inside it and its rows"""
+
+    def __init__(self, atomic, using):
+        self.atomic = atomic
+        self.using = using
+        self.savepoint_ids = _open_savepoints(using)
+        self.entries = []
+        # (savepoint ids, rows) last queued with on_commit from a plain atomic block
+        self.deferred = None
+
+
+def _write_history(entries, using=None):
+    if entries:
+        with transaction.atomic(using=using):
+            StockHistory.objects.bulk_create(entries, batch_size=HISTORY_BATCH_SIZE)
+
+
+class buffered_history(ContextDecorator):
+    """
+    Run the block in a transaction and collect the StockHistory rows it logs,
+    writing them with one chunked bulk_create just before the transaction commits.
+    A nested block hands its rows to the enclosing one when it succeeds and
+    drops them when it rolls back. Rows logged inside a plain atomic block are
+    queued with transaction.on_commit instead, so they are dropped with that
+    savepoint if it rolls back and written just after the commit otherwise.
+    """
+
+    def __init__(self, using=None):
+        self.using = using
+
+    def __enter__(self):
+        atomic = transaction.atomic(using=self.using)
+        atomic.__enter__()
+        if not hasattr(_history_buffer, 'stack'):
+            _history_buffer.stack = []
+        _history_buffer.stack.append(_Frame(atomic, self.using))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stack = _history_buffer.stack
+        frame = stack.pop()
+        try:
+            if stack:
+                # A nested block's savepoint is released (or rolled back) first,
+                # then its rows go wherever a row logged at that point would
+                suppress = frame.atomic.__exit__(exc_type, exc_value, traceback)
+                if exc_type is None:
+                    _queue(stack[-1], frame.entries)
+                return suppress
+            if exc_type is None:
+                try:
+                    _write_history(frame.entries, frame.using)
+                except Exception as e:
+                    frame.atomic.__exit__(type(e), e, e.__traceback__)
+                    raise
+            return frame.atomic.__exit__(exc_type, exc_value, traceback)
+        finally:
+            if not stack:
+                del _history_buffer.stack
+
+
+def _open_savepoints(using):
+    # atomic(savepoint=False) blocks appear as None; they cannot roll back on their own
+    return tuple(sid for sid in transaction.get_connection(using).savepoint_ids if sid is not None)
+
+
+def _queue(frame, entries):
+    """Add rows to the frame's buffer, or to an on_commit batch when inside a savepoint the frame does not own"""
+    savepoint_ids = _open_savepoints(frame.using)
+    if savepoint_ids == frame.savepoint_ids:
+        frame.entries.extend(entries)
+        return
+    # Django drops the batch with its savepoint if that rolls back. Savepoint ids
+    # are never reused within a transaction, so an unchanged chain means the
+    # last batch queued is still live to add to.
+    if frame.deferred is None or frame.deferred[0] != savepoint_ids:
+        frame.deferred = (savepoint_ids, [])
+        transaction.on_commit(partial(_write_history, frame.deferred[1], frame.using), using=frame.using)
+    frame.deferred[1].extend(entries)
+
+
+def record_history(**fields):
+    """Create a StockHistory row now, or queue it if a history buffer is active"""
+    fields.setdefault('changed_at', timezone.now())
+    entry = StockHistory(**fields)
+    stack = getattr(_history_buffer, 'stack', None)
+    if not stack:
+        entry.save()
+    else:
+        _queue(stack[-1], [entry])
+    return entry
+
+
 @receiver(pre_save, sender=Stock)
 def track_stock_changes(sender, instance, **kwargs):
     """Track stock changes (quantity, name, price) before save"""
     if instance.pk:  # Only for existing instances
-        try:
-            old_instance = Stock.objects.get(pk=instance.pk)
-            # Track quantity changes
-            if old_instance.quantity != instance.quantity:
-                instance._quantity_changed = True
-                instance._previous_quantity = old_instance.quantity
-            # Track name changes
-            if old_instance.name != instance.name:
-                instance._name_changed = True
-                instance._previous_name = old_instance.name
-            # Track price changes
-            if old_instance.unit_price != instance.unit_price:
-                instance._price_changed = True
-                instance._previous_price = old_instance.unit_price
-            instance._old_is_deleted = old_instance.is_deleted
-        except Stock.DoesNotExist:
-            pass
+        # Diff against the values captured when the instance was loaded. Instances
+        # built by hand (or with deferred fields) have no snapshot, and callers can
+        # set `_reread_for_update` to force a locked re-read of the current row.
+        old_values = getattr(instance, '_loaded_values', None)
+        if old_values is None or getattr(instance, '_reread_for_update', False):
+            queryset = Stock.objects.filter(pk=instance.pk)
+            if transaction.get_connection().in_atomic_block:
+                queryset = queryset.select_for_update()
+            old_values = queryset.values(*Stock.TRACKED_FIELDS).first()
+            if old_values is None:
+                return
+        # Track quantity changes
+        if old_values['quantity'] != instance.quantity:
+            instance._quantity_changed = True
+            instance._previous_quantity = old_values['quantity']
+        # Track name changes
+        if old_values['name'] != instance.name:
+            instance._name_changed = True
+            instance._previous_name = old_values['name']
+        # Track price changes
+        if old_values['unit_price'] != instance.unit_price:
+            instance._price_changed = True
+            instance._previous_price = old_values['unit_price']
+        instance._old_is_deleted = old_values['is_deleted']
+        instance._totals_before = (old_values['quantity'], old_values['unit_price'], old_values['is_deleted'])
 
 @receiver(post_save, sender=Stock)
 def log_stock_changes(sender, instance, created, **kwargs):
     """Log stock changes to StockHistory"""
     if created:
         # New stock item created
-        StockHistory.objects.create(
+        record_history(
             stock=instance,
             previous_quantity=0,
             new_quantity=instance.quantity,
@@ -79,7 +195,7 @@ def log_stock_changes(sender, instance, created, **kwargs):
                     reason = 'Stock updated'
             
             # Create history entry
-            StockHistory.objects.create(
+            record_history(
                 stock=instance,
                 previous_quantity=getattr(instance, '_previous_quantity', None) if quantity_changed else None,
                 new_quantity=instance.quantity if quantity_changed else None,
@@ -99,10 +215,176 @@ def log_stock_changes(sender, instance, created, **kwargs):
                 if hasattr(instance, attr):
                     delattr(instance, attr)
 
+@receiver(post_save, sender=Stock)
+def update_stock_search_index(sender, instance, created, **kwargs):
+    """Keep the name search index in step with created and renamed stock"""
+    from .search import index_stock
+    snapshot = getattr(instance, '_loaded_values', None)  # still the pre-save values here
+    if created or snapshot is None or snapshot['name'] != instance.name:
+        index_stock(instance.pk, instance.name)
+
+@receiver(post_delete, sender=Stock)
+def remove_stock_from_search_index(sender, instance, **kwargs):
+    """Drop hard-deleted stock from the name search index"""
+    from .search import unindex_stock
+    unindex_stock(instance.pk)
+
+@receiver(post_save, sender=Stock)
+def update_inventory_totals(sender, instance, created, **kwargs):
+    """Apply this save's effect to the running inventory totals"""
+    from .totals import apply_changes, stock_state
+    before = None if created else instance.__dict__.pop('_totals_before', None)
+    if created or before is not None:
+        apply_changes([(before, stock_state(instance))])
+
+@receiver(post_delete, sender=Stock)
+def remove_from_inventory_totals(sender, instance, **kwargs):
+    """Take hard-deleted stock out of the running inventory totals"""
+    from .totals import apply_changes, stock_state
+    apply_changes([(stock_state(instance), None)])
+
+@receiver(post_delete, sender=Stock)
+def forget_shared_stock(sender, instance, **kwargs):
+    """Clear a hard-deleted item from the shared stock table, which only sees rows that still exist"""
+    from .shared_stock import stock_table
+    stock_id = instance.pk
+    transaction.on_commit(lambda: stock_table.forget(stock_id))
+
+@receiver(post_save, sender=Stock)
+@receiver(post_delete, sender=Stock)
+@receiver(post_save, sender=StockHistory)
+def invalidate_dashboard_cache(sender, **kwargs):
+    """Cached dashboard figures are stale once a stock change commits"""
+    from .cache import DASHBOARD, invalidate_on_commit
+    invalidate_on_commit(DASHBOARD)
+
+BILL_MODELS = ('transactions.SaleBill', 'transactions.SaleItem',
+               'transactions.PurchaseBill', 'transactions.PurchaseItem')
+
+def invalidate_bill_figures(sender, **kwargs):
+    """Cached dashboard figures are stale once a bill change commits"""
+    from .cache import DASHBOARD, invalidate_on_commit
+    invalidate_on_commit(DASHBOARD)
+
+for _model in BILL_MODELS:
+    post_save.connect(invalidate_bill_figures, sender=_model, dispatch_uid=f'dashboard_bills_save_{_model}')
+    post_delete.connect(invalidate_bill_figures, sender=_model, dispatch_uid=f'dashboard_bills_delete_{_model}')
+
+# Bill item model -> the dashboard total its amounts feed
+BILL_KPIS = {
+    'transactions.SaleItem': 'sales',
+    'transactions.PurchaseItem': 'purchases',
+}
+
+def merge_bill_deltas(pending, data):
+    """Add up two undelivered 'bills' events"""
+    days = {day: dict(amounts) for day, amounts in pending['days'].items()}
+    for day, amounts in data['days'].items():
+        totals = days.setdefault(day, {'sales': 0, 'purchases': 0})
+        for kpi, amount in amounts.items():
+            totals[kpi] += amount
+    return {'today': data['today'], 'days': days}
+
+def publish_bill_deltas(item_label, changes):
+    """
+    Tell live dashboards how the sales or purchase total of each day moved.
+    `changes` is (day, amount) pairs; dashboards add the days inside their window.
+    """
+    from .live import publish_on_commit
+    kpi = BILL_KPIS[item_label]
+    days = {}
+    for day, amount in changes:
+        if amount:
+            totals = days.setdefault(day.isoformat(), {'sales': 0, 'purchases': 0})
+            totals[kpi] += float(amount)
+    if days:
+        publish_on_commit(
+            'bills',
+            lambda: {'today': timezone.localdate().isoformat(), 'days': days},
+            merge=merge_bill_deltas
+        )
+
+def record_bill_item(sender, instance, **kwargs):
+    """Move the item's last sold/purchased time forward"""
+    record_activity(instance, ACTIVITY_FIELDS[sender._meta.label])
+
+def forget_bill_item(sender, instance, **kwargs):
+    """Recompute the item's last sold/purchased time without the deleted item"""
+    refresh_activity([instance.stock_id], sender._meta.label)
+
+for _model in ACTIVITY_FIELDS:
+    post_save.connect(record_bill_item, sender=_model, dispatch_uid=f'activity_save_{_model}')
+    post_delete.connect(forget_bill_item, sender=_model, dispatch_uid=f'activity_delete_{_model}')
+
+def snapshot_bill_item(sender, instance, **kwargs):
+    """Remember the item's fields as loaded, so a later save knows its old contribution without a SELECT"""
+    instance._movement_loaded = item_snapshot(instance)
+
+def remember_bill_item_movement(sender, instance, **kwargs):
+    """Read what the stored item contributed when it was not loaded whole from the database"""
+    if instance._state.adding or instance.__dict__.get('_movement_loaded') is None:
+        instance._movement_before = stored_item_state(instance)
+
+def update_bill_item_movement(sender, instance, created, **kwargs):
+    """Apply a saved item to the daily movements"""
+    after = item_state(instance)
+    if '_movement_before' in instance.__dict__:
+        before = instance.__dict__.pop('_movement_before')
+    elif created:
+        before = None
+    else:
+        before = snapshot_item_state(instance, instance._movement_loaded, after)
+    instance._movement_loaded = item_snapshot(instance)
+    apply_item_change(sender._meta.label, before, after)
+    publish_bill_deltas(sender._meta.label, [
+        (state[1], sign * state[3]) for sign, state in ((-1, before), (1, after)) if state is not None
+    ])
+
+def remove_bill_item_movement(sender, instance, **kwargs):
+    """Take a deleted item out of the daily movements"""
+    before = item_state(instance)
+    apply_item_change(sender._meta.label, before, None)
+    if before is not None:
+        publish_bill_deltas(sender._meta.label, [(before[1], -before[3])])
+
+for _model in MOVEMENT_FIELDS:
+    post_init.connect(snapshot_bill_item, sender=_model, dispatch_uid=f'movement_post_init_{_model}')
+    pre_save.connect(remember_bill_item_movement, sender=_model, dispatch_uid=f'movement_pre_save_{_model}')
+    post_save.connect(update_bill_item_movement, sender=_model, dispatch_uid=f'movement_save_{_model}')
+    post_delete.connect(remove_bill_item_movement, sender=_model, dispatch_uid=f'movement_delete_{_model}')
+
+def snapshot_bill_time(sender, instance, **kwargs):
+    """Remember the bill's time as loaded, so a later save can tell whether it moved without a SELECT"""
+    if 'time' in instance.__dict__:
+        instance._movement_time = instance.time
+
+def remember_bill_day(sender, instance, **kwargs):
+    """Keep the stored bill's day, to notice when a save moves it"""
+    if not instance._state.adding and '_movement_time' in instance.__dict__:
+        stored = instance._movement_time
+    else:
+        # New, or loaded with `time` deferred
+        stored = sender.objects.filter(pk=instance.pk).values_list('time', flat=True).first() if instance.pk else None
+    instance._movement_day = timezone.localdate(stored) if stored else None
+
+def move_bill_movements(sender, instance, created, **kwargs):
+    """Move the bill's items to the bill's new day"""
+    old_day = instance.__dict__.pop('_movement_day', None)
+    snapshot_bill_time(sender, instance)
+    new_day = timezone.localdate(instance.time)
+    if not created and old_day is not None and old_day != new_day:
+        amount = move_bill(sender._meta.label, instance.pk, old_day, new_day)
+        publish_bill_deltas(BILL_ITEMS[sender._meta.label], [(old_day, -amount), (new_day, amount)])
+
+for _model in BILL_ITEMS:
+    post_init.connect(snapshot_bill_time, sender=_model, dispatch_uid=f'movement_bill_post_init_{_model}')
+    pre_save.connect(remember_bill_day, sender=_model, dispatch_uid=f'movement_bill_pre_save_{_model}')
+    post_save.connect(move_bill_movements, sender=_model, dispatch_uid=f'movement_bill_save_{_model}')
+
 def log_stock_transaction(stock, previous_quantity, new_quantity, change_type, changed_by, reason=''):
     """Helper function to log stock transactions (purchases, sales)"""
     try:
-        StockHistory.objects.create(
+        record_history(
             stock=stock,
             previous_quantity=previous_quantity,
             new_quantity=new_quantity,
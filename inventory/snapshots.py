@@ -0,0 +1,230 @@
+"""
+Point-in-time (as-of) inventory.
+
+take_snapshot() copies every stock item under one InventorySnapshot header,
+together with the highest StockHistory id the copy includes;
+take_inventory_snapshot runs it, typically once a day. inventory_as_of(ts)
+starts from the snapshot nearest to `ts` and replays only the StockHistory rows
+between the two: forward from an earlier snapshot, or backward (undoing the
+changes) from a later one. With daily snapshots that is at most about half a
+day of history however old the database is. History is read through
+inventory.archive, so archived rows count as well.
+
+Which rows a snapshot already contains is decided by history id, not by
+changed_at: a row is stamped when its transaction writes it, and the
+transaction may commit after a snapshot taken later than the stamp. The
+snapshot takes the write lock with its first insert, so on SQLite no other
+transaction commits while it reads the high-water id and copies the items.
+"""
+import datetime
+
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+from .archive import history_rows
+from .models import Stock, StockHistory, ArchivedStockHistory, InventorySnapshot, StockSnapshotItem
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Reason written by the history signal and the importer when an item is created
+CREATED_REASON = 'Stock item created'
+
+SNAPSHOT_BATCH_SIZE = 1000
+
+HISTORY_FIELDS = (
+    'id', 'changed_at', 'stock_id', 'change_type', 'reason',
+    'previous_quantity', 'new_quantity',
+    'previous_name', 'new_name',
+    'previous_price', 'new_price',
+)
+
+
+def _last_history_id():
+    """Highest history id, live or archived"""
+    return max(
+        model.objects.aggregate(top=Max('id'))['top'] or 0
+        for model in (StockHistory, ArchivedStockHistory)
+    )
+
+
+def take_snapshot():
+    """Copy every stock item into a new snapshot and return it"""
+    with transaction.atomic():
+        snapshot = InventorySnapshot.objects.create(taken_at=timezone.now())
+        snapshot.history_id = _last_history_id()
+        rows = Stock.objects.order_by('pk').values_list(
+            'pk', 'name', 'quantity', 'unit_price', 'is_deleted'
+        ).iterator(chunk_size=SNAPSHOT_BATCH_SIZE)
+        batch = []
+        count = 0
+        for stock_id, name, quantity, unit_price, is_deleted in rows:
+            batch.append(StockSnapshotItem(
+                snapshot=snapshot,
+                stock_id=stock_id,
+                name=name,
+                quantity=quantity,
+                unit_price=unit_price,
+                is_deleted=is_deleted
+            ))
+            if len(batch) >= SNAPSHOT_BATCH_SIZE:
+                StockSnapshotItem.objects.bulk_create(batch)
+                count += len(batch)
+                batch = []
+        StockSnapshotItem.objects.bulk_create(batch)
+        count += len(batch)
+        snapshot.item_count = count
+        snapshot.save(update_fields=['item_count', 'history_id'])
+    logger.info(f"Inventory snapshot of {count} item(s) taken at {snapshot.taken_at}")
+    return snapshot
+
+
+def nearest_snapshot(timestamp):
+    """The snapshot closest to `timestamp` on either side, or None"""
+    candidates = [
+        InventorySnapshot.objects.filter(taken_at__lte=timestamp).order_by('-taken_at').first(),
+        InventorySnapshot.objects.filter(taken_at__gt=timestamp).order_by('taken_at').first(),
+    ]
+    candidates = [snapshot for snapshot in candidates if snapshot is not None]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda snapshot: abs(snapshot.taken_at - timestamp))
+
+
+def _snapshot_state(snapshot):
+    return {
+        stock_id: {'name': name, 'quantity': quantity, 'unit_price': unit_price, 'is_deleted': is_deleted}
+        for stock_id, name, quantity, unit_price, is_deleted in snapshot.items.values_list(
+            'stock_id', 'name', 'quantity', 'unit_price', 'is_deleted'
+        ).iterator(chunk_size=SNAPSHOT_BATCH_SIZE)
+    }
+
+
+def _replay_forward(state, rows):
+    """Apply history rows, oldest first"""
+    for row in rows:
+        item = state.get(row['stock_id'])
+        if item is None:
+            # Created after the starting point; name and price are filled in later
+            item = state[row['stock_id']] = {'name': None, 'quantity': 0, 'unit_price': None, 'is_deleted': False}
+        if row['new_quantity'] is not None:
+            item['quantity'] = row['new_quantity']
+        if row['new_name'] is not None:
+            item['name'] = row['new_name']
+        if row['new_price'] is not None:
+            item['unit_price'] = row['new_price']
+        if row['change_type'] == 'delete':
+            item['is_deleted'] = True
+        elif row['change_type'] == 'restore':
+            item['is_deleted'] = False
+
+
+def _replay_backward(state, rows):
+    """Undo history rows, newest first"""
+    for row in rows:
+        if row['change_type'] == 'edit' and row['reason'] == CREATED_REASON:
+            state.pop(row['stock_id'], None)
+            continue
+        item = state.get(row['stock_id'])
+        if item is None:
+            continue
+        if row['previous_quantity'] is not None:
+            item['quantity'] = row['previous_quantity']
+        if row['previous_name'] is not None:
+            item['name'] = row['previous_name']
+        if row['previous_price'] is not None:
+            item['unit_price'] = row['previous_price']
+        if row['change_type'] == 'delete':
+            item['is_deleted'] = False
+        elif row['change_type'] == 'restore':
+            item['is_deleted'] = True
+
+
+def _fill_unknown(state, timestamp):
+    """
+    Name and price of items created after the starting point, which creation
+    rows do not record: the value before the first later change, else the current one.
+    """
+    missing = [stock_id for stock_id, item in state.items() if item['name'] is None or item['unit_price'] is None]
+    if not missing:
+        return
+    current = {
+        stock_id: (name, unit_price)
+        for stock_id, name, unit_price in Stock.objects.filter(pk__in=missing).values_list('pk', 'name', 'unit_price')
+    }
+    first_name, first_price = {}, {}
+    later = history_rows(
+        ('id', 'changed_at', 'stock_id', 'previous_name', 'previous_price'),
+        ('changed_at', 'id'),
+        Q(previous_name__isnull=False) | Q(previous_price__isnull=False),
+        stock_id__in=missing,
+        changed_at__gt=timestamp
+    )
+    for row in later:
+        if row['previous_name'] is not None:
+            first_name.setdefault(row['stock_id'], row['previous_name'])
+        if row['previous_price'] is not None:
+            first_price.setdefault(row['stock_id'], row['previous_price'])
+    for stock_id in missing:
+        item = state[stock_id]
+        name, unit_price = current.get(stock_id, (None, None))
+        if item['name'] is None:
+            item['name'] = first_name.get(stock_id, name)
+        if item['unit_price'] is None:
+            item['unit_price'] = first_price.get(stock_id, unit_price)
+
+
+def inventory_as_of(timestamp, include_deleted=False):
+    """
+    Every stock item as it was at `timestamp` (changes logged at or before it
+    included), sorted by name: [{'stock_id', 'name', 'quantity', 'unit_price',
+    'value', 'is_deleted'}]. Deleted items are left out unless asked for.
+    """
+    snapshot = nearest_snapshot(timestamp)
+    if snapshot is None:
+        # Replaying from the first history row would cost the whole history on
+        # every query; a snapshot now bounds this one and every later one
+        logger.info("No inventory snapshot yet, taking one for an as-of query")
+        snapshot = take_snapshot()
+    state = _snapshot_state(snapshot)
+    if snapshot.taken_at <= timestamp:
+        # Changes the copy lacks: committed after it, even if stamped before it
+        _replay_forward(state, history_rows(
+            HISTORY_FIELDS, ('id',), id__gt=snapshot.history_id, changed_at__lte=timestamp
+        ).iterator())
+    else:
+        # Changes the copy includes that were made after `timestamp`
+        _replay_backward(state, history_rows(
+            HISTORY_FIELDS, ('-id',), id__lte=snapshot.history_id, changed_at__gt=timestamp
+        ).iterator())
+    _fill_unknown(state, timestamp)
+
+    items = [
+        {
+            'stock_id': stock_id,
+            'name': item['name'],
+            'quantity': item['quantity'],
+            'unit_price': item['unit_price'],
+            'value': item['quantity'] * item['unit_price'] if item['unit_price'] is not None else None,
+            'is_deleted': item['is_deleted'],
+        }
+        for stock_id, item in state.items()
+        if include_deleted or not item['is_deleted']
+    ]
+    items.sort(key=lambda item: (item['name'] or '', item['stock_id']))
+    return items
+
+
+def parse_as_of(value):
+    """
+    Timestamp for an as-of query parameter: a date means the end of that day,
+    a naive datetime is taken in the current time zone. Raises ValueError.
+    """
+    value = value.strip()
+    if len(value) == 10:
+        moment = datetime.datetime.combine(datetime.date.fromisoformat(value), datetime.time.max)
+    else:
+        moment = datetime.datetime.fromisoformat(value)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
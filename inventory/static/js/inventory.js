@@ -104,3 +104,56 @@ function checkStockAvailability(stockId, quantity, callback) {
     });
 }
 
+// Stock availability check for a whole bill in one request:
+// lines is a list of {stockId, quantity}; callback gets one result per line, in order
+function checkStockAvailabilityBatch(lines, callback) {
+    var items = lines.map(function(line) {
+        return line.stockId + ':' + line.quantity;
+    });
+    $.ajax({
+        url: '/inventory/api/check-stock-batch/',
+        data: {
+            'items': items.join(',')
+        },
+        dataType: 'json',
+        success: function(data) {
+            if (callback) callback(data.results);
+        }
+    });
+}
+
+// Stock holds for checkout: hold units while a sale is being entered, then
+// confirm the hold when the sale is saved or release it when a line is dropped.
+// Units held by other sales are not counted as available by the checks above.
+function stockHoldRequest(url, data, callback, onError) {
+    $.ajax({
+        url: url,
+        method: 'POST',
+        data: data || {},
+        dataType: 'json',
+        headers: {'X-CSRFToken': getCookie('csrftoken')},
+        success: function(result) {
+            if (callback) callback(result);
+        },
+        error: function(xhr) {
+            if (onError) onError(xhr.responseJSON || {error: 'Request failed'});
+        }
+    });
+}
+
+function holdStock(stockId, quantity, callback, onError) {
+    stockHoldRequest('/inventory/api/holds/', {'stock_id': stockId, 'quantity': quantity}, callback, onError);
+}
+
+function confirmStockHold(token, callback, onError) {
+    stockHoldRequest('/inventory/api/holds/' + encodeURIComponent(token) + '/confirm/', null, callback, onError);
+}
+
+function releaseStockHold(token, callback, onError) {
+    stockHoldRequest('/inventory/api/holds/' + encodeURIComponent(token) + '/release/', null, callback, onError);
+}
+
+function getCookie(name) {
+    var match = document.cookie.match(new RegExp('(?:^|; )' + name + '=([^;]*)'));
+    return match ? decodeURIComponent(match[1]) : null;
+}
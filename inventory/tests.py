@@ -1,3 +1,1196 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import gzip
+import threading
+import time
+import io
+import json
+import os
+import pickle
+import tempfile
+import uuid
+from decimal import Decimal
+from unittest import mock, skipIf
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, OperationalError, connection, transaction
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import (
+    ArchivedStockHistory, DailyStockMovement, InventorySnapshot, InventoryTotals, RejectedStockChange, Stock,
+    StockHistory, StockHistoryRollup, StockJournalCheckpoint
+)
+from . import analytics, reservations, search, services, shared_stock, totals, views
+from .shared_stock import active_stocks
+from .archive import archive_history, history_page, month_start
+from .coalesce import RequestCoalescer, ServerBusy
+from .importer import import_stock_csv
+from .live import broadcaster
+from .movements import rebuild_movements
+from .pagination import InvalidCursor, encode_cursor, paginate_keyset
+from .snapshots import inventory_as_of, take_snapshot
+from .signals import buffered_history, publish_bill_deltas, record_history
+from .writebehind import DeltaAccumulator, replay_journals
+
+
+class ReserveStockConcurrencyTest(TransactionTestCase):
+    """Concurrent reserve_stock calls must never take the quantity below zero"""
+    THREADS = 8
+    ATTEMPTS_PER_THREAD = 10
+
+    def test_concurrent_reservations_do_not_oversell(self):
+        stock = Stock.objects.create(name='Widget', quantity=50, unit_price=Decimal('2.50'))
+        successes = []
+        failures = []
+        start = threading.Barrier(self.THREADS)
+
+        def worker():
+            try:
+                item = Stock.objects.get(pk=stock.pk)
+                start.wait()
+                for _ in range(self.ATTEMPTS_PER_THREAD):
+                    while True:
+                        try:
+                            item.reserve_stock(3, changed_by='stress-test')
+                            successes.append(item.quantity)
+                        except ValidationError:
+                            failures.append(1)
+                        except OperationalError:
+                            # SQLite reports a locked database instead of waiting; retry
+                            time.sleep(0.001)
+                            continue
+                        break
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stock.refresh_from_db()
+        self.assertEqual(len(successes), 50 // 3)
+        self.assertEqual(len(successes) + len(failures), self.THREADS * self.ATTEMPTS_PER_THREAD)
+        self.assertEqual(stock.quantity, 50 - 3 * len(successes))
+        # Every success saw a distinct new quantity, as returned by the UPDATE
+        self.assertEqual(sorted(successes), list(range(50 % 3, 50, 3)))
+        self.assertEqual(
+            StockHistory.objects.filter(stock=stock, change_type='sale').count(),
+            len(successes)
+        )
+
+    def test_release_stock_restores_quantity(self):
+        stock = Stock.objects.create(name='Gadget', quantity=5, unit_price=Decimal('1.00'))
+        self.assertEqual(stock.reserve_stock(5), 0)
+        with self.assertRaises(ValidationError):
+            stock.reserve_stock(1)
+        self.assertEqual(stock.release_stock(2), 2)
+        stock.refresh_from_db()
+        self.assertEqual(stock.quantity, 2)
+
+
+class KeysetPaginationTest(TestCase):
+    """Cursor pages cover every row once, in both directions, whatever the timestamp ties"""
+
+    def setUp(self):
+        stamp = timezone.now()
+        for i in range(7):
+            Stock.objects.create(name=f'Washer {i}', quantity=i, unit_price=Decimal('1.00'))
+        # Three rows share a timestamp, so the page boundaries fall inside a tie
+        ids = list(Stock.objects.order_by('pk').values_list('pk', flat=True))
+        for offset, pk in enumerate(ids):
+            Stock.objects.filter(pk=pk).update(last_modified=stamp - datetime.timedelta(minutes=min(offset, 3)))
+        self.expected = list(Stock.objects.order_by('-last_modified', '-pk').values_list('pk', flat=True))
+
+    def test_forward_and_back(self):
+        queryset = Stock.objects.all()
+        pages = [paginate_keyset(queryset, per_page=3)]
+        while pages[-1].has_next():
+            pages.append(paginate_keyset(queryset, cursor=pages[-1].next_cursor, per_page=3))
+        self.assertEqual([stock.pk for page in pages for stock in page], self.expected)
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertFalse(pages[0].has_previous())
+        self.assertIsNone(pages[-1].next_cursor)
+
+        back = paginate_keyset(queryset, cursor=pages[-1].previous_cursor, per_page=3)
+        self.assertEqual([stock.pk for stock in back], [stock.pk for stock in pages[1]])
+        back = paginate_keyset(queryset, cursor=back.previous_cursor, per_page=3)
+        self.assertEqual([stock.pk for stock in back], [stock.pk for stock in pages[0]])
+        self.assertFalse(back.has_previous())
+        self.assertTrue(back.has_next())
+
+    def test_page_ending_on_the_last_row(self):
+        page = paginate_keyset(Stock.objects.all(), per_page=7)
+        self.assertEqual(len(page), 7)
+        self.assertFalse(page.has_next())
+
+    def test_tampered_cursors_are_rejected(self):
+        valid = encode_cursor(timezone.now(), 1, 'next')
+        for token in [valid[:-3], 'not a cursor', encode_cursor(timezone.now(), 1, 'sideways'),
+                      'WyJ4IiwgMSwgIm5leHQiXQ', 'eyJhIjogMX0', 'WzEsIDIsIDNd']:
+            with self.assertRaises(InvalidCursor, msg=token):
+                paginate_keyset(Stock.objects.all(), cursor=token)
+
+    def test_list_view_answers_404_for_a_bad_cursor(self):
+        self.client.force_login(User.objects.create_user('clerk', password='pw'))
+        response = self.client.get(reverse('inventory'), {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse('inventory'))
+        self.assertEqual(response.status_code, 200)
+
+
+class StockSearchTest(TestCase):
+    """Name search uses the trigram index from three characters and LIKE below"""
+
+    def setUp(self):
+        for name in ('Tablet', 'Cable', 'Abacus'):
+            Stock.objects.create(name=name, quantity=1, unit_price=Decimal('1.00'))
+
+    def names(self, query):
+        return [stock.name for stock in search.search_stocks(query)]
+
+    def test_short_queries_fall_back_to_like(self):
+        with mock.patch.object(Stock.objects, 'raw', side_effect=AssertionError('index used')):
+            self.assertEqual(self.names('ab'), ['Abacus', 'Cable', 'Tablet'])
+            self.assertEqual(self.names(' a '), ['Abacus', 'Cable', 'Tablet'])
+
+    def test_indexed_queries(self):
+        if not search.index_available():
+            self.skipTest('SQLite without FTS5 trigram support')
+        self.assertEqual(self.names('abl'), ['Cable', 'Tablet'])
+        self.assertEqual(self.names('aba'), ['Abacus'])
+
+    def test_dropped_index_is_noticed(self):
+        if not search.index_available():
+            self.skipTest('SQLite without FTS5 trigram support')
+        self.addCleanup(search._index_present.clear)
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE {search.SEARCH_TABLE}")
+        self.assertEqual(self.names('abl'), ['Cable', 'Tablet'])
+        self.assertFalse(search.index_available())
+        Stock.objects.create(name='Cable tie', quantity=1, unit_price=Decimal('1.00'))
+
+
+class StockExportTest(TestCase):
+    """The CSV export streams every active row in blocks, plain or gzipped"""
+
+    def setUp(self):
+        for i in range(30):
+            Stock.objects.create(name=f'Hinge {i:02}', quantity=i, unit_price=Decimal('2.50'))
+        Stock.objects.create(name='Retired hinge', quantity=1, unit_price=Decimal('1.00'), is_deleted=True)
+        self.client.force_login(User.objects.create_user('clerk', password='pw'))
+
+    def rows(self, content):
+        return sorted(line.split(',')[0] for line in content.decode().splitlines()[1:])
+
+    def test_export_is_streamed_in_blocks(self):
+        with mock.patch.object(views.StockExportView, 'flush_bytes', 100), \
+                mock.patch.object(views.StockExportView, 'chunk_size', 7):
+            response = self.client.get(reverse('export-stock'))
+            chunks = list(response.streaming_content)
+        self.assertTrue(response.streaming)
+        self.assertGreater(len(chunks), 5)
+        self.assertEqual(self.rows(b''.join(chunks)), [f'Hinge {i:02}' for i in range(30)])
+
+    def test_gzip_export(self):
+        response = self.client.get(reverse('export-stock'), {'gzip': '1'})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        content = gzip.decompress(b''.join(response.streaming_content))
+        self.assertEqual(self.rows(content), [f'Hinge {i:02}' for i in range(30)])
+
+
+class BufferedHistoryTest(TestCase):
+    """Buffered history rows are written at the end of the block, minus those of rolled-back savepoints"""
+
+    def test_rows_from_rolled_back_savepoints_are_dropped(self):
+        stock = Stock.objects.create(name='Sprocket', quantity=5, unit_price=Decimal('1.00'))
+        with self.captureOnCommitCallbacks(execute=True):
+            with buffered_history():
+                record_history(stock=stock, change_type='sale', changed_by='kept')
+                try:
+                    with transaction.atomic():
+                        record_history(stock=stock, change_type='sale', changed_by='dropped')
+                        raise DatabaseError('roll back this savepoint')
+                except DatabaseError:
+                    pass
+                with transaction.atomic():
+                    record_history(stock=stock, change_type='sale', changed_by='released')
+                try:
+                    with buffered_history():
+                        record_history(stock=stock, change_type='sale', changed_by='nested dropped')
+                        raise DatabaseError('roll back the nested buffer')
+                except DatabaseError:
+                    pass
+                try:
+                    with transaction.atomic():
+                        with buffered_history():
+                            record_history(stock=stock, change_type='sale', changed_by='nested then dropped')
+                        raise DatabaseError('roll back around a nested buffer that succeeded')
+                except DatabaseError:
+                    pass
+                with buffered_history():
+                    record_history(stock=stock, change_type='sale', changed_by='nested')
+                record_history(stock=stock, change_type='sale', changed_by='after')
+                self.assertFalse(StockHistory.objects.filter(stock=stock, change_type='sale').exists())
+
+        self.assertEqual(
+            list(StockHistory.objects.filter(stock=stock, change_type='sale').order_by('changed_at', 'id').values_list('changed_by', flat=True)),
+            ['kept', 'released', 'nested', 'after']
+        )
+
+
+class ReserveManyTest(TestCase):
+    """reserve_many retries when a row changes between its read and its UPDATE"""
+
+    def setUp(self):
+        self.bolt = Stock.objects.create(name='Bolt', quantity=5, unit_price=Decimal('0.10'))
+        self.nut = Stock.objects.create(name='Nut', quantity=5, unit_price=Decimal('0.05'))
+
+    def _sell_nuts_after_first_read(self, quantity):
+        """Patch _lock_rows so another writer changes the nut row right after the first read"""
+        lock_rows = services._lock_rows
+        calls = []
+
+        def racy_lock_rows(stock_ids):
+            rows = lock_rows(stock_ids)
+            if not calls:
+                Stock.objects.filter(pk=self.nut.pk).update(quantity=quantity, version=F('version') + 1)
+            calls.append(stock_ids)
+            return rows
+
+        return mock.patch.object(services, '_lock_rows', racy_lock_rows)
+
+    def test_retry_uses_the_current_quantities(self):
+        with self._sell_nuts_after_first_read(3):
+            new_quantities = services.reserve_many({self.bolt.pk: 1, self.nut.pk: 1})
+        self.assertEqual(new_quantities, {self.bolt.pk: 4, self.nut.pk: 2})
+        self.assertEqual(
+            StockHistory.objects.get(stock=self.nut, change_type='sale').previous_quantity, 3
+        )
+
+    def test_retry_reports_the_line_that_fell_short(self):
+        with self._sell_nuts_after_first_read(1):
+            with self.assertRaises(services.InsufficientStockError) as raised:
+                services.reserve_many({self.bolt.pk: 1, self.nut.pk: 2})
+        self.assertEqual(list(raised.exception.shortfalls), [self.nut.pk])
+        self.assertEqual(raised.exception.shortfalls[self.nut.pk]['available'], 1)
+        self.bolt.refresh_from_db()
+        self.assertEqual(self.bolt.quantity, 5)
+
+
+class SetDeletedTest(TestCase):
+    """Bulk delete/restore writes one history row per changed item"""
+
+    def setUp(self):
+        self.stocks = [
+            Stock.objects.create(name=f'Peg {i}', quantity=i, unit_price=Decimal('1.00'))
+            for i in range(3)
+        ]
+
+    def history(self):
+        return list(StockHistory.objects.filter(change_type__in=['sale', 'delete']).order_by('id').values_list(
+            'change_type', 'stock_id'
+        ))
+
+    def test_one_row_per_changed_item(self):
+        first, second, third = self.stocks
+        self.assertEqual(services.set_deleted([second.pk, first.pk, 999999], changed_by='admin'), [first.pk, second.pk])
+        # Already deleted items are skipped
+        self.assertEqual(services.set_deleted([first.pk, third.pk], changed_by='admin'), [third.pk])
+        self.assertEqual(services.set_deleted([second.pk], deleted=False, changed_by='admin'), [second.pk])
+        self.assertEqual(services.set_deleted([second.pk], deleted=False), [])
+
+        rows = list(StockHistory.objects.filter(change_type__in=['delete', 'restore']).order_by('id').values_list(
+            'change_type', 'stock_id', 'changed_by', 'reason'
+        ))
+        self.assertEqual(rows, [
+            ('delete', first.pk, 'admin', 'Bulk delete'),
+            ('delete', second.pk, 'admin', 'Bulk delete'),
+            ('delete', third.pk, 'admin', 'Bulk delete'),
+            ('restore', second.pk, 'admin', 'Bulk restore'),
+        ])
+        self.assertEqual(
+            list(Stock.objects.filter(is_deleted=True).order_by('pk').values_list('pk', flat=True)),
+            [first.pk, third.pk]
+        )
+
+    def test_query_count_does_not_grow_with_the_selection(self):
+        more = [Stock.objects.create(name=f'Bolt {i}', quantity=5, unit_price=Decimal('1.00')) for i in range(20)]
+        # Create every totals stripe up front so none is added while counting
+        totals.rebuild_totals()
+        with CaptureQueriesContext(connection) as few:
+            services.set_deleted([stock.pk for stock in self.stocks])
+        with CaptureQueriesContext(connection) as many:
+            services.set_deleted([stock.pk for stock in more])
+        self.assertEqual(len(many), len(few))
+
+    def test_rows_keep_their_place_in_an_outer_buffer(self):
+        first, second, third = self.stocks
+        with buffered_history():
+            record_history(stock=first, change_type='sale', changed_by='before')
+            services.set_deleted([second.pk, third.pk], changed_by='admin')
+            record_history(stock=first, change_type='sale', changed_by='after')
+        self.assertEqual(self.history(), [
+            ('sale', first.pk), ('delete', second.pk), ('delete', third.pk), ('sale', first.pk)
+        ])
+
+
+class SalesTrendTest(TestCase):
+    """Trend buckets cover the whole window, empty ones as zeros, from the daily movements"""
+
+    today = datetime.date(2026, 3, 18)
+
+    def setUp(self):
+        stock = Stock.objects.create(name='Nut', quantity=1, unit_price=Decimal('1.00'))
+        for days_ago, revenue, cost in [(0, 10, 0), (2, 5, 3), (9, 7, 0), (20, 100, 0)]:
+            DailyStockMovement.objects.create(
+                stock=stock, date=self.today - datetime.timedelta(days=days_ago),
+                revenue=Decimal(revenue), cost=Decimal(cost)
+            )
+        patcher = mock.patch('django.utils.timezone.localdate', return_value=self.today)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_daily_buckets(self):
+        trend = analytics.sales_purchase_trend(7)
+        self.assertEqual(trend['bucket'], 'day')
+        self.assertEqual(trend['labels'], ['Mar 12', 'Mar 13', 'Mar 14', 'Mar 15', 'Mar 16', 'Mar 17', 'Mar 18'])
+        self.assertEqual(trend['sales'], [0, 0, 0, 0, 5, 0, 10])
+        self.assertEqual(trend['purchases'], [0, 0, 0, 0, 3, 0, 0])
+
+    def test_weekly_buckets(self):
+        trend = analytics.sales_purchase_trend(30, bucket='week')
+        # Weeks start on Monday; the first one begins before the window
+        self.assertEqual(trend['labels'], ['Feb 16', 'Feb 23', 'Mar 02', 'Mar 09', 'Mar 16'])
+        self.assertEqual(trend['sales'], [0, 100, 0, 7, 15])
+
+    def test_monthly_buckets(self):
+        trend = analytics.sales_purchase_trend(365)
+        self.assertEqual(trend['bucket'], 'month')
+        self.assertEqual(len(trend['labels']), 13)
+        self.assertEqual(trend['labels'][-2:], ['Feb 2026', 'Mar 2026'])
+        self.assertEqual(trend['sales'][-2:], [100, 22])
+        self.assertEqual(sum(trend['sales']), 122)
+
+    def test_period_totals_against_the_previous_period(self):
+        totals = analytics.period_totals(14)
+        self.assertEqual(totals['start_date'].date(), datetime.date(2026, 3, 5))
+        self.assertEqual(totals['total_sales'], Decimal('22'))
+        self.assertEqual(totals['prev_total_sales'], Decimal('100'))
+        self.assertEqual(totals['sales_change'], Decimal('-78'))
+        self.assertEqual(totals['total_purchases'], Decimal('3'))
+        self.assertEqual(totals['purchases_change'], 0)
+        self.assertEqual(totals['profit'], Decimal('19'))
+
+
+class InventoryTotalsTest(TestCase):
+    """Stock writes keep the striped KPI rows summing to the real totals"""
+
+    def test_writes_spread_over_stripes(self):
+        stripes = iter([1, 2, 3, 4, 5, 6, 7, 8] * 10)
+        with mock.patch('inventory.totals.random.randint', side_effect=lambda a, b: next(stripes)):
+            totals.rebuild_totals()
+            stocks = [Stock.objects.create(name=f'Rivet {i}', quantity=i * 5, unit_price=Decimal('1.50'))
+                      for i in range(5)]
+            stocks[3].reserve_stock(15)
+            services.set_deleted([stocks[4].pk])
+        self.assertGreater(InventoryTotals.objects.exclude(item_count=0).count(), 1)
+        self.assertEqual(totals.find_drift(), {})
+        current = totals.get_totals()
+        self.assertEqual(current.item_count, 4)
+        self.assertEqual(current.total_quantity, 15)
+        self.assertEqual(current.total_value, Decimal('22.50'))
+        self.assertEqual(current.out_of_stock_count, 2)
+
+    def test_missing_stripes_are_added(self):
+        Stock.objects.create(name='Rivet', quantity=3, unit_price=Decimal('2.00'))
+        totals.rebuild_totals()
+        InventoryTotals.objects.exclude(pk=totals.TOTALS_PK).delete()
+        with mock.patch('inventory.totals.random.randint', return_value=5):
+            Stock.objects.create(name='Rivet 2', quantity=4, unit_price=Decimal('2.00'))
+        self.assertTrue(InventoryTotals.objects.filter(pk=5, item_count=1).exists())
+        self.assertEqual(totals.get_totals().total_quantity, 7)
+        self.assertEqual(totals.find_drift(), {})
+
+
+class LiveBillEventsTest(TestCase):
+    """Bill deltas reach dashboard streams after commit, merged while undelivered"""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+        async def subscribe():
+            return broadcaster.subscribe()
+
+        self.subscription = self.loop.run_until_complete(subscribe())
+        self.addCleanup(broadcaster.unsubscribe, self.subscription)
+
+    def test_deltas_add_up_until_delivered(self):
+        today, yesterday = datetime.date(2026, 3, 18), datetime.date(2026, 3, 17)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            publish_bill_deltas('transactions.SaleItem', [(today, Decimal('5.00'))])
+            publish_bill_deltas('transactions.SaleItem', [(today, Decimal('2.00')), (yesterday, Decimal('1.00'))])
+            publish_bill_deltas('transactions.PurchaseItem', [(today, Decimal('4.00')), (yesterday, 0)])
+            self.assertEqual(self.subscription.pending, {})
+        self.assertEqual(len(callbacks), 3)
+
+        events = self.loop.run_until_complete(self.subscription.wait(1))
+        self.assertEqual(events['bills']['days'], {
+            '2026-03-18': {'sales': 7.0, 'purchases': 4.0},
+            '2026-03-17': {'sales': 1.0, 'purchases': 0},
+        })
+        self.assertIsNone(self.loop.run_until_complete(self.subscription.wait(0.01)))
+
+    def test_rolled_back_writes_are_not_published(self):
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            publish_bill_deltas('transactions.SaleItem', [(datetime.date(2026, 3, 18), Decimal('5.00'))])
+        self.assertEqual(len(callbacks), 1)
+        self.assertIsNone(self.loop.run_until_complete(self.subscription.wait(0.01)))
+
+
+class RequestCoalescerTest(SimpleTestCase):
+    """Coalescing and the build cap hold across coalescers that only share the cache, like two workers"""
+
+    def setUp(self):
+        self.name = f'test-{uuid.uuid4().hex}'
+
+    def workers(self, count=2, **kwargs):
+        options = dict(max_concurrent=1, queue_timeout=0.2, wait_timeout=5)
+        options.update(kwargs)
+        return [RequestCoalescer(self.name, **options) for _ in range(count)]
+
+    def run_in_thread(self, coalescer, key, compute):
+        outcome = {}
+
+        def target():
+            try:
+                outcome['result'] = coalescer.run(key, compute)
+            except Exception as e:
+                outcome['error'] = e
+
+        thread = threading.Thread(target=target)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        return thread, outcome
+
+    def test_identical_requests_share_one_build(self):
+        first, second = self.workers()
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def build():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {'rows': [1, 2, 3]}
+
+        leader, leader_outcome = self.run_in_thread(first, '30:', build)
+        self.assertTrue(started.wait(5))
+        follower, follower_outcome = self.run_in_thread(second, '30:', build)
+        time.sleep(0.1)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertEqual(calls, [1])
+        self.assertEqual(leader_outcome, {'result': {'rows': [1, 2, 3]}})
+        self.assertEqual(follower_outcome, {'result': {'rows': [1, 2, 3]}})
+        # The next request after the flight builds again
+        self.assertEqual(second.run('30:', lambda: 'fresh'), 'fresh')
+
+    def test_distinct_builds_are_capped(self):
+        first, second = self.workers()
+        started, release = threading.Event(), threading.Event()
+        leader, _ = self.run_in_thread(first, '30:', lambda: started.set() or release.wait(5))
+        self.assertTrue(started.wait(5))
+        with self.assertRaises(ServerBusy):
+            second.run('90:', lambda: 'built')
+        release.set()
+        leader.join(5)
+        self.assertEqual(second.run('90:', lambda: 'built'), 'built')
+
+    def test_followers_get_the_leaders_error(self):
+        first, second = self.workers()
+        started, release = threading.Event(), threading.Event()
+
+        def fail():
+            started.set()
+            release.wait(5)
+            raise ValueError('bad window')
+
+        leader, leader_outcome = self.run_in_thread(first, '30:', fail)
+        self.assertTrue(started.wait(5))
+        follower, follower_outcome = self.run_in_thread(second, '30:', fail)
+        time.sleep(0.1)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertIsInstance(leader_outcome['error'], ValueError)
+        self.assertIsInstance(follower_outcome['error'], ValueError)
+
+    def test_busy_error_survives_the_cache(self):
+        error = pickle.loads(pickle.dumps(ServerBusy(7)))
+        self.assertEqual(error.retry_after, 7)
+
+
+class StockImportTest(TestCase):
+    """Bad CSV rows become per-row errors; the other rows are still imported"""
+
+    def test_non_finite_prices_are_row_errors(self):
+        csv_file = io.StringIO(
+            "Name,Quantity,Unit Price\n"
+            "Washer,10,0.25\n"
+            "Spring,4,NaN\n"
+            "Clip,4,sNaN\n"
+            "Pin,4,Infinity\n"
+        )
+        result = import_stock_csv(csv_file, 'importer')
+        self.assertEqual(result.created_count, 1)
+        self.assertEqual(result.error_count, 3)
+        self.assertEqual(list(Stock.objects.values_list('name', flat=True)), ['Washer'])
+
+
+class BatchStockAvailabilityTest(TestCase):
+    """The batch endpoint answers every line, caps the line count and reports unknown items"""
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('clerk', password='pw'))
+        self.chisel = Stock.objects.create(name='Chisel', quantity=5, unit_price=Decimal('7.50'))
+        self.file = Stock.objects.create(name='File', quantity=1, unit_price=Decimal('3.00'))
+        self.gone = Stock.objects.create(name='Rasp', quantity=9, unit_price=Decimal('4.00'), is_deleted=True)
+        self.url = reverse('check-stock-batch-api')
+
+    def get(self, items):
+        return self.client.get(self.url, {'items': items})
+
+    def test_each_line_is_answered_in_order(self):
+        missing = 10 ** 9
+        response = self.get(f'{self.chisel.pk}:3,{missing}:1,{self.file.pk}:2,{self.gone.pk}:1,{self.chisel.pk}:6')
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([result['stock_id'] for result in results],
+                         [self.chisel.pk, missing, self.file.pk, self.gone.pk, self.chisel.pk])
+        self.assertEqual([result['available'] for result in results], [True, False, False, False, False])
+        self.assertEqual(results[0]['current_quantity'], 5)
+        self.assertEqual(results[0]['unit_price'], 7.5)
+        self.assertEqual(results[1]['message'], 'Stock item not found')
+        self.assertEqual(results[3]['message'], 'Stock item not found')
+
+    def test_line_cap_and_malformed_items(self):
+        cap = views.BatchStockAvailabilityView.max_items
+        self.assertEqual(self.get(','.join(f'{self.chisel.pk}:1' for _ in range(cap))).status_code, 200)
+        response = self.get(','.join(f'{self.chisel.pk}:1' for _ in range(cap + 1)))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(str(cap), response.json()['error'])
+        self.assertEqual(self.get('abc:1').status_code, 400)
+        self.assertEqual(self.get(f'{self.chisel.pk}:x').status_code, 400)
+        self.assertEqual(self.get('').json(), {'results': []})
+
+
+@skipIf(shared_stock.fcntl is None, 'the shared stock table needs fcntl')
+class SharedStockTableTest(TestCase):
+    """The shared table follows deltas, is swept outside requests and survives a torn write"""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, self.path)
+        self.table = shared_stock.SharedStockTable(self.path, max_age=3600, overlap=5)
+        self.addCleanup(self.table._close)
+        self.vise = Stock.objects.create(name='Vise', quantity=4, unit_price=Decimal('12.50'))
+        self.clamp = Stock.objects.create(name='Clamp', quantity=9, unit_price=Decimal('3.00'))
+
+    def quantities(self):
+        rows = self.table.lookup([self.vise.pk, self.clamp.pk])
+        return None if rows is None else {stock_id: row.quantity for stock_id, row in rows.items()}
+
+    def expire(self):
+        """Make the next lookup refresh"""
+        sequence, capacity, _, watermark, swept_at = self.table._header()
+        shared_stock.HEADER.pack_into(self.table._map, 0, shared_stock.MAGIC, sequence, capacity, 0.0, watermark, swept_at)
+
+    def test_delta_refresh_reads_only_changed_rows(self):
+        self.assertEqual(self.quantities(), {self.vise.pk: 4, self.clamp.pk: 9})
+        Stock.objects.filter(pk=self.vise.pk).update(quantity=2, last_modified=timezone.now())
+        self.assertEqual(self.quantities(), {self.vise.pk: 4, self.clamp.pk: 9})
+        self.expire()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.quantities(), {self.vise.pk: 2, self.clamp.pk: 9})
+        self.assertEqual(len(queries), 1)
+        self.assertIn('last_modified', queries[0]['sql'].split('WHERE')[-1])
+
+    def test_sweep_catches_late_commits_and_removed_rows(self):
+        self.quantities()
+        # Committed long after it was stamped, so outside the delta overlap
+        Stock.objects.filter(pk=self.clamp.pk).update(
+            quantity=1, last_modified=timezone.now() - datetime.timedelta(hours=1)
+        )
+        self.expire()
+        self.assertEqual(self.quantities()[self.clamp.pk], 9)
+        Stock.objects.filter(pk=self.vise.pk).delete()
+
+        self.assertEqual(self.table.sweep(), 1)
+        self.assertEqual(self.quantities(), {self.clamp.pk: 1})
+        self.assertGreater(self.table._header()[4], 0)
+
+    def test_torn_write_is_repaired(self):
+        self.quantities()
+        sequence, capacity, refreshed_at, watermark, swept_at = self.table._header()
+        # A writer died after marking the table busy and scribbling over a slot
+        shared_stock.HEADER.pack_into(
+            self.table._map, 0, shared_stock.MAGIC, sequence + 1, capacity, refreshed_at, watermark, swept_at
+        )
+        offset = shared_stock.HEADER_SIZE + self.vise.pk * shared_stock.SLOT.size
+        self.table._map[offset:offset + shared_stock.SLOT.size] = shared_stock.SLOT.pack(-77, 1, shared_stock.PRESENT)
+        # Readers do not trust a table left mid-write
+        self.assertIsNone(self.quantities())
+
+        self.expire()
+        with self.assertLogs('inventory.shared_stock', 'WARNING'):
+            self.assertEqual(self.quantities(), {self.vise.pk: 4, self.clamp.pk: 9})
+        self.assertEqual(self.table._header()[0] % 2, 0)
+
+
+class StockActivityFieldsTest(TestCase):
+    """Saving a Stock loaded before a sale keeps the sale's last_sold_at"""
+
+    def test_save_does_not_write_back_activity_times(self):
+        stock = Stock.objects.create(name='Hinge', quantity=5, unit_price=Decimal('3.00'))
+        loaded = Stock.objects.get(pk=stock.pk)
+        sold_at = timezone.now()
+        Stock.objects.filter(pk=stock.pk).update(last_sold_at=sold_at)
+
+        loaded.name = 'Door hinge'
+        loaded.save()
+
+        stock.refresh_from_db()
+        self.assertEqual(stock.name, 'Door hinge')
+        self.assertEqual(stock.last_sold_at, sold_at)
+
+    def test_sale_does_not_conflict_with_an_open_edit(self):
+        from transactions.models import SaleBill, SaleItem
+        stock = Stock.objects.create(name='Hasp', quantity=5, unit_price=Decimal('3.00'))
+        loaded = Stock.objects.get(pk=stock.pk)
+        bill = SaleBill.objects.create(name='Walk-in')
+        SaleItem.objects.create(billno=bill, stock=stock, quantity=1, perprice=3, totalprice=3)
+        stock.refresh_from_db()
+        self.assertIsNotNone(stock.last_sold_at)
+        self.assertEqual(stock.version, loaded.version)
+
+        loaded.name = 'Safety hasp'
+        loaded.save()
+
+        stock.refresh_from_db()
+        self.assertEqual(stock.name, 'Safety hasp')
+        self.assertEqual(stock.last_sold_at, bill.time)
+
+
+class StockValueTest(TestCase):
+    """stock_value stays quantity x unit_price on every write path"""
+
+    def assertValuesMatch(self):
+        for name, quantity, unit_price, stock_value in Stock.objects.values_list(
+            'name', 'quantity', 'unit_price', 'stock_value'
+        ):
+            self.assertEqual(stock_value, (quantity * Decimal(str(unit_price))).quantize(Decimal('0.01')), name)
+
+    def test_write_paths(self):
+        gear = Stock.objects.create(name='Gear', quantity=10, unit_price=Decimal('2.50'))
+        cog = Stock.objects.create(name='Cog', quantity=8, unit_price=Decimal('1.25'))
+        self.assertValuesMatch()
+
+        gear.unit_price = Decimal('3.00')
+        gear.save(update_fields=['unit_price'])
+        gear.reserve_stock(4)
+        cog.release_stock(2)
+        services.reserve_many({gear.pk: 1, cog.pk: 3})
+        self.assertValuesMatch()
+
+        import_stock_csv(io.StringIO("Name,Quantity,Unit Price\nGear,20,1.10\nSprocket,3,4.00\n"), 'importer')
+        self.assertValuesMatch()
+        self.assertEqual(Stock.objects.get(name='Sprocket').stock_value, Decimal('12.00'))
+
+    def test_value_ranking_uses_the_partial_index(self):
+        self.assertIn('stock_active_value_idx', [index.name for index in Stock._meta.indexes])
+        for i in range(3):
+            Stock.objects.create(name=f'Axle {i}', quantity=i + 1, unit_price=Decimal('10.00'))
+        ranked = Stock.objects.filter(is_deleted=False).order_by('-stock_value').values_list('name', flat=True)
+        self.assertEqual(list(ranked), ['Axle 2', 'Axle 1', 'Axle 0'])
+        if connection.vendor != 'sqlite':
+            return
+        plan = ' '.join(str(row) for row in connection.cursor().execute(
+            f"EXPLAIN QUERY PLAN {Stock.objects.filter(is_deleted=False).order_by('-stock_value')[:5].query}"
+        ).fetchall())
+        self.assertIn('stock_active_value_idx', plan)
+
+
+class DailyMovementSignalsTest(TestCase):
+    """Bill and item saves keep the daily facts right without re-reading the stored rows"""
+
+    def setUp(self):
+        from transactions.models import SaleBill, SaleItem
+        self.SaleBill, self.SaleItem = SaleBill, SaleItem
+        self.stock = Stock.objects.create(name='Spindle', quantity=100, unit_price=Decimal('10.00'))
+        self.bill = SaleBill.objects.create(name='Walk-in')
+        self.item = SaleItem.objects.create(billno=self.bill, stock=self.stock, quantity=2, perprice=10, totalprice=20)
+
+    def facts(self):
+        return list(DailyStockMovement.objects.order_by('date').values_list('date', 'qty_sold', 'revenue'))
+
+    def selects_from(self, queries, model):
+        table = f'FROM "{model._meta.db_table}"'
+        return [query['sql'] for query in queries if query['sql'].startswith('SELECT') and table in query['sql']]
+
+    def test_loaded_item_save_reads_no_stored_row(self):
+        today = timezone.localdate()
+        self.assertEqual(self.facts(), [(today, 2, Decimal('20'))])
+        item = self.SaleItem.objects.get(pk=self.item.pk)
+        item.quantity, item.totalprice = 3, 30
+        with CaptureQueriesContext(connection) as queries:
+            item.save()
+        self.assertEqual(self.selects_from(queries, self.SaleItem), [])
+        self.assertEqual(self.facts(), [(today, 3, Decimal('30'))])
+
+        # A second save of the same instance starts from what the first one wrote
+        item.quantity, item.totalprice = 1, 10
+        item.save()
+        self.assertEqual(self.facts(), [(today, 1, Decimal('10'))])
+
+    def test_deferred_item_save_reads_the_stored_row(self):
+        item = self.SaleItem.objects.only('pk', 'billno_id', 'quantity').get(pk=self.item.pk)
+        item.quantity = 5
+        item.save(update_fields=['quantity'])
+        self.assertEqual(self.facts(), [(timezone.localdate(), 5, Decimal('20'))])
+
+    def test_item_moved_to_another_bill(self):
+        earlier = self.SaleBill.objects.create(name='Phone order')
+        self.SaleBill.objects.filter(pk=earlier.pk).update(time=timezone.now() - datetime.timedelta(days=3))
+        item = self.SaleItem.objects.get(pk=self.item.pk)
+        item.billno = self.SaleBill.objects.get(pk=earlier.pk)
+        item.save()
+        self.assertEqual(self.facts(), [(timezone.localdate() - datetime.timedelta(days=3), 2, Decimal('20'))])
+
+    def test_bill_moved_to_another_day(self):
+        three_days_ago = timezone.localdate() - datetime.timedelta(days=3)
+        self.SaleBill.objects.filter(pk=self.bill.pk).update(time=timezone.now() - datetime.timedelta(days=3))
+        rebuild_movements()
+        self.assertEqual(self.facts(), [(three_days_ago, 2, Decimal('20'))])
+        bill = self.SaleBill.objects.get(pk=self.bill.pk)
+        with CaptureQueriesContext(connection) as queries:
+            # time is auto_now, so saving moves the bill to today
+            bill.save()
+        self.assertEqual(self.selects_from(queries, self.SaleBill), [])
+        self.assertEqual(self.facts(), [(timezone.localdate(), 2, Decimal('20'))])
+
+
+class InventoryAsOfTest(TestCase):
+    """As-of queries replay history forward and backward from the nearest snapshot"""
+
+    def quantities(self, timestamp):
+        return {item['name']: item['quantity'] for item in inventory_as_of(timestamp)}
+
+    def test_replay_both_ways_across_a_snapshot(self):
+        anvil = Stock.objects.create(name='Anvil', quantity=10, unit_price=Decimal('50.00'))
+        before = timezone.now()
+        anvil.reserve_stock(3)
+        snapshot = take_snapshot()
+        self.assertEqual(snapshot.history_id, StockHistory.objects.order_by('-id').values_list('id', flat=True)[0])
+        at_snapshot = timezone.now()
+        anvil.reserve_stock(2)
+        Stock.objects.create(name='Tongs', quantity=4, unit_price=Decimal('8.00'))
+        after = timezone.now()
+
+        self.assertEqual(self.quantities(before), {'Anvil': 10})
+        self.assertEqual(self.quantities(at_snapshot), {'Anvil': 7})
+        self.assertEqual(self.quantities(after), {'Anvil': 5, 'Tongs': 4})
+        self.assertEqual([item['unit_price'] for item in inventory_as_of(after)], [Decimal('50.00'), Decimal('8.00')])
+
+    def test_change_committed_after_the_snapshot_it_predates(self):
+        anvil = Stock.objects.create(name='Anvil', quantity=10, unit_price=Decimal('50.00'))
+        snapshot = take_snapshot()
+        # Stamped before the snapshot, committed (given a higher id) after it
+        Stock.objects.filter(pk=anvil.pk).update(quantity=6)
+        StockHistory.objects.create(
+            stock=anvil, previous_quantity=10, new_quantity=6, change_type='sale', changed_by='late',
+            changed_at=snapshot.taken_at - datetime.timedelta(seconds=1)
+        )
+        self.assertEqual(self.quantities(timezone.now()), {'Anvil': 6})
+        self.assertEqual(self.quantities(snapshot.taken_at), {'Anvil': 6})
+
+    def test_first_query_takes_a_snapshot(self):
+        anvil = Stock.objects.create(name='Anvil', quantity=10, unit_price=Decimal('50.00'))
+        moment = timezone.now()
+        anvil.reserve_stock(1)
+        self.assertEqual(InventorySnapshot.objects.count(), 0)
+        self.assertEqual(self.quantities(moment), {'Anvil': 10})
+        self.assertEqual(InventorySnapshot.objects.count(), 1)
+        self.assertEqual(self.quantities(timezone.now()), {'Anvil': 9})
+
+
+class HistoryArchiveTest(TestCase):
+    """Old history moves to the archive with a monthly rollup and still pages as one trail"""
+
+    def setUp(self):
+        self.stock = Stock.objects.create(name='Lathe', quantity=50, unit_price=Decimal('5.00'))
+        now = timezone.now()
+        self.old = now - datetime.timedelta(days=300)
+        for days_ago, previous, new in [(300, 50, 45), (299, 45, 40), (240, 40, 42), (3, 42, 41), (2, 41, 39), (1, 39, 38)]:
+            StockHistory.objects.create(
+                stock=self.stock, previous_quantity=previous, new_quantity=new,
+                change_type='sale' if new < previous else 'purchase', changed_by='clerk',
+                changed_at=now - datetime.timedelta(days=days_ago)
+            )
+        self.trail = list(StockHistory.objects.filter(stock=self.stock).order_by('-changed_at', '-id').values_list(
+            'id', flat=True
+        ))
+
+    def test_archive_moves_rows_and_rolls_them_up(self):
+        cutoff = timezone.now() - datetime.timedelta(days=30)
+        self.assertEqual(archive_history(before=cutoff), 3)
+        self.assertEqual(archive_history(before=cutoff), 0)
+        self.assertEqual(StockHistory.objects.filter(changed_at__lt=cutoff).count(), 0)
+        self.assertEqual(sorted(ArchivedStockHistory.objects.values_list('id', flat=True)), sorted(self.trail[-3:]))
+        rollups = {
+            (rollup.month, rollup.change_type): (rollup.entries, rollup.quantity_change)
+            for rollup in StockHistoryRollup.objects.filter(stock=self.stock)
+        }
+        first_month = month_start(self.old)
+        self.assertEqual(rollups[(first_month, 'sale')], (2, -10))
+        self.assertEqual(sum(entries for entries, _ in rollups.values()), 3)
+        self.assertEqual(sum(change for _, change in rollups.values()), -8)
+
+    def test_pages_run_on_into_the_archive(self):
+        archive_history(before=timezone.now() - datetime.timedelta(days=30))
+        pages = [history_page(self.stock, per_page=2)]
+        while pages[-1].has_next():
+            pages.append(history_page(self.stock, cursor=pages[-1].next_cursor, per_page=2))
+        self.assertEqual([entry.pk for page in pages for entry in page], self.trail)
+        self.assertIsInstance(pages[-1].object_list[-1], ArchivedStockHistory)
+
+        back = history_page(self.stock, cursor=pages[-1].previous_cursor, per_page=2)
+        self.assertEqual([entry.pk for entry in back], [entry.pk for entry in pages[-2]])
+
+    def test_recent_pages_do_not_read_the_archive(self):
+        archive_history(before=timezone.now() - datetime.timedelta(days=30))
+        archive_table = ArchivedStockHistory._meta.db_table
+        with CaptureQueriesContext(connection) as queries:
+            page = history_page(self.stock, per_page=3)
+        self.assertEqual(len(page), 3)
+        self.assertFalse([query for query in queries if archive_table in query['sql']])
+        with CaptureQueriesContext(connection) as queries:
+            history_page(self.stock, cursor=page.next_cursor, per_page=3)
+        self.assertTrue([query for query in queries if archive_table in query['sql']])
+
+
+class AuditLogApiTest(TestCase):
+    """The audit log pages filtered history across items and into the archive"""
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('auditor', password='pw'))
+        now = timezone.now()
+        drill = Stock.objects.create(name='Drill', quantity=20, unit_price=Decimal('30.00'))
+        saw = Stock.objects.create(name='Saw', quantity=20, unit_price=Decimal('25.00'))
+        StockHistory.objects.all().delete()
+        for i in range(7):
+            StockHistory.objects.create(
+                stock=drill if i % 2 else saw, previous_quantity=20 - i, new_quantity=19 - i,
+                change_type='sale', changed_by='alice' if i < 5 else 'bob',
+                changed_at=now - datetime.timedelta(days=200 if i < 2 else 7 - i)
+            )
+        StockHistory.objects.create(stock=drill, change_type='edit', changed_by='alice', changed_at=now)
+        archive_history(before=now - datetime.timedelta(days=100))
+        self.url = reverse('audit-log-api')
+
+    def pages(self, **params):
+        pages = [self.client.get(self.url, params).json()]
+        while pages[-1]['next_cursor']:
+            pages.append(self.client.get(self.url, dict(params, cursor=pages[-1]['next_cursor'])).json())
+        return pages
+
+    def test_filtered_pages_cover_live_and_archived_rows(self):
+        pages = self.pages(change_type='sale', changed_by='alice', limit=2)
+        entries = [entry for page in pages for entry in page['results']]
+        self.assertEqual([len(page['results']) for page in pages], [2, 2, 1])
+        self.assertEqual(len({entry['id'] for entry in entries}), 5)
+        self.assertTrue(all(entry['change_type'] == 'sale' and entry['changed_by'] == 'alice' for entry in entries))
+        stamps = [entry['changed_at'] for entry in entries]
+        self.assertEqual(stamps, sorted(stamps, reverse=True))
+        self.assertIsNone(pages[0]['previous_cursor'])
+
+        back = self.client.get(self.url, {
+            'change_type': 'sale', 'changed_by': 'alice', 'limit': 2, 'cursor': pages[-1]['previous_cursor']
+        }).json()
+        self.assertEqual(back['results'], pages[-2]['results'])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.get(self.url, {'cursor': 'garbage'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'limit': 'ten'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'change_type': 'theft'}).status_code, 400)
+        self.assertEqual(len(self.client.get(self.url, {'limit': 100000}).json()['results']), 8)
+        self.assertEqual(len(self.client.get(self.url, {'limit': 0}).json()['results']), 1)
+
+
+class StockAdjustmentConflictTest(TestCase):
+    """An adjustment posted from a stale form is refused and shows the current row"""
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw'))
+
+    def test_conflict_renders_current_quantity(self):
+        stock = Stock.objects.create(name='Latch', quantity=5, unit_price=Decimal('2.00'))
+        stale_version = stock.version
+        Stock.objects.filter(pk=stock.pk).update(quantity=7, version=F('version') + 1)
+
+        response = self.client.post(reverse('stock-adjust', args=[stock.pk]), {
+            'adjustment_type': 'correction', 'adjusted_quantity': 1, 'reason': 'count', 'version': stale_version,
+        })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['form'].non_field_errors())
+        self.assertEqual(response.context['stock'].quantity, 7)
+        self.assertEqual(response.context['form']['version'].value(), str(stale_version + 1))
+        stock.refresh_from_db()
+        self.assertEqual(stock.quantity, 7)
+
+
+class WriteBehindTest(TransactionTestCase):
+    """Deferred quantity changes are applied once each, in order, and never silently dropped"""
+
+    def setUp(self):
+        journals = tempfile.TemporaryDirectory()
+        self.addCleanup(journals.cleanup)
+        settings_override = override_settings(STOCK_WRITE_BEHIND_JOURNAL_DIR=journals.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # Long enough that only the test flushes
+        self.accumulator = DeltaAccumulator(interval_ms=3600 * 1000)
+        self.stock = Stock.objects.create(name='Rivet', quantity=5, unit_price=Decimal('1.00'))
+
+    def crash(self, accumulator=None):
+        """Drop the accumulator as a killed process would, releasing its journal and the owner lock"""
+        accumulator = accumulator or self.accumulator
+        os.close(accumulator._fd)
+        os.close(accumulator._owner_fd)
+        accumulator._pid = accumulator._owner_pid = None
+
+    def journaled(self):
+        with open(self.accumulator._path()) as journal:
+            return [json.loads(line)['delta'] for line in journal]
+
+    def test_flush_applies_net_change_in_journal_order(self):
+        self.accumulator.add(self.stock.pk, -3, 'sale', 'alice', 'Sold')
+        self.accumulator.add(self.stock.pk, 3, 'adjustment', 'bob', 'Returned')
+        self.assertEqual(self.accumulator.add(self.stock.pk, -5, 'sale', 'alice', 'Sold'), 0)
+
+        self.assertEqual(self.accumulator.flush(), 3)
+
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 0)
+        self.assertEqual(self.accumulator.pending(self.stock.pk), 0)
+        self.assertEqual(
+            list(StockHistory.objects.filter(stock=self.stock, change_type__in=['sale', 'adjustment']).order_by('pk')
+                 .values_list('changed_by', 'previous_quantity', 'new_quantity')),
+            [('alice', 5, 2), ('bob', 2, 5), ('alice', 5, 0)]
+        )
+        self.assertEqual(os.path.getsize(self.accumulator._path()), 0)
+
+    def test_replay_applies_unflushed_changes_after_crash(self):
+        self.accumulator.add(self.stock.pk, -2, 'sale', 'alice', 'Sold')
+        self.crash()
+
+        self.assertEqual(replay_journals(), 1)
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 3)
+        self.assertEqual(replay_journals(), 0)
+
+    def test_replay_skips_changes_committed_before_crash(self):
+        self.accumulator.add(self.stock.pk, -2, 'sale', 'alice', 'Sold')
+        with mock.patch('inventory.writebehind.os.ftruncate', side_effect=OSError('disk gone')):
+            with self.assertRaises(OSError):
+                self.accumulator.flush()
+        self.crash()
+
+        self.assertEqual(replay_journals(), 0)
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 3)
+
+    def test_unapplicable_changes_are_kept(self):
+        self.accumulator.add(self.stock.pk, -3, 'sale', 'alice', 'Sold')
+        # Another process drains the item before the flush
+        Stock.objects.filter(pk=self.stock.pk).update(quantity=1)
+
+        self.assertEqual(self.accumulator.flush(), 0)
+        self.assertEqual(self.accumulator.pending(self.stock.pk), -3)
+        checkpoint = StockJournalCheckpoint.objects.get(journal=self.accumulator._name)
+        self.assertEqual(checkpoint.held_seqs, [1])
+
+        self.crash()
+        self.assertEqual(replay_journals(), 0)
+        Stock.objects.filter(pk=self.stock.pk).update(quantity=4)
+        self.assertEqual(replay_journals(), 1)
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 1)
+        self.assertFalse(StockJournalCheckpoint.objects.filter(journal=self.accumulator._name).exists())
+
+    def test_changes_are_journaled_when_the_transaction_commits(self):
+        with transaction.atomic():
+            self.assertEqual(self.accumulator.add(self.stock.pk, -3, 'sale', 'alice', 'Sold'), 2)
+            self.assertEqual(self.journaled(), [])
+            self.assertEqual(self.accumulator.pending(self.stock.pk), -3)
+            # The transaction's own uncommitted changes count against it
+            with self.assertRaises(ValidationError):
+                self.accumulator.add(self.stock.pk, -3, 'sale', 'alice', 'Sold')
+        self.assertEqual(self.journaled(), [-3])
+        self.assertEqual(self.accumulator.pending(self.stock.pk), -3)
+        self.assertEqual(self.accumulator.flush(), 1)
+
+    def test_rolled_back_changes_are_dropped(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.accumulator.add(self.stock.pk, -3, 'sale', 'alice', 'Sold')
+                raise RuntimeError('checkout failed')
+        with transaction.atomic():
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    self.accumulator.add(self.stock.pk, -4, 'sale', 'bob', 'Sold')
+                    raise RuntimeError('line failed')
+            self.assertEqual(self.accumulator.pending(self.stock.pk), 0)
+            self.accumulator.add(self.stock.pk, -5, 'sale', 'bob', 'Sold')
+
+        self.assertEqual(self.journaled(), [-5])
+        self.assertEqual(self.accumulator.flush(), 1)
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 0)
+
+    def test_one_process_owns_the_journals(self):
+        self.accumulator.add(self.stock.pk, -1, 'sale', 'alice', 'Sold')
+        other = DeltaAccumulator(interval_ms=3600 * 1000)
+        self.assertFalse(other._own())
+        with self.assertRaises(RuntimeError):
+            other.add(self.stock.pk, -1, 'sale', 'bob', 'Sold')
+
+        self.crash()
+        other._next_owner_try = 0
+        self.assertEqual(other.add(self.stock.pk, -1, 'sale', 'bob', 'Sold'), 3)
+        self.stock.refresh_from_db()
+        # Taking over replayed the old owner's journal
+        self.assertEqual(self.stock.quantity, 4)
+        self.crash(other)
+
+    def test_held_changes_are_rejected_after_the_last_attempt(self):
+        self.accumulator.add(self.stock.pk, -3, 'sale', 'alice', 'Sold')
+        self.accumulator.add(self.stock.pk, 1, 'adjustment', 'bob', 'Found one')
+        Stock.objects.filter(pk=self.stock.pk).update(quantity=1)
+
+        with mock.patch('inventory.writebehind.MAX_ATTEMPTS', 2):
+            self.assertEqual(self.accumulator.flush(), 0)
+            self.assertEqual(self.accumulator.pending(self.stock.pk), -2)
+            self.assertEqual(self.accumulator.flush(), 0)
+
+        self.assertEqual(self.accumulator.pending(self.stock.pk), 0)
+        self.assertEqual(self.journaled(), [])
+        self.assertEqual(StockJournalCheckpoint.objects.get(journal=self.accumulator._name).held_seqs, [])
+        self.assertEqual(
+            list(RejectedStockChange.objects.order_by('seq').values_list('stock_id', 'delta', 'changed_by', 'attempts')),
+            [(self.stock.pk, -3, 'alice', 2), (self.stock.pk, 1, 'bob', 2)]
+        )
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 1)
+
+
+class StockHoldTest(TestCase):
+    """Units held by a reservation are kept for its confirm() from every sale path"""
+
+    def setUp(self):
+        self.stock = Stock.objects.create(name='Caster', quantity=5, unit_price=Decimal('4.00'))
+        self.reservation = reservations.hold(self.stock, 3)
+        # TestCase never commits, so the on_commit clears of the hold cache do not run
+        reservations.clear_hold_cache()
+        self.addCleanup(reservations.clear_hold_cache)
+
+    def reservation_queries(self, queries):
+        table = reservations.StockReservation._meta.db_table
+        return [query['sql'] for query in queries if table in query['sql']]
+
+    def test_availability_reads_holds_once_per_max_age(self):
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(3):
+                self.assertEqual(active_stocks([self.stock.pk])[self.stock.pk].quantity, 2)
+        self.assertEqual(len(self.reservation_queries(queries)), 1)
+
+        # Another process holds one more unit; it shows once the copy is too old
+        reservations.StockReservation.objects.create(
+            stock=self.stock, quantity=1, expires_at=timezone.now() + datetime.timedelta(minutes=5)
+        )
+        self.assertEqual(active_stocks([self.stock.pk])[self.stock.pk].quantity, 2)
+        later = time.monotonic() + reservations.HOLDS_MAX_AGE
+        with mock.patch('inventory.reservations.time.monotonic', return_value=later):
+            self.assertEqual(active_stocks([self.stock.pk])[self.stock.pk].quantity, 1)
+
+    def test_sale_paths_leave_held_units(self):
+        with self.assertRaises(ValidationError):
+            Stock.objects.get(pk=self.stock.pk).reserve_stock(3)
+        with self.assertRaises(services.InsufficientStockError) as raised:
+            services.reserve_many({self.stock.pk: 3})
+        self.assertEqual(raised.exception.shortfalls[self.stock.pk]['available'], 2)
+        self.assertEqual(active_stocks([self.stock.pk])[self.stock.pk].quantity, 2)
+
+        self.assertEqual(Stock.objects.get(pk=self.stock.pk).reserve_stock(2), 3)
+        self.assertEqual(reservations.confirm(self.reservation.token), 0)
+
+    def test_checkout_api(self):
+        self.client.force_login(User.objects.create_user('clerk', password='pw'))
+        response = self.client.post(reverse('stock-hold-api'), {'stock_id': self.stock.pk, 'quantity': 3})
+        self.assertEqual(response.status_code, 409)
+        response = self.client.post(reverse('stock-hold-api'), {'stock_id': self.stock.pk, 'quantity': 2})
+        self.assertEqual(response.status_code, 201)
+        token = response.json()['token']
+
+        response = self.client.post(reverse('stock-hold-confirm-api', args=[token]))
+        self.assertEqual(response.json(), {'confirmed': True, 'new_quantity': 3})
+        response = self.client.post(reverse('stock-hold-release-api', args=[self.reservation.token]))
+        self.assertEqual(response.json(), {'released': True})
+        self.assertFalse(reservations.active_holds([self.stock.pk]))
+
+
+class StockHoldConcurrencyTest(TransactionTestCase):
+    """Holds racing for the last units take turns: exactly the available units are held"""
+    THREADS = 8
+
+    def test_concurrent_holds_neither_oversell_nor_back_off(self):
+        stock = Stock.objects.create(name='Castor wheel', quantity=5, unit_price=Decimal('4.00'))
+        held = []
+        refused = []
+        start = threading.Barrier(self.THREADS)
+
+        def worker():
+            try:
+                start.wait()
+                while True:
+                    try:
+                        held.append(reservations.hold(stock, 1))
+                    except ValidationError:
+                        refused.append(1)
+                    except OperationalError:
+                        # SQLite reports a locked database instead of waiting; retry
+                        time.sleep(0.001)
+                        continue
+                    break
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(held), 5)
+        self.assertEqual(len(refused), self.THREADS - 5)
+        self.assertEqual(reservations.active_holds([stock.pk]), {stock.pk: 5})
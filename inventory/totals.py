@@ -0,0 +1,151 @@
+"""
+Incrementally maintained inventory KPIs.
+
+InventoryTotals holds the total stock value and quantity and the active,
+low-stock and out-of-stock item counts, split over a few stripe rows (pk 1 to
+TOTALS_STRIPES) whose sum is the real figure. Every Stock write path reports
+the before/after state of the rows it touched, and the difference is added to
+one randomly picked stripe in the same transaction, so concurrent writers
+rarely wait on the same row lock and dashboard reads are one small SUM instead
+of full-table aggregates.
+"""
+import random
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum, Count, F, Q, Max
+from django.utils import timezone
+from .models import Stock, InventoryTotals
+from .live import publish_on_commit
+from .cache import DASHBOARD, invalidate_on_commit
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The stripe holding the rebuilt totals; the others start at zero
+TOTALS_PK = 1
+
+# Rows the totals are spread over
+TOTALS_STRIPES = max(1, getattr(settings, 'INVENTORY_TOTALS_STRIPES', 8))
+
+# Items at or below this quantity count as low stock
+LOW_STOCK_THRESHOLD = 10
+
+TOTAL_FIELDS = ('total_value', 'total_quantity', 'item_count', 'low_stock_count', 'out_of_stock_count')
+
+
+def stock_state(stock):
+    """The (quantity, unit_price, is_deleted) triple the totals are computed from"""
+    return (stock.quantity, stock.unit_price, stock.is_deleted)
+
+
+def _contribution(state):
+    """What one item in `state` (or None for no row) adds to each total"""
+    if state is None:
+        return (Decimal(0), 0, 0, 0, 0)
+    quantity, unit_price, is_deleted = state
+    if is_deleted:
+        return (Decimal(0), 0, 0, 0, 0)
+    return (
+        quantity * Decimal(str(unit_price)),
+        quantity,
+        1,
+        int(quantity <= LOW_STOCK_THRESHOLD),
+        int(quantity == 0),
+    )
+
+
+def apply_changes(changes):
+    """
+    Apply the totals delta for an iterable of (before, after) states, where
+    either side is a (quantity, unit_price, is_deleted) triple or None for a row
+    that did not exist. Must be called after the rows were written.
+    """
+    delta = [Decimal(0), 0, 0, 0, 0]
+    for before, after in changes:
+        old, new = _contribution(before), _contribution(after)
+        for i in range(len(delta)):
+            delta[i] += new[i] - old[i]
+    if not any(delta):
+        return
+    stripe = random.randint(1, TOTALS_STRIPES)
+    changes = {field: F(field) + value for field, value in zip(TOTAL_FIELDS, delta) if value}
+    updated = InventoryTotals.objects.filter(pk=stripe).update(updated_at=timezone.now(), **changes)
+    if not updated:
+        if InventoryTotals.objects.filter(pk=TOTALS_PK).exists():
+            # Built before the stripe count was raised; add the missing stripe
+            InventoryTotals.objects.get_or_create(pk=stripe)
+            InventoryTotals.objects.filter(pk=stripe).update(updated_at=timezone.now(), **changes)
+        else:
+            # No totals yet; the rows are already written, so a rebuild includes this change
+            rebuild_totals()
+    publish_on_commit('stock', totals_payload)
+    invalidate_on_commit(DASHBOARD)
+
+
+def compute_totals():
+    """Recompute every total from the stock table"""
+    totals = Stock.objects.filter(is_deleted=False).aggregate(
+        total_value=Sum(F('quantity') * F('unit_price')),
+        total_quantity=Sum('quantity'),
+        item_count=Count('id'),
+        low_stock_count=Count('id', filter=Q(quantity__lte=LOW_STOCK_THRESHOLD)),
+        out_of_stock_count=Count('id', filter=Q(quantity=0)),
+    )
+    totals['total_value'] = Decimal(str(totals['total_value'] or 0)).quantize(Decimal('0.01'))
+    totals['total_quantity'] = totals['total_quantity'] or 0
+    return totals
+
+
+def rebuild_totals():
+    """Overwrite the stored totals with freshly computed ones, in the first stripe with the others zeroed"""
+    with transaction.atomic():
+        InventoryTotals.objects.update_or_create(pk=TOTALS_PK, defaults=compute_totals())
+        InventoryTotals.objects.exclude(pk=TOTALS_PK).update(
+            updated_at=timezone.now(), **{field: 0 for field in TOTAL_FIELDS}
+        )
+        InventoryTotals.objects.bulk_create(
+            [InventoryTotals(pk=stripe) for stripe in range(2, TOTALS_STRIPES + 1)],
+            ignore_conflicts=True
+        )
+    return _summed_totals()
+
+
+def _summed_totals():
+    """The stripes added up into an unsaved InventoryTotals, or None if there are none"""
+    sums = InventoryTotals.objects.aggregate(
+        stripes=Count('pk'), updated_at=Max('updated_at'), **{field: Sum(field) for field in TOTAL_FIELDS}
+    )
+    if not sums.pop('stripes'):
+        return None
+    sums['total_value'] = Decimal(str(sums['total_value'])).quantize(Decimal('0.01'))
+    return InventoryTotals(**sums)
+
+
+def get_totals():
+    """The current totals (an unsaved InventoryTotals summing the stripes), built on first use"""
+    return _summed_totals() or rebuild_totals()
+
+
+def totals_payload():
+    """The stock KPIs as sent to the dashboard (same keys as DashboardDataView)"""
+    totals = get_totals()
+    return {
+        'total_stock_value': float(totals.total_value),
+        'total_quantity': totals.total_quantity,
+        'item_count': totals.item_count,
+        'low_stock_count': totals.low_stock_count,
+        'out_of_stock_count': totals.out_of_stock_count,
+    }
+
+
+def find_drift():
+    """{field: (stored, actual)} for every total that no longer matches the stock table"""
+    stored = get_totals()
+    actual = compute_totals()
+    return {
+        field: (getattr(stored, field), actual[field])
+        for field in TOTAL_FIELDS
+        if getattr(stored, field) != actual[field]
+    }
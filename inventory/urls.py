@@ -9,13 +9,21 @@ urlpatterns = [
     path('stock/<pk>/edit', views.StockUpdateView.as_view(), name='edit-stock'),
     path('stock/<pk>/delete', views.StockDeleteView.as_view(), name='delete-stock'),
     path('stock/<pk>/history', views.StockHistoryView.as_view(), name='stock-history'),
+    path('audit-log', views.AuditLogView.as_view(), name='audit-log'),
+    path('deleted', views.DeletedStockListView.as_view(), name='deleted-stock'),
     path('bulk-action', views.BulkStockActionView.as_view(), name='bulk-stock-action'),
     path('export', views.StockExportView.as_view(), name='export-stock'),
     path('export/<str:stock_ids>', views.StockExportView.as_view(), name='export-stock-selected'),
     path('stock/<pk>/adjust', views.StockAdjustmentView.as_view(), name='stock-adjust'),
     path('report', views.StockReportView.as_view(), name='stock-report'),
+    path('report/as-of.csv', views.StockAsOfExportView.as_view(), name='stock-as-of-export'),
     path('import', views.StockImportView.as_view(), name='stock-import'),
     path('api/search/', views.StockSearchView.as_view(), name='stock-search-api'),
     path('api/check-stock/', views.CheckStockAvailabilityView.as_view(), name='check-stock-api'),
+    path('api/check-stock-batch/', views.BatchStockAvailabilityView.as_view(), name='check-stock-batch-api'),
     path('api/get-stock-price/', views.GetStockPriceView.as_view(), name='get-stock-price-api'),
+    path('api/holds/', views.StockHoldView.as_view(), name='stock-hold-api'),
+    path('api/holds/<str:token>/confirm/', views.ConfirmStockHoldView.as_view(), name='stock-hold-confirm-api'),
+    path('api/holds/<str:token>/release/', views.ReleaseStockHoldView.as_view(), name='stock-hold-release-api'),
+    path('api/audit-log/', views.AuditLogApiView.as_view(), name='audit-log-api'),
 ]
\ No newline at end of file
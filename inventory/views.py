@@ -6,10 +6,24 @@ from django.views.generic import (
 )
 from django.contrib.messages.views import SuccessMessageMixin
 from django.contrib import messages
-from .models import Stock, StockHistory, StockAdjustment
+from .models import Stock, StockAdjustment, StockVersionConflict
 from .forms import StockForm, StockAdjustmentForm, StockEditDetailsForm
 from django_filters.views import FilterView
-from .filters import StockFilter
+from .filters import StockFilter, StockHistoryFilter
+from .archive import history_page, history_querysets
+from .pagination import paginate_keyset, paginate_keyset_merged, InvalidCursor
+from .search import search_stocks
+from .shared_stock import active_stocks, get_active_stock
+from .importer import import_stock_csv
+from .services import set_deleted
+from . import reservations
+from .signals import buffered_history
+from . import writebehind
+from .reports import get_stock_report
+from .coalesce import ServerBusy
+from .snapshots import inventory_as_of, parse_as_of
+from django.http import Http404
+from django.core.exceptions import ValidationError
 from django.db import transaction
 from django.db.models import Max, Min, Avg, Sum, Count, F, Q
 from django.utils import timezone
@@ -22,10 +36,37 @@ class StockListView(FilterView):
     filterset_class = StockFilter
     template_name = 'inventory.html'
     paginate_by = 10
+    cursor_kwarg = 'cursor'
     
     def get_queryset(self):
         """Optimize query with indexes"""
-        return Stock.objects.filter(is_deleted=False).order_by('-last_modified')
+        return Stock.objects.filter(is_deleted=False).order_by('-last_modified', '-id')
+
+    def paginate_queryset(self, queryset, page_size):
+        """Page with a (last_modified, id) cursor unless an offset ?page= was asked for"""
+        self.cursor_pagination = self.page_kwarg not in self.request.GET
+        if not self.cursor_pagination:
+            return super().paginate_queryset(queryset, page_size)
+        try:
+            page = paginate_keyset(
+                queryset,
+                cursor=self.request.GET.get(self.cursor_kwarg),
+                per_page=page_size,
+                with_count=self.request.GET.get('count') == '1'
+            )
+        except InvalidCursor:
+            raise Http404("Invalid page cursor.")
+        return (None, page, page.object_list, page.has_other_pages())
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # Current filters, so paging links keep them
+        params = self.request.GET.copy()
+        for key in (self.page_kwarg, self.cursor_kwarg):
+            params.pop(key, None)
+        context['filter_querystring'] = params.urlencode()
+        context['cursor_pagination'] = getattr(self, 'cursor_pagination', False)
+        return context
 
 
 class StockUpdateView(SuccessMessageMixin, UpdateView):                                 # updateview class to edit stock, mixin used to display message
@@ -38,7 +79,7 @@ class StockUpdateView(SuccessMessageMixin, UpdateView):
     @transaction.atomic
     def post(self, request, pk):
         try:
-            stock = get_object_or_404(Stock, pk=pk)
+            stock = self.object = get_object_or_404(Stock, pk=pk)
             old_name = stock.name
             old_price = stock.unit_price
             form = StockEditDetailsForm(request.POST, instance=stock)
@@ -61,8 +102,24 @@ class StockUpdateView(SuccessMessageMixin, UpdateView):
                 stock.last_modified = datetime.datetime.now()
                 stock.last_modification = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                 stock.modified_by = request.user.username
+                if form.cleaned_data['version'] is not None:
+                    stock.version = form.cleaned_data['version']
                 stock.full_clean()  # Run model validation
-                stock.save()
+                try:
+                    # In a savepoint, so the conflict leaves the view's transaction usable for the re-render
+                    with transaction.atomic():
+                        stock.save()
+                except StockVersionConflict as e:
+                    # Show the current row, carrying its version so a resubmit applies on top of it
+                    self.object = Stock.objects.get(pk=pk)
+                    data = request.POST.copy()
+                    data['version'] = str(self.object.version)
+                    form = StockEditDetailsForm(data, instance=Stock.objects.get(pk=pk))
+                    form.is_valid()
+                    form.add_error(None, e)
+                    context = self.get_context_data()
+                    context['form'] = form
+                    return render(request, self.template_name, context)
                 messages.success(request, self.success_message)
                 logger.info(f"Stock details for {stock.name} updated by {request.user.username}")
                 return redirect('inventory')
@@ -141,20 +198,110 @@ class StockHistoryView(View):
     """View to display stock change history"""
     template_name = 'stock_history.html'
     
+    per_page = 50
+    
     def get(self, request, pk):
         try:
             stock = get_object_or_404(Stock, pk=pk)
-            history = StockHistory.objects.filter(stock=stock).order_by('-changed_at')[:50]
+            # Pages run on from the live table into archived history
+            try:
+                history = history_page(stock, cursor=request.GET.get('cursor'), per_page=self.per_page)
+            except InvalidCursor:
+                raise Http404("Invalid page cursor.")
             context = {
                 'stock': stock,
                 'history': history,
+                'rollups': None if history.has_next() else stock.history_rollups.all(),
             }
             return render(request, self.template_name, context)
+        except Http404:
+            raise
         except Exception as e:
             logger.error(f"Error loading stock history: {str(e)}", exc_info=True)
             messages.error(request, "An error occurred while loading stock history.")
             return redirect('inventory')
 
+class AuditLogView(View):
+    """Stock history across all items, filtered and paged newest first"""
+    template_name = 'audit_log.html'
+    per_page = 50
+    
+    def get_filters(self, request):
+        """One StockHistoryFilter per history table (live and archived)"""
+        return [StockHistoryFilter(request.GET, queryset=queryset) for queryset in history_querysets()]
+    
+    def get_page(self, request, filters, per_page):
+        """KeysetPage of the history matching the filters, newest first"""
+        return paginate_keyset_merged(
+            [history_filter.qs for history_filter in filters],
+            cursor=request.GET.get('cursor'),
+            per_page=per_page,
+            time_field='changed_at'
+        )
+    
+    def get(self, request):
+        try:
+            filters = self.get_filters(request)
+            try:
+                page = self.get_page(request, filters, self.per_page)
+            except InvalidCursor:
+                raise Http404("Invalid page cursor.")
+            # Current filters, so paging links keep them
+            params = request.GET.copy()
+            params.pop('cursor', None)
+            context = {
+                'filter': filters[0],
+                'history': page,
+                'filter_querystring': params.urlencode(),
+            }
+            return render(request, self.template_name, context)
+        except Http404:
+            raise
+        except Exception as e:
+            logger.error(f"Error loading audit log: {str(e)}", exc_info=True)
+            messages.error(request, "An error occurred while loading the audit log.")
+            return redirect('inventory')
+
+class AuditLogApiView(AuditLogView):
+    """JSON audit log: ?change_type=&changed_by=&stock=&changed_after=&changed_before=&cursor=&limit="""
+    max_per_page = 200
+    
+    def get(self, request):
+        from django.http import JsonResponse
+        try:
+            per_page = min(max(int(request.GET.get('limit', self.per_page)), 1), self.max_per_page)
+        except ValueError:
+            return JsonResponse({'error': 'limit must be a number'}, status=400)
+        filters = self.get_filters(request)
+        if not filters[0].form.is_valid():
+            return JsonResponse({'error': filters[0].form.errors}, status=400)
+        try:
+            page = self.get_page(request, filters, per_page)
+        except InvalidCursor:
+            return JsonResponse({'error': 'Invalid page cursor'}, status=400)
+        
+        results = [{
+            'id': entry.pk,
+            'stock_id': entry.stock_id,
+            'stock_name': entry.stock.name,
+            'change_type': entry.change_type,
+            'previous_quantity': entry.previous_quantity,
+            'new_quantity': entry.new_quantity,
+            'previous_name': entry.previous_name,
+            'new_name': entry.new_name,
+            'previous_price': float(entry.previous_price) if entry.previous_price is not None else None,
+            'new_price': float(entry.new_price) if entry.new_price is not None else None,
+            'changed_by': entry.changed_by,
+            'changed_at': entry.changed_at.isoformat(),
+            'reason': entry.reason,
+        } for entry in page]
+        
+        return JsonResponse({
+            'results': results,
+            'next_cursor': page.next_cursor,
+            'previous_cursor': page.previous_cursor,
+        })
+
 class StockSearchView(View):
     """AJAX endpoint for stock search autocomplete"""
     def get(self, request):
@@ -164,10 +311,7 @@ class StockSearchView(View):
         if len(query) < 2:
             return JsonResponse([], safe=False)
         
-        stocks = Stock.objects.filter(
-            is_deleted=False,
-            name__icontains=query
-        )[:10]
+        stocks = search_stocks(query, limit=10)
         
         results = [{
             'id': stock.id,
@@ -186,7 +330,7 @@ class CheckStockAvailabilityView(View):
         quantity = int(request.GET.get('quantity', 0))
         
         try:
-            stock = Stock.objects.get(pk=stock_id, is_deleted=False)
+            stock = get_active_stock(stock_id)
             is_available, message = stock.check_stock_availability(quantity)
             
             return JsonResponse({
@@ -201,6 +345,49 @@ class CheckStockAvailabilityView(View):
                 'message': 'Stock item not found'
             }, status=404)
 
+class BatchStockAvailabilityView(View):
+    """
+    AJAX endpoint to check many bill lines at once: ?items=<stock_id>:<quantity>,...
+    Answers each line like CheckStockAvailabilityView, from one lookup.
+    """
+    max_items = 200
+    
+    def get(self, request):
+        from django.http import JsonResponse
+        try:
+            lines = []
+            for pair in request.GET.get('items', '').split(','):
+                if pair.strip():
+                    stock_id, _, quantity = pair.partition(':')
+                    lines.append((int(stock_id), int(quantity or 0)))
+        except ValueError:
+            return JsonResponse({'error': 'items must be <stock_id>:<quantity> pairs'}, status=400)
+        if len(lines) > self.max_items:
+            return JsonResponse({'error': f'At most {self.max_items} items per request'}, status=400)
+        
+        stocks = active_stocks({stock_id for stock_id, _ in lines})
+        
+        results = []
+        for stock_id, quantity in lines:
+            stock = stocks.get(stock_id)
+            if stock is None:
+                results.append({
+                    'stock_id': stock_id,
+                    'available': False,
+                    'message': 'Stock item not found'
+                })
+                continue
+            is_available, message = stock.check_stock_availability(quantity)
+            results.append({
+                'stock_id': stock_id,
+                'available': is_available,
+                'message': message,
+                'current_quantity': stock.quantity,
+                'unit_price': float(stock.unit_price)
+            })
+        
+        return JsonResponse({'results': results})
+
 class GetStockPriceView(View):
     """AJAX endpoint to get stock price"""
     def get(self, request):
@@ -208,7 +395,7 @@ class GetStockPriceView(View):
         stock_id = request.GET.get('stock_id')
         
         try:
-            stock = Stock.objects.get(pk=stock_id, is_deleted=False)
+            stock = get_active_stock(stock_id)
             return JsonResponse({
                 'unit_price': float(stock.unit_price),
                 'quantity': stock.quantity
@@ -218,9 +405,73 @@ class GetStockPriceView(View):
                 'error': 'Stock item not found'
             }, status=404)
 
+class StockHoldView(View):
+    """
+    AJAX endpoint for checkout to hold stock while a sale is in progress: POST
+    stock_id and quantity. Answers the hold's token, which the sale passes to
+    the confirm endpoint when it completes or to the release endpoint when it is abandoned.
+    """
+    def post(self, request):
+        from django.http import JsonResponse
+        try:
+            stock_id = int(request.POST.get('stock_id'))
+            quantity = int(request.POST.get('quantity'))
+        except (TypeError, ValueError):
+            return JsonResponse({'error': 'stock_id and quantity must be numbers'}, status=400)
+        stock = Stock.objects.filter(pk=stock_id, is_deleted=False).first()
+        if stock is None:
+            return JsonResponse({'error': 'Stock item not found'}, status=404)
+        try:
+            reservation = reservations.hold(stock, quantity, created_by=request.user.username)
+        except ValidationError as e:
+            return JsonResponse({'error': ' '.join(e.messages)}, status=409)
+        return JsonResponse({
+            'token': reservation.token,
+            'stock_id': stock_id,
+            'quantity': quantity,
+            'expires_at': reservation.expires_at.isoformat()
+        }, status=201)
+
+class ConfirmStockHoldView(View):
+    """AJAX endpoint to turn a hold into a sale when checkout completes"""
+    def post(self, request, token):
+        from django.http import JsonResponse
+        try:
+            new_quantity = reservations.confirm(
+                token, changed_by=request.user.username, reason='Sale completed at checkout'
+            )
+        except ValidationError as e:
+            return JsonResponse({'error': ' '.join(e.messages)}, status=409)
+        return JsonResponse({'confirmed': True, 'new_quantity': new_quantity})
+
+class ReleaseStockHoldView(View):
+    """AJAX endpoint to drop a hold when checkout is abandoned or a line removed"""
+    def post(self, request, token):
+        from django.http import JsonResponse
+        return JsonResponse({'released': reservations.release(token)})
+
+class DeletedStockListView(View):
+    """Soft-deleted stock items, most recently deleted first, with a bulk restore"""
+    template_name = 'deleted_stock.html'
+    per_page = 50
+
+    def get(self, request):
+        if not request.user.is_superuser:
+            messages.error(request, "You don't have permission to restore stock.")
+            return redirect('inventory')
+        try:
+            page = paginate_keyset(
+                Stock.objects.filter(is_deleted=True).order_by('-last_modified', '-id'),
+                cursor=request.GET.get('cursor'),
+                per_page=self.per_page
+            )
+        except InvalidCursor:
+            raise Http404("Invalid page cursor.")
+        return render(request, self.template_name, {'stocks': page})
+
 class BulkStockActionView(View):
     """Handle bulk operations on stock items"""
-    @transaction.atomic
+    @buffered_history()
     def post(self, request):
         if not request.user.is_superuser:
             messages.error(request, "You don't have permission to perform this action.")
@@ -234,18 +485,14 @@ class BulkStockActionView(View):
                 messages.error(request, "No items selected.")
                 return redirect('inventory')
             
-            stocks = Stock.objects.filter(pk__in=stock_ids, is_deleted=False)
-            
-            if action == 'delete':
-                count = 0
-                for stock in stocks:
-                    stock.is_deleted = True
-                    stock._changed_by = request.user.username
-                    stock._change_reason = 'Bulk delete'
-                    stock.save()
-                    count += 1
-                messages.success(request, f"{count} item(s) deleted successfully.")
-                logger.info(f"Bulk delete: {count} items deleted by {request.user.username}")
+            if action in ('delete', 'restore'):
+                deleted = action == 'delete'
+                changed = set_deleted(stock_ids, deleted=deleted, changed_by=request.user.username)
+                verb = 'deleted' if deleted else 'restored'
+                messages.success(request, f"{len(changed)} item(s) {verb} successfully.")
+                logger.info(f"Bulk {action}: {len(changed)} items {verb} by {request.user.username}: {changed}")
+                if not deleted:
+                    return redirect('deleted-stock')
             
             elif action == 'export':
                 # Export functionality will be handled separately
@@ -261,19 +508,15 @@ class BulkStockActionView(View):
             return redirect('inventory')
 
 class StockExportView(View):
-    """Export stock to CSV"""
+    """Export stock to CSV, streamed so memory use does not grow with the catalog"""
+    chunk_size = 2000                                                                   # rows fetched per database round trip
+    flush_bytes = 64 * 1024                                                             # CSV bytes buffered before each yield
+
     def get(self, request, stock_ids=None):
         try:
-            import csv
-            from django.http import HttpResponse
+            from django.http import StreamingHttpResponse
             from datetime import datetime
             
-            response = HttpResponse(content_type='text/csv')
-            response['Content-Disposition'] = f'attachment; filename="stock_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv"'
-            
-            writer = csv.writer(response)
-            writer.writerow(['Name', 'Quantity', 'Unit Price', 'Last Modified', 'Modified By'])
-            
             if stock_ids:
                 # Export selected items
                 ids = stock_ids.split(',')
@@ -282,24 +525,69 @@ class StockExportView(View):
                 # Export all filtered items (from query params)
                 filter_params = request.GET.copy()
                 filter_params.pop('export', None)  # Remove export param
+                filter_params.pop('gzip', None)
                 stocks = StockFilter(filter_params, queryset=Stock.objects.filter(is_deleted=False)).qs
             
-            for stock in stocks:
-                writer.writerow([
-                    stock.name,
-                    stock.quantity,
-                    stock.unit_price,
-                    stock.last_modified.strftime('%Y-%m-%d %H:%M:%S'),
-                    stock.modified_by or 'N/A'
-                ])
+            rows = stocks.values_list(
+                'name', 'quantity', 'unit_price', 'last_modified', 'modified_by'
+            ).iterator(chunk_size=self.chunk_size)
+            username = request.user.username if request.user.is_authenticated else 'Anonymous'
+            content = self._csv_stream(rows, username)
             
-            logger.info(f"Stock export: {stocks.count()} items exported by {request.user.username if request.user.is_authenticated else 'Anonymous'}")
+            filename = f'stock_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
+            if request.GET.get('gzip') == '1':
+                response = StreamingHttpResponse(self._gzip_stream(content), content_type='application/gzip')
+                filename += '.gz'
+            else:
+                response = StreamingHttpResponse(content, content_type='text/csv')
+            response['Content-Disposition'] = f'attachment; filename="{filename}"'
             return response
         except Exception as e:
             logger.error(f"Error exporting stock: {str(e)}", exc_info=True)
             messages.error(request, f"An error occurred while exporting: {str(e)}")
             return redirect('inventory')
 
+    def _csv_stream(self, rows, username):
+        """Yield the CSV in blocks of about flush_bytes, counting rows as they are written"""
+        import csv
+        from io import StringIO
+        
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['Name', 'Quantity', 'Unit Price', 'Last Modified', 'Modified By'])
+        count = 0
+        try:
+            for name, quantity, unit_price, last_modified, modified_by in rows:
+                writer.writerow([
+                    name,
+                    quantity,
+                    unit_price,
+                    last_modified.strftime('%Y-%m-%d %H:%M:%S'),
+                    modified_by or 'N/A'
+                ])
+                count += 1
+                if buffer.tell() >= self.flush_bytes:
+                    yield buffer.getvalue().encode('utf-8')
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue().encode('utf-8')
+            logger.info(f"Stock export: {count} items exported by {username}")
+        except Exception as e:
+            # Headers are already sent, so the download is cut short rather than redirected
+            logger.error(f"Error exporting stock after {count} rows: {str(e)}", exc_info=True)
+            raise
+
+    def _gzip_stream(self, chunks):
+        """Gzip-compress a byte stream on the fly"""
+        import zlib
+        
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
 class StockAdjustmentView(View):
     """View for creating stock adjustments"""
     template_name = 'stock_adjustment.html'
@@ -327,31 +615,55 @@ class StockAdjustmentView(View):
             if form.is_valid():
                 adjustment = form.save(commit=False)
                 adjustment.stock = stock
-                adjustment.previous_quantity = stock.quantity
+                adjustment.previous_quantity = writebehind.effective_quantity(stock)
                 adjustment.adjusted_by = request.user.username if request.user.is_authenticated else 'System'
+                reason = f"{adjustment.get_adjustment_type_display()}: {adjustment.reason}"
+                deferred = writebehind.accumulator.enabled()
                 
-                # Update stock quantity
-                stock.quantity = adjustment.adjusted_quantity
-                stock._changed_by = adjustment.adjusted_by
-                stock._change_reason = f"Stock adjustment: {adjustment.get_adjustment_type_display()}"
-                stock.last_modification = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                stock.save()
+                try:
+                    # In a savepoint, so the conflict leaves the view's transaction usable for the re-render
+                    with transaction.atomic():
+                        if deferred:
+                            self._adjust_deferred(stock, form.cleaned_data['version'], adjustment, reason)
+                        else:
+                            # Update stock quantity
+                            stock.quantity = adjustment.adjusted_quantity
+                            stock._changed_by = adjustment.adjusted_by
+                            stock._change_reason = f"Stock adjustment: {adjustment.get_adjustment_type_display()}"
+                            stock.last_modification = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                            if form.cleaned_data['version'] is not None:
+                                stock.version = form.cleaned_data['version']
+                            stock.save()
+                except StockVersionConflict as e:
+                    # Show the current quantity, carrying its version so a resubmit applies on top of it
+                    stock = Stock.objects.get(pk=pk)
+                    data = request.POST.copy()
+                    data['version'] = str(stock.version)
+                    form = StockAdjustmentForm(data, stock=stock)
+                    form.is_valid()
+                    form.add_error(None, e)
+                    context = {
+                        'stock': stock,
+                        'form': form,
+                    }
+                    return render(request, self.template_name, context)
                 
                 # Save adjustment
                 adjustment.save()
                 
-                # Log to history
-                from .signals import log_stock_transaction
-                log_stock_transaction(
-                    stock=stock,
-                    previous_quantity=adjustment.previous_quantity,
-                    new_quantity=adjustment.adjusted_quantity,
-                    change_type='adjustment',
-                    changed_by=adjustment.adjusted_by,
-                    reason=f"{adjustment.get_adjustment_type_display()}: {adjustment.reason}"
-                )
+                # Log to history (a deferred change is logged when it is flushed)
+                if not deferred:
+                    from .signals import log_stock_transaction
+                    log_stock_transaction(
+                        stock=stock,
+                        previous_quantity=adjustment.previous_quantity,
+                        new_quantity=adjustment.adjusted_quantity,
+                        change_type='adjustment',
+                        changed_by=adjustment.adjusted_by,
+                        reason=reason
+                    )
                 
-                messages.success(request, f"Stock adjusted successfully. New quantity: {stock.quantity}")
+                messages.success(request, f"Stock adjusted successfully. New quantity: {adjustment.adjusted_quantity}")
                 logger.info(f"Stock {stock.name} adjusted by {adjustment.adjusted_by}: {adjustment.previous_quantity} -> {adjustment.adjusted_quantity}")
                 return redirect('inventory')
             else:
@@ -365,6 +677,19 @@ class StockAdjustmentView(View):
             messages.error(request, f"An error occurred while adjusting stock: {str(e)}")
             return redirect('inventory')
 
+    def _adjust_deferred(self, stock, version, adjustment, reason):
+        """
+        Write-behind is on: queue the adjustment as the change from the quantity
+        including pending changes, so those are kept rather than overwritten
+        """
+        if version is not None and version != stock.version:
+            raise StockVersionConflict(stock)
+        delta = adjustment.adjusted_quantity - adjustment.previous_quantity
+        if delta:
+            writebehind.accumulator.add(
+                stock.pk, delta, 'adjustment', adjustment.adjusted_by, reason, respect_holds=False
+            )
+
 class StockImportView(View):
     """Import stock from CSV file"""
     template_name = 'stock_import.html'
@@ -375,16 +700,14 @@ class StockImportView(View):
             return redirect('inventory')
         return render(request, self.template_name, {})
     
-    @transaction.atomic
+    @buffered_history()
     def post(self, request):
         if not request.user.is_superuser:
             messages.error(request, "You don't have permission to import stock.")
             return redirect('inventory')
         
         try:
-            import csv
             from io import TextIOWrapper
-            from django.core.exceptions import ValidationError
             
             if 'csv_file' not in request.FILES:
                 messages.error(request, "Please select a CSV file to upload.")
@@ -392,64 +715,18 @@ class StockImportView(View):
             
             csv_file = request.FILES['csv_file']
             decoded_file = TextIOWrapper(csv_file.file, encoding='utf-8')
-            reader = csv.DictReader(decoded_file)
+            username = request.user.username if request.user.is_authenticated else 'System'
+            result = import_stock_csv(decoded_file, username)
             
-            errors = []
-            success_count = 0
-            rows_processed = []
-            
-            for row_num, row in enumerate(reader, start=2):
-                try:
-                    name = row.get('Name') or row.get('name') or row.get('Item Name') or row.get('item_name')
-                    quantity = row.get('Quantity') or row.get('quantity') or row.get('Qty') or row.get('qty')
-                    unit_price = row.get('Unit Price') or row.get('unit_price') or row.get('Price') or row.get('price')
-                    
-                    if not name or not quantity or not unit_price:
-                        errors.append(f"Row {row_num}: Missing required field")
-                        continue
-                    
-                    try:
-                        quantity = int(quantity)
-                        unit_price = float(unit_price)
-                    except ValueError:
-                        errors.append(f"Row {row_num}: Invalid number format")
-                        continue
-                    
-                    stock, created = Stock.objects.get_or_create(
-                        name=name,
-                        defaults={
-                            'quantity': quantity,
-                            'unit_price': unit_price,
-                            'modified_by': request.user.username if request.user.is_authenticated else 'System',
-                            'last_modification': timezone.now().strftime('%Y-%m-%d %H:%M:%S')
-                        }
-                    )
-                    
-                    if not created:
-                        stock.quantity += quantity
-                        stock.unit_price = unit_price
-                        stock.modified_by = request.user.username if request.user.is_authenticated else 'System'
-                        stock.last_modification = timezone.now().strftime('%Y-%m-%d %H:%M:%S')
-                        stock.full_clean()
-                        stock.save()
-                        rows_processed.append(f"Row {row_num}: Updated {name}")
-                    else:
-                        rows_processed.append(f"Row {row_num}: Created {name}")
-                        success_count += 1
-                    
-                except Exception as e:
-                    errors.append(f"Row {row_num}: {str(e)}")
-                    logger.error(f"Error importing stock row {row_num}: {str(e)}", exc_info=True)
-            
-            if rows_processed:
-                messages.success(request, f"Processed {len(rows_processed)} row(s). {success_count} new item(s) created.")
-            if errors:
-                messages.warning(request, f"Encountered {len(errors)} error(s).")
+            if result.processed_count:
+                messages.success(request, f"Processed {result.processed_count} row(s). {result.created_count} new item(s) created.")
+            if result.error_count:
+                messages.warning(request, f"Encountered {result.error_count} error(s).")
             
             context = {
-                'errors': errors[:20],
-                'success_count': success_count,
-                'rows_processed': rows_processed[:20]
+                'errors': result.errors,
+                'success_count': result.created_count,
+                'rows_processed': result.rows_processed
             }
             return render(request, self.template_name, context)
             
@@ -458,95 +735,73 @@ class StockImportView(View):
             messages.error(request, f"An error occurred: {str(e)}")
             return render(request, self.template_name, {})
 
+class StockAsOfExportView(View):
+    """Export the inventory as it was at ?as_of= (a date or datetime) to CSV"""
+
+    def get(self, request):
+        try:
+            import csv
+            from django.http import HttpResponse
+            
+            as_of = request.GET.get('as_of', '')
+            try:
+                timestamp = parse_as_of(as_of)
+            except ValueError:
+                messages.error(request, f"Invalid as-of date: {as_of}")
+                return redirect('stock-report')
+            items = inventory_as_of(timestamp)
+            
+            response = HttpResponse(content_type='text/csv')
+            response['Content-Disposition'] = f'attachment; filename="stock_as_of_{timestamp.strftime("%Y%m%d_%H%M%S")}.csv"'
+            writer = csv.writer(response)
+            writer.writerow(['Name', 'Quantity', 'Unit Price', 'Value'])
+            for item in items:
+                writer.writerow([item['name'], item['quantity'], item['unit_price'], item['value']])
+            logger.info(f"Stock as of {timestamp}: {len(items)} items exported by {request.user.username}")
+            return response
+        except Exception as e:
+            logger.error(f"Error exporting stock as of a date: {str(e)}", exc_info=True)
+            messages.error(request, f"An error occurred while exporting: {str(e)}")
+            return redirect('stock-report')
+
+
 class StockReportView(View):
     """Comprehensive stock analysis report"""
     template_name = 'stock_report.html'
+    as_of_display_limit = 100                                                           # as-of rows shown; the CSV has all of them
     
     def get(self, request):
         try:
-            from django.db.models import Sum, Count, Avg, F, Q
-            from django.utils import timezone
-            from datetime import timedelta
-            from transactions.models import SaleItem, PurchaseItem
-            
             # Get date range
             days = int(request.GET.get('days', 30))
-            start_date = timezone.now() - timedelta(days=days)
-            
-            # Stock valuation
-            stock_analysis = Stock.objects.filter(
-                is_deleted=False
-            ).aggregate(
-                total_items=Count('id'),
-                total_quantity=Sum('quantity'),
-                total_value=Sum(F('quantity') * F('unit_price')),
-                avg_price=Avg('unit_price'),
-                max_price=Max('unit_price'),
-                min_price=Min('unit_price')
-            )
-            
-            # Low stock analysis
-            low_stock = Stock.objects.filter(
-                is_deleted=False,
-                quantity__lte=10
-            ).order_by('quantity')
-            
-            # Out of stock
-            out_of_stock = Stock.objects.filter(
-                is_deleted=False,
-                quantity=0
-            )
-            
-            # Items sold in period
-            items_sold = SaleItem.objects.filter(
-                billno__time__gte=start_date
-            ).values('stock__name').annotate(
-                total_sold=Sum('quantity'),
-                revenue=Sum('totalprice')
-            ).order_by('-total_sold')[:10]
-            
-            # Items purchased in period
-            items_purchased = PurchaseItem.objects.filter(
-                billno__time__gte=start_date
-            ).values('stock__name').annotate(
-                total_purchased=Sum('quantity'),
-                cost=Sum('totalprice')
-            ).order_by('-total_purchased')[:10]
             
-            # Slow moving items (not sold in last 90 days)
-            ninety_days_ago = timezone.now() - timedelta(days=90)
-            slow_moving = Stock.objects.filter(
-                is_deleted=False
-            ).exclude(
-                saleitem__billno__time__gte=ninety_days_ago
-            ).annotate(
-                value=F('quantity') * F('unit_price')
-            ).distinct()[:10]
+            # Identical requests in flight share one build; builds are capped.
+            # The result is shared, so it is copied before adding to it.
+            context = dict(get_stock_report(days, request.GET.get('bucket')))
             
-            # High value items
-            high_value = Stock.objects.filter(
-                is_deleted=False
-            ).annotate(
-                value=F('quantity') * F('unit_price')
-            ).order_by('-value')[:10]
-            
-            # Add value to low_stock items for display
-            low_stock = low_stock.annotate(
-                value=F('quantity') * F('unit_price')
-            )
-            
-            context = {
-                'stock_analysis': stock_analysis,
-                'items_sold': items_sold,
-                'items_purchased': items_purchased,
-                'low_stock': low_stock,
-                'out_of_stock': out_of_stock,
-                'slow_moving': slow_moving,
-                'high_value': high_value,
-                'days': days,
-                'start_date': start_date,
-            }
+            # Inventory as it was at a past date
+            as_of = request.GET.get('as_of')
+            if as_of:
+                try:
+                    timestamp = parse_as_of(as_of)
+                except ValueError:
+                    messages.error(request, f"Invalid as-of date: {as_of}")
+                else:
+                    as_of_items = inventory_as_of(timestamp)
+                    context.update({
+                        'as_of': as_of,
+                        'as_of_timestamp': timestamp,
+                        'as_of_items': as_of_items[:self.as_of_display_limit],
+                        'as_of_count': len(as_of_items),
+                        'as_of_quantity': sum(item['quantity'] for item in as_of_items),
+                        'as_of_value': sum(item['value'] or 0 for item in as_of_items),
+                    })
             return render(request, self.template_name, context)
+        except ServerBusy as e:
+            logger.warning(f"Stock report for {request.user} deferred: {str(e)}")
+            response = render(request, 'stock_report_busy.html', {'retry_after': e.retry_after}, status=503)
+            response['Retry-After'] = str(e.retry_after)
+            return response
         except Exception as e:
             logger.error(f"Error generating stock report: {str(e)}", exc_info=True)
             messages.error(request, "An error occurred while generating the report.")
@@ -0,0 +1,477 @@
+"""
+Write-behind quantity changes for fast-moving stock.
+
+With STOCK_WRITE_BEHIND_MS set, reserve(), release() and reserve_many() do
+not write the Stock rows. The change is appended (and fsynced) to this
+process's journal file and added to an in-memory pending total when the
+caller's transaction commits; until then it counts only for that
+transaction, and a rollback drops it. Every
+STOCK_WRITE_BEHIND_MS a background thread applies what accumulated: one
+conditional F('quantity') + net delta UPDATE per item, and one history row
+per run of consecutive changes by the same type and user, in journal order.
+This is a single transaction that also advances the journal's
+StockJournalCheckpoint. An item taking hundreds of changes a minute then
+costs a few writes a second instead of one per change.
+
+Only one process per journal directory defers changes: the first to use
+write-behind takes the directory's owner lock and keeps it while it runs. The
+others write their changes straight through, as if the setting were off, and
+take over (replaying the old owner's journal) once the owner is gone. The
+owner therefore sees every deferred change when it checks availability.
+
+Applying the net change means the order of changes within a flush cannot make
+an item look oversold. An item whose net change still cannot be applied
+(deleted, or drained by a write that did not go through write-behind) keeps
+its changes pending for up to STOCK_WRITE_BEHIND_MAX_ATTEMPTS flushes. The
+checkpoint lists them as held, and the journal is cut down to them. After the
+last attempt they are saved as RejectedStockChange rows, logged as errors
+and dropped, so they can be re-entered by hand.
+
+Crash safety: a process holds an flock on its journal while it runs. On
+start-up, and from replay_stock_journals, journals nobody holds are
+replayed past their checkpoint (plus its held records) and removed. A crash
+between the commit and the journal truncation therefore cannot apply a
+change twice.
+
+A crash between a caller's commit and the journal append loses the change;
+the rest of the caller's transaction stays committed.
+
+Reads that must see accepted changes use effective_quantity() or
+pending(). They add this process's unflushed deltas, and the calling
+transaction's uncommitted ones, to the stored quantity. reserve() checks
+availability the same way.
+
+Without the setting, or without fcntl (Windows), reserve() and release()
+call Stock.reserve_stock() / release_stock() directly.
+"""
+import atexit
+import json
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from .models import RejectedStockChange, Stock, StockJournalCheckpoint
+from .signals import buffered_history
+import logging
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Milliseconds between flushes; 0 writes every change straight through
+INTERVAL_MS = getattr(settings, 'STOCK_WRITE_BEHIND_MS', 0)
+
+# Flushes a change that cannot be applied is retried on before it is rejected
+MAX_ATTEMPTS = getattr(settings, 'STOCK_WRITE_BEHIND_MAX_ATTEMPTS', 20)
+
+JOURNAL_SUFFIX = '.journal'
+
+# Held by the one process that defers changes for a journal directory
+OWNER_LOCK = 'owner.lock'
+
+
+def journal_dir():
+    return getattr(settings, 'STOCK_WRITE_BEHIND_JOURNAL_DIR', os.path.join(settings.BASE_DIR, 'stock_journal'))
+
+
+def _history_parts(records):
+    """
+    One item's records as (delta, change type, user, reason) runs of consecutive
+    changes by the same type and user, in journal order
+    """
+    runs = []
+    for record in records:
+        key = (record['change_type'], record['changed_by'])
+        if not runs or runs[-1][0] != key:
+            runs.append((key, [0, 0, set()]))
+        run = runs[-1][1]
+        run[0] += record['delta']
+        run[1] += 1
+        run[2].add(record['reason'])
+    parts = []
+    for (change_type, changed_by), (delta, count, reasons) in runs:
+        reason = next(iter(reasons)) if len(reasons) == 1 else 'Stock changes'
+        if count > 1:
+            reason = f"{reason} ({count} changes coalesced)"
+        parts.append((delta, change_type, changed_by, reason))
+    return parts
+
+
+def _apply(records):
+    """
+    Apply journal records as one conditional UPDATE of each item's net delta,
+    with a history row per run of changes by the same type and user. Must run
+    inside a transaction. Returns the records that could not be applied, in
+    journal order: an item that is deleted, or whose net change would take it
+    below zero because other processes changed it meanwhile, keeps its records
+    for a later attempt.
+    """
+    by_stock = defaultdict(list)
+    for record in records:
+        by_stock[record['stock_id']].append(record)
+    held = []
+    for stock_id, stock_records in by_stock.items():
+        delta = sum(record['delta'] for record in stock_records)
+        parts = _history_parts(stock_records)
+        if Stock(pk=stock_id)._apply_quantity_delta(
+            delta, None, None, None, history=parts, respect_holds=False
+        ) is None:
+            logger.warning(
+                f"Write-behind: could not apply {delta:+d} ({len(stock_records)} change(s)) to stock {stock_id}; "
+                f"the item is deleted or the quantity would go below zero"
+            )
+            held.extend(stock_records)
+    return sorted(held, key=lambda record: record['seq'])
+
+
+def _retry_or_reject(journal, held):
+    """
+    Count a failed attempt on each held record and return those with attempts
+    left. The others are saved as RejectedStockChange rows, in the caller's
+    transaction, and dropped.
+    """
+    kept, rejected = [], []
+    for record in held:
+        record = dict(record, attempts=record.get('attempts', 0) + 1)
+        (rejected if record['attempts'] >= MAX_ATTEMPTS else kept).append(record)
+    if rejected:
+        RejectedStockChange.objects.bulk_create([
+            RejectedStockChange(
+                journal=journal, seq=record['seq'], stock_id=record['stock_id'], delta=record['delta'],
+                change_type=record['change_type'], changed_by=record['changed_by'],
+                reason=record['reason'], attempts=record['attempts']
+            )
+            for record in rejected
+        ])
+        logger.error(
+            f"Write-behind: rejected {len(rejected)} change(s) from journal {journal} after "
+            f"{MAX_ATTEMPTS} attempts: " + ', '.join(
+                f"{record['delta']:+d} on stock {record['stock_id']} by {record['changed_by']}" for record in rejected
+            )
+        )
+    return kept
+
+
+def _rewrite_journal(path, records):
+    """
+    Replace the journal at path with just `records`, atomically, and return a
+    descriptor of the new file, flocked so no replay takes it over
+    """
+    fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    os.write(fd, ''.join(json.dumps(record) + '\n' for record in records).encode())
+    os.fsync(fd)
+    os.replace(path + '.tmp', path)
+    return fd
+
+
+def _read_journal(journal):
+    records = []
+    for line in journal:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            # A torn last line from a crash; it was never acknowledged
+            break
+    return records
+
+
+def replay_journals():
+    """
+    Apply and remove the journals of processes that are gone; returns the number
+    of records applied. Journals still locked by a live process are left alone,
+    and records that still cannot be applied stay in their journal for the next replay.
+    """
+    directory = journal_dir()
+    if fcntl is None or not os.path.isdir(directory):
+        return 0
+    replayed = 0
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(JOURNAL_SUFFIX):
+            continue
+        path = os.path.join(directory, filename)
+        name = filename[:-len(JOURNAL_SUFFIX)]
+        with open(path, 'rb') as journal:
+            try:
+                fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            if not os.path.exists(path) or not os.path.samestat(os.stat(path), os.fstat(journal.fileno())):
+                # Replaced by its owner's compaction, or replayed, while we opened it
+                continue
+            records = _read_journal(journal)
+            with transaction.atomic():
+                checkpoint = StockJournalCheckpoint.objects.filter(journal=name).first()
+                if checkpoint:
+                    due = set(checkpoint.held_seqs)
+                    records = [
+                        record for record in records
+                        if record['seq'] > checkpoint.applied_seq or record['seq'] in due
+                    ]
+                with buffered_history():
+                    unapplied = _apply(records)
+                held = _retry_or_reject(name, unapplied)
+                if held:
+                    StockJournalCheckpoint.objects.update_or_create(journal=name, defaults={
+                        'applied_seq': max(record['seq'] for record in records),
+                        'held_seqs': [record['seq'] for record in held],
+                    })
+                else:
+                    StockJournalCheckpoint.objects.filter(journal=name).delete()
+            if held:
+                os.close(_rewrite_journal(path, held))
+            else:
+                os.remove(path)
+        applied = len(records) - len(unapplied)
+        replayed += applied
+        if applied:
+            logger.warning(f"Write-behind: replayed {applied} change(s) from journal {name}")
+        if held:
+            logger.warning(f"Write-behind: {len(held)} change(s) in journal {name} still cannot be applied")
+    return replayed
+
+
+class _Accepted:
+    """
+    on_commit callback that journals one accept's changes. While it waits, its
+    records are the accepting transaction's pending buffer.
+    """
+
+    def __init__(self, accumulator, records):
+        self.accumulator = accumulator
+        self.records = records
+
+    def __call__(self):
+        self.accumulator._commit(self.records)
+
+
+class DeltaAccumulator:
+    """Per-process journal, pending totals and flusher thread"""
+
+    def __init__(self, interval_ms=INTERVAL_MS):
+        self.interval_ms = interval_ms
+        self._lock = threading.RLock()
+        self._records = []
+        self._pending = defaultdict(int)
+        self._seq = 0
+        self._fd = None
+        self._pid = None
+        self._name = None
+        self._owner_fd = None
+        self._owner_pid = None
+        self._next_owner_try = 0
+
+    def enabled(self):
+        """Whether this process defers changes: write-behind is on and it owns the journal directory"""
+        if fcntl is None or not self.interval_ms:
+            return False
+        # Other processes (and the replay) cannot see an in-memory database
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            return False
+        return self._own()
+
+    def _own(self):
+        """
+        Take the journal directory's owner lock unless another process holds it;
+        a process that does not get it tries again after a flush interval
+        """
+        with self._lock:
+            if self._owner_pid == os.getpid():
+                return True
+            if time.monotonic() < self._next_owner_try:
+                return False
+            os.makedirs(journal_dir(), exist_ok=True)
+            fd = os.open(os.path.join(journal_dir(), OWNER_LOCK), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                self._next_owner_try = time.monotonic() + self.interval_ms / 1000
+                return False
+            self._owner_fd, self._owner_pid = fd, os.getpid()
+            return True
+
+    def _start(self):
+        """Replay orphaned journals, then open this process's journal and start the flusher"""
+        if self._pid == os.getpid():
+            return
+        if not self._own():
+            raise RuntimeError("Another process owns the write-behind journals")
+        replay_journals()
+        self._name = f"{socket.gethostname()}-{os.getpid()}-{int(time.time() * 1000)}"
+        self._fd = os.open(
+            self._path(),
+            os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600
+        )
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        self._pid = os.getpid()
+        self._records, self._pending, self._seq = [], defaultdict(int), 0
+        threading.Thread(target=self._run, name='stock-write-behind', daemon=True).start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval_ms / 1000)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Write-behind flush failed, will retry: {str(e)}", exc_info=True)
+            finally:
+                connection.close()
+
+    def _path(self):
+        return os.path.join(journal_dir(), self._name + JOURNAL_SUFFIX)
+
+    def _commit(self, records):
+        """Journal the changes of a committed transaction"""
+        with self._lock:
+            self._start()
+            self._append(records)
+
+    def _append(self, records):
+        """Journal changes (durably) and count them as pending"""
+        for record in records:
+            self._seq += 1
+            record['seq'] = self._seq
+        os.write(self._fd, ''.join(json.dumps(record) + '\n' for record in records).encode())
+        os.fsync(self._fd)
+        for record in records:
+            self._records.append(record)
+            self._pending[record['stock_id']] += record['delta']
+
+    def _uncommitted(self):
+        """
+        {stock_id: net change} accepted by the calling thread's open transaction.
+        A rollback, of the transaction or of the savepoint that accepted a
+        change, discards its on_commit callback and so the change with it.
+        """
+        uncommitted = defaultdict(int)
+        for _, callback, _ in connection.run_on_commit:
+            if isinstance(callback, _Accepted) and callback.accumulator is self:
+                for record in callback.records:
+                    uncommitted[record['stock_id']] += record['delta']
+        return uncommitted
+
+    def pending(self, stock_id):
+        """Net quantity change accepted for the item but not yet written"""
+        with self._lock:
+            flushing = self._pending.get(stock_id, 0) if self._pid == os.getpid() else 0
+        return flushing + self._uncommitted().get(stock_id, 0)
+
+    def add_many(self, deltas, change_type, changed_by, reason, check=None, respect_holds=True):
+        """
+        Accept {stock_id: delta} for the next flush, all or nothing, and return
+        {stock_id: effective quantity}. Inside a transaction the changes are
+        journaled when it commits. `check` is called with {stock_id: row}
+        (id, name, quantity including pending changes, is_deleted, held) for the
+        items found and may raise to refuse the lot; by default a missing or
+        deleted item, or a decrease into the units held by active reservations
+        (none with respect_holds off), raises ValidationError like reserve_stock.
+        """
+        from .reservations import active_holds
+        with self._lock:
+            self._start()
+            rows = {
+                row['id']: row
+                for row in Stock.objects.filter(pk__in=deltas).values('id', 'name', 'quantity', 'is_deleted')
+            }
+            held = active_holds(list(deltas)) if respect_holds else {}
+            uncommitted = self._uncommitted()
+            for stock_id, row in rows.items():
+                row['quantity'] += self._pending.get(stock_id, 0) + uncommitted.get(stock_id, 0)
+                row['held'] = held.get(stock_id, 0)
+            if check is not None:
+                check(rows)
+            for stock_id, delta in deltas.items():
+                row = rows.get(stock_id)
+                if row is None or row['is_deleted']:
+                    raise ValidationError("Cannot change stock: stock item is deleted")
+                if delta < 0 and row['quantity'] + delta < row['held']:
+                    raise ValidationError("Cannot reserve stock: insufficient quantity")
+            transaction.on_commit(_Accepted(self, [
+                {'stock_id': stock_id, 'delta': delta, 'change_type': change_type,
+                 'changed_by': changed_by, 'reason': reason}
+                for stock_id, delta in deltas.items()
+            ]))
+            return {stock_id: rows[stock_id]['quantity'] + delta for stock_id, delta in deltas.items()}
+
+    def add(self, stock_id, delta, change_type, changed_by, reason, respect_holds=True):
+        """
+        Accept a quantity change for the next flush and return the item's
+        effective quantity. Decreases are checked against the stored quantity
+        plus pending changes, less active holds; raises ValidationError like reserve_stock.
+        """
+        return self.add_many(
+            {stock_id: delta}, change_type, changed_by, reason, respect_holds=respect_holds
+        )[stock_id]
+
+    def flush(self):
+        """
+        Write everything committed so far; returns the number of changes written.
+        Changes that cannot be applied yet stay journaled and pending, and the
+        checkpoint lists them so a replay still applies them, until they run
+        out of attempts and are rejected.
+        """
+        with self._lock:
+            if self._pid != os.getpid() or not self._records:
+                return 0
+            records = self._records
+            with transaction.atomic():
+                with buffered_history():
+                    unapplied = _apply(records)
+                held = _retry_or_reject(self._name, unapplied)
+                StockJournalCheckpoint.objects.update_or_create(journal=self._name, defaults={
+                    'applied_seq': records[-1]['seq'],
+                    'held_seqs': [record['seq'] for record in held],
+                })
+            self._records = held
+            self._pending = defaultdict(int)
+            for record in held:
+                self._pending[record['stock_id']] += record['delta']
+            # The checkpoint covers a crash before the journal is cut down to what is held
+            if held:
+                fd = _rewrite_journal(self._path(), held)
+                os.close(self._fd)
+                self._fd = fd
+            else:
+                os.ftruncate(self._fd, 0)
+            return len(records) - len(unapplied)
+
+
+accumulator = DeltaAccumulator()
+
+
+def reserve(stock, quantity, changed_by='System', reason='Stock reserved', change_type='sale'):
+    """Stock.reserve_stock, deferred to the next flush when write-behind is on; returns the new quantity"""
+    if quantity <= 0:
+        raise ValidationError("Cannot reserve stock: quantity must be positive")
+    if not accumulator.enabled():
+        return stock.reserve_stock(quantity, changed_by=changed_by, reason=reason, change_type=change_type)
+    return accumulator.add(stock.pk, -quantity, change_type, changed_by, reason)
+
+
+def release(stock, quantity, changed_by='System', reason='Stock released', change_type='adjustment'):
+    """Stock.release_stock, deferred to the next flush when write-behind is on; returns the new quantity"""
+    if quantity <= 0:
+        raise ValidationError("Cannot release stock: quantity must be positive")
+    if not accumulator.enabled():
+        return stock.release_stock(quantity, changed_by=changed_by, reason=reason, change_type=change_type)
+    return accumulator.add(stock.pk, quantity, change_type, changed_by, reason)
+
+
+def pending(stock_id):
+    """Unflushed quantity change for the item in this process"""
+    return accumulator.pending(stock_id)
+
+
+def effective_quantity(stock):
+    """The item's quantity including changes accepted but not yet written"""
+    return stock.quantity + accumulator.pending(stock.pk)